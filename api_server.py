@@ -1,14 +1,14 @@
 from fastapi import FastAPI, HTTPException, Header, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
-from datetime import datetime
 import uvicorn
 import asyncio
 import logging
 
 import config
-from database import Database
+import services
+from timeutil import to_sql_text
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,10 +23,7 @@ logger = logging.getLogger(__name__)
 
 # Инициализация
 app = FastAPI(title="DARKVEIL API", version="0.03")
-db = Database()
-
-# Хранилище для отправки сообщений боту
-message_queue = asyncio.Queue()
+db = services.get_database()
 
 # ===== МОДЕЛИ ДАННЫХ =====
 
@@ -92,12 +89,7 @@ def verify_user_key(user_id: str, user_key: str) -> bool:
 
 async def send_to_bot(user_id: int, message: str, message_type: str = "notification"):
     """Отправить сообщение боту"""
-    await message_queue.put({
-        'user_id': user_id,
-        'message': message,
-        'type': message_type,
-        'timestamp': datetime.now().isoformat()
-    })
+    services.notify(user_id, message, message_type)
 
 # ===== ЭНДПОИНТЫ API =====
 
@@ -161,13 +153,15 @@ async def heartbeat(request: HeartbeatRequest, api_key: str = Header(None)):
     try:
         uid = int(request.user_id)
         
-        # Обновляем heartbeat
-        db.update_heartbeat(uid)
-        
-        # Обновляем статус
         is_running = request.status == "running"
         status = db.get_script_status(uid)
-        db.update_script_status(uid, is_running, status.get('is_paused', False))
+        
+        # Heartbeat и статус уходят в очередь записи без блокировки event loop:
+        # одновременные heartbeat разных скриптов попадают в один групповой коммит
+        await asyncio.gather(
+            asyncio.wrap_future(db.update_heartbeat(uid, wait=False)),
+            asyncio.wrap_future(db.update_script_status(uid, is_running, status.get('is_paused', False), wait=False))
+        )
         
         return {"valid": True, "message": "Heartbeat received"}
     except Exception as e:
@@ -197,24 +191,8 @@ async def get_config(
     try:
         uid = int(user_id)
         
-        # Получаем настройки
-        settings = db.get_script_settings(uid)
-        
-        # Получаем координаты
-        coordinates = db.get_user_coordinates(uid)
-        
-        # Формируем конфигурацию
-        config_data = {}
-        
-        # Добавляем настройки
-        config_data.update(settings)
-        
-        # Добавляем координаты
-        for coord_name, coord_data in coordinates.items():
-            config_data[f"{coord_name}_x"] = coord_data['x']
-            config_data[f"{coord_name}_y"] = coord_data['y']
-        
-        return config_data
+        # Конфиг (настройки + координаты) собирается при записи - здесь только отдаём готовые байты
+        return Response(content=db.get_script_config(uid), media_type="application/json")
         
     except Exception as e:
         logger.error(f"Config error: {e}")
@@ -327,18 +305,9 @@ async def check_commands(user_id: int, api_key: str = Header(None)):
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     try:
-        # Получаем статус
-        status = db.get_script_status(user_id)
-        
-        # Получаем команды
-        commands = db.get_pending_commands(user_id)
-        
-        return {
-            "is_running": status.get('is_running', False),
-            "is_paused": status.get('is_paused', False),
-            "pause_until": status.get('pause_until'),
-            "has_commands": len(commands) > 0
-        }
+        state = services.get_script_state(user_id)
+        state['pause_until'] = to_sql_text(state['pause_until'])
+        return state
     except Exception as e:
         logger.error(f"Check commands error: {e}")
         raise HTTPException(status_code=500, detail="Error checking commands")
@@ -357,7 +326,7 @@ async def create_command(request: CommandRequest, api_key: str = Header(None)):
     
     try:
         if request.command == "stop":
-            db.update_script_status(request.user_id, False, False)
+            services.stop_script(request.user_id)
             return {"status": "ok", "message": "Stop command sent"}
         
         return {"status": "ok", "message": "Command created"}
@@ -379,7 +348,7 @@ async def set_pause(request: PauseRequest, api_key: str = Header(None)):
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     try:
-        db.set_pause(request.user_id, request.seconds)
+        services.pause_script(request.user_id, request.seconds)
         
         if request.seconds > 0:
             return {"status": "ok", "message": "Pause set"}
@@ -463,7 +432,7 @@ async def script_stopped(request: NotificationRequest):
         uid = int(request.user_id)
         
         # Обновляем статус
-        db.update_script_status(uid, False, False)
+        await asyncio.wrap_future(db.update_script_status(uid, False, False, wait=False))
         
         # Отправляем уведомление
         message = f"🛑 Скрипт остановлен\nПричина: {request.message}"
@@ -485,10 +454,7 @@ async def device_info(request: DeviceInfoRequest):
         await send_to_bot(uid, request.message, "device_info")
         
         # Удаляем команду из очереди
-        commands = db.get_pending_commands(uid)
-        for cmd in commands:
-            if cmd['command_type'] == 'get_device_info':
-                db.complete_command(cmd['id'])
+        services.complete_commands(uid, 'get_device_info')
         
         return {"status": "ok"}
     except Exception as e:
@@ -506,10 +472,7 @@ async def script_info(request: DeviceInfoRequest):
         await send_to_bot(uid, request.message, "script_info")
         
         # Удаляем команду из очереди
-        commands = db.get_pending_commands(uid)
-        for cmd in commands:
-            if cmd['command_type'] == 'get_script_info':
-                db.complete_command(cmd['id'])
+        services.complete_commands(uid, 'get_script_info')
         
         return {"status": "ok"}
     except Exception as e:
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | BACKUP
+
+Онлайн-копии базы через SQLite backup API: копирование идёт порциями по
+BACKUP_PAGES_PER_STEP страниц с паузой между ними, бот и API продолжают работать.
+
+Использование:
+    python backup.py now                 - сделать копию сейчас
+    python backup.py list                - список копий
+    python backup.py restore <файл>      - восстановить базу из копии (сервисы остановить!)
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from typing import List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+BACKUP_SUFFIX = ".db.gz"
+
+def _backup_prefix(db_path: str) -> str:
+    """Префикс имён копий базы: darkveil.db -> darkveil_ (у каждого шарда свой)"""
+    return f"{os.path.splitext(os.path.basename(db_path))[0]}_"
+
+def _copy_database(source_path: str, target_path: str):
+    """Скопировать живую базу порциями страниц"""
+    source = sqlite3.connect(source_path, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        # Держим читающую транзакцию на всё время копирования: в WAL писатель не блокируется,
+        # а копия снимается с одного снимка и не перезапускается от каждого коммита
+        source.execute('BEGIN')
+        source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        
+        source.backup(
+            target,
+            pages=config.BACKUP_PAGES_PER_STEP,
+            sleep=config.BACKUP_STEP_SLEEP_SECONDS
+        )
+        source.execute('COMMIT')
+    finally:
+        target.close()
+        source.close()
+
+def create_backup(db_path: str = config.DATABASE_PATH, backup_dir: str = config.BACKUP_DIR) -> str:
+    """
+    Сделать сжатую копию базы и удалить старые
+    
+    Returns:
+        Путь к созданной копии
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    
+    name = f"{_backup_prefix(db_path)}{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    raw_path = os.path.join(backup_dir, f"{name}.db.tmp")
+    part_path = os.path.join(backup_dir, f"{name}{BACKUP_SUFFIX}.part")
+    final_path = os.path.join(backup_dir, f"{name}{BACKUP_SUFFIX}")
+    
+    try:
+        _copy_database(db_path, raw_path)
+        
+        with open(raw_path, 'rb') as src, gzip.open(part_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(part_path, final_path)
+    finally:
+        for path in (raw_path, part_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    rotate_backups(backup_dir, db_path=db_path)
+    return final_path
+
+def list_backups(backup_dir: str = config.BACKUP_DIR, db_path: str = config.DATABASE_PATH) -> List[str]:
+    """Список копий базы db_path, новые первыми"""
+    if not os.path.isdir(backup_dir):
+        return []
+    
+    prefix = _backup_prefix(db_path)
+    names = [
+        name for name in os.listdir(backup_dir)
+        if name.startswith(prefix) and name.endswith(BACKUP_SUFFIX)
+    ]
+    # Имя содержит дату в сортируемом виде
+    return [os.path.join(backup_dir, name) for name in sorted(names, reverse=True)]
+
+def rotate_backups(backup_dir: str = config.BACKUP_DIR, keep: int = config.BACKUP_KEEP,
+                   db_path: str = config.DATABASE_PATH) -> int:
+    """Удалить копии базы db_path сверх keep последних. Возвращает количество удалённых"""
+    removed = 0
+    for path in list_backups(backup_dir, db_path)[keep:]:
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError as e:
+            logger.warning(f"Не удалось удалить копию {path}: {e}")
+    return removed
+
+def restore_backup(backup_path: str, db_path: str = config.DATABASE_PATH):
+    """
+    Восстановить базу из сжатой копии
+    
+    Копия распаковывается во временный файл, проверяется integrity_check и
+    переносится в рабочую базу через backup API (корректно и для WAL).
+    Бот и API на время восстановления нужно остановить.
+    """
+    raw_path = f"{db_path}.restore.tmp"
+    try:
+        with gzip.open(backup_path, 'rb') as src, open(raw_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        
+        source = sqlite3.connect(raw_path)
+        try:
+            check = source.execute('PRAGMA integrity_check').fetchone()[0]
+            if check != 'ok':
+                raise ValueError(f"Копия повреждена: {check}")
+            
+            target = sqlite3.connect(db_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+# ===== ФОНОВОЕ КОПИРОВАНИЕ =====
+
+_stop_event = threading.Event()
+
+def _backup_loop(db_paths: List[str], interval: float):
+    """Цикл фонового потока: копии всех баз раз в interval секунд"""
+    while not _stop_event.wait(interval):
+        for db_path in db_paths:
+            try:
+                path = create_backup(db_path)
+                logger.info(f"Резервная копия создана: {path}")
+            except Exception as e:
+                logger.error(f"Ошибка резервного копирования {db_path}: {e}")
+
+def start_backup_thread(db_paths: List[str] = None,
+                        interval: float = config.BACKUP_INTERVAL_SECONDS) -> Optional[threading.Thread]:
+    """Запустить периодическое копирование баз db_paths (по умолчанию DATABASE_PATH) в фоновом потоке"""
+    if interval <= 0:
+        return None
+    
+    _stop_event.clear()
+    db_paths = list(db_paths or [config.DATABASE_PATH])
+    thread = threading.Thread(target=_backup_loop, args=(db_paths, interval), name="db-backup", daemon=True)
+    thread.start()
+    return thread
+
+def stop_backup_thread():
+    """Остановить фоновое копирование"""
+    _stop_event.set()
+
+# ===== CLI =====
+
+def main(argv: List[str] = None) -> int:
+    """Точка входа CLI"""
+    parser = argparse.ArgumentParser(description="Резервные копии базы DARKVEIL")
+    parser.add_argument('--db', default=config.DATABASE_PATH, help="путь к базе")
+    parser.add_argument('--dir', default=config.BACKUP_DIR, help="каталог копий")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('now', help="сделать копию сейчас")
+    commands.add_parser('list', help="список копий")
+    restore = commands.add_parser('restore', help="восстановить базу из копии")
+    restore.add_argument('backup', help="файл копии или 'latest'")
+    args = parser.parse_args(argv)
+    
+    if args.command == 'now':
+        print(create_backup(args.db, args.dir))
+    elif args.command == 'list':
+        for path in list_backups(args.dir, args.db):
+            print(f"{path}\t{os.path.getsize(path)} байт")
+    elif args.command == 'restore':
+        backup_path = args.backup
+        if backup_path == 'latest':
+            backups = list_backups(args.dir, args.db)
+            if not backups:
+                print("Копий нет", file=sys.stderr)
+                return 1
+            backup_path = backups[0]
+        restore_backup(backup_path, args.db)
+        print(f"База {args.db} восстановлена из {backup_path}")
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=getattr(logging, config.LOG_LEVEL))
+    sys.exit(main())
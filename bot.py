@@ -5,25 +5,32 @@ LAST UPDATE - 14:51
 """
 
 import asyncio
+import functools
+import html
 import logging
 import os
 import re
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional, Dict, List, Tuple, Any
 from enum import Enum
 
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, FSInputFile
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, FSInputFile, BufferedInputFile
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 
-import aiohttp
+import backup
 import config
+import services
 import texts
-from database import Database
+from deferred import DeferredActions
+from fsm_storage import PersistentFSMStorage
+from outbound import OutboundScheduler, Priority, RenderedScreens, is_not_modified
+from screens import ADMIN_MAIN_KEYBOARD, COMMANDS_MAIN_KEYBOARD, RenderCache
+from timeutil import format_timestamp
+from ui_state import UIStateStore
 
 # Настройка логирования без эмодзи для консоли Windows
 logging.basicConfig(
@@ -38,12 +45,21 @@ logger = logging.getLogger(__name__)
 
 # Инициализация
 bot = Bot(token=config.BOT_TOKEN)
-storage = MemoryStorage()
+db = services.get_database()
+# Состояния диалогов переживают перезапуск: в памяти, в БД - пачками в фоне
+storage = PersistentFSMStorage(db)
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
 
-db = Database()
+# Весь вывод в Telegram - через очередь с лимитами и приоритетами
+outbound = OutboundScheduler()
+# Отложенные действия (удалить сообщение позже и т.п.) - одним таймером, без ожидания в обработчиках
+deferred = DeferredActions(bot, outbound, db)
+# Отпечатки отрисованных экранов: правку без изменений не отправляем
+rendered_screens = RenderedScreens()
+# Отрисованные экраны: повторный показ без изменений настроек не собирает их заново
+render_cache = RenderCache()
 
 # Состояния FSM
 class UserStates(StatesGroup):
@@ -95,6 +111,8 @@ class UserStates(StatesGroup):
     admin_key_detail = State()
     admin_statistics = State()
     admin_loot = State()
+    admin_bulk_count = State()
+    admin_bulk_keys = State()
     
     # Настройки пользователя
     user_settings = State()
@@ -102,11 +120,9 @@ class UserStates(StatesGroup):
     # Цвета координат
     color_input = State()
 
-# Глобальные переменные
-user_current_message_id = {}
-active_users_in_script_control = {}
-script_status_cache = {}
-last_status_update = {}
+# Текущее сообщение бота и открытая панель скрипта по пользователям (ограничено, с TTL;
+# message_id переживает перезапуск через users.last_message_id)
+ui_state = UIStateStore(db)
 
 # ====================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
@@ -137,36 +153,89 @@ def make_keyboard(buttons: List[tuple], row_width: int = 2, last_row_full: bool
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-async def edit_or_send_message(user_id: int, text: str, keyboard: InlineKeyboardMarkup = None):
+def cached_screen(screen: str, user_id: int, render, status: Any = None) -> tuple:
+    """
+    Экран, зависящий от настроек пользователя, из кэша отрисовки
+    
+    Ключ включает config_version: после сохранения настроек или координат
+    экран отрисуется заново, до этого - берётся готовым
+    """
+    key = (screen, user_id, db.get_config_version(user_id), status)
+    return render_cache.get_or_render(key, render)
+
+async def edit_message(user_id: int, message_id: int, text: str, keyboard: InlineKeyboardMarkup = None,
+                       priority: Priority = Priority.INTERACTIVE, wait: bool = True):
+    """
+    Отредактировать сообщение, если его содержимое действительно меняется
+    
+    Совпадение с последним отрисованным и ответ "message is not modified" - успех без ошибки.
+    При wait=False правка уходит в фоне, ошибки только логируются.
+    """
+    fingerprint = rendered_screens.fingerprint(text, keyboard)
+    if rendered_screens.is_unchanged(user_id, message_id, fingerprint):
+        return
+    rendered_screens.remember(user_id, message_id, fingerprint)
+    
+    def edited(future):
+        if future.cancelled() or future.exception() is None or is_not_modified(future.exception()):
+            return
+        # Что показано в сообщении, теперь неизвестно - следующую правку не пропускаем
+        rendered_screens.forget(user_id, message_id)
+        if not wait:
+            logger.debug(f"Не удалось обновить сообщение user_id={user_id}: {future.exception()}")
+    
+    future = outbound.submit(
+        user_id,
+        lambda: bot.edit_message_text(
+            chat_id=user_id,
+            message_id=message_id,
+            text=text,
+            reply_markup=keyboard,
+            parse_mode="HTML"
+        ),
+        priority,
+        coalesce_key=(user_id, message_id)
+    )
+    future.add_done_callback(edited)
+    if not wait:
+        return
+    
+    try:
+        await future
+    except Exception as e:
+        if not is_not_modified(e):
+            raise
+
+async def edit_or_send_message(user_id: int, text: str, keyboard: InlineKeyboardMarkup = None,
+                               priority: Priority = Priority.INTERACTIVE):
     """Редактирует существующее сообщение или отправляет новое"""
-    if user_id in user_current_message_id:
+    message_id = ui_state.get_message_id(user_id)
+    if message_id is not None:
         try:
-            await bot.edit_message_text(
-                chat_id=user_id,
-                message_id=user_current_message_id[user_id],
-                text=text,
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
+            await edit_message(user_id, message_id, text, keyboard, priority)
             return True
         except Exception as e:
             logger.warning(f"Не удалось редактировать сообщение: {e}")
             try:
-                await bot.delete_message(user_id, user_current_message_id[user_id])
+                await outbound.submit(user_id, lambda: bot.delete_message(user_id, message_id), priority, paced=False)
             except Exception as e2:
                 logger.warning(f"Не удалось удалить сообщение: {e2}")
-            if user_id in user_current_message_id:
-                del user_current_message_id[user_id]
+            ui_state.set_message_id(user_id, None)
     
     # Отправляем новое сообщение
     try:
-        msg = await bot.send_message(
-            chat_id=user_id,
-            text=text,
-            reply_markup=keyboard,
-            parse_mode="HTML"
+        msg = await outbound.submit(
+            user_id,
+            lambda: bot.send_message(
+                chat_id=user_id,
+                text=text,
+                reply_markup=keyboard,
+                parse_mode="HTML"
+            ),
+            priority
         )
-        user_current_message_id[user_id] = msg.message_id
+        ui_state.set_message_id(user_id, msg.message_id)
+        rendered_screens.remember(user_id, msg.message_id, rendered_screens.fingerprint(text, keyboard))
         return True
     except Exception as e:
         logger.error(f"Не удалось отправить сообщение: {e}")
@@ -175,17 +244,18 @@ async def edit_or_send_message(user_id: int, text: str, keyboard: InlineKeyboard
 async def send_toast_notification(callback: CallbackQuery, text: str, duration: int = 2):
     """Отправить всплывающее уведомление (toast) - ТОЛЬКО ДЛЯ КОМАНД"""
     try:
+        chat_id = callback.message.chat.id
         # Отправляем временное сообщение
-        temp_msg = await callback.message.answer(f"ℹ️ {text}")
-        # Удаляем через указанное время
-        await asyncio.sleep(duration)
-        await bot.delete_message(callback.message.chat.id, temp_msg.message_id)
+        temp_msg = await outbound.submit(chat_id, lambda: bot.send_message(chat_id=chat_id, text=f"ℹ️ {text}"))
+        # Удаляем через указанное время: обработчик не ждёт
+        deferred.delete_message_later(chat_id, temp_msg.message_id, duration)
     except Exception as e:
         logger.error(f"Error sending toast: {e}")
 
-def get_script_status_text(user_id: int) -> tuple:
+def get_script_status_text(user_id: int, status: Optional[Dict] = None) -> tuple:
     """Получить текст статуса скрипта"""
-    status = db.get_script_status(user_id)
+    if status is None:
+        status = services.get_script_status(user_id)
     
     if status['is_paused']:
         return (
@@ -206,72 +276,91 @@ def get_script_status_text(user_id: int) -> tuple:
             texts.get_text("SCRIPT_SECTION.offline.description")
         )
 
-async def get_script_status_from_api(user_id: int, force_refresh: bool = False) -> dict:
-    """Получает актуальный статус скрипта из API"""
-    if not force_refresh and user_id in last_status_update:
-        time_diff = (datetime.now() - last_status_update[user_id]).total_seconds()
-        if time_diff < 1 and user_id in script_status_cache:
-            return script_status_cache[user_id]
+def render_script_panel(status: Dict, background: bool = False) -> tuple:
+    """
+    Текст и клавиатура панели скрипта
     
-    try:
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{config.API_HOST}:{config.API_PORT}/api/check_commands/{user_id}"
-            headers = {"api-key": config.API_SECRET_KEY}
-            
-            async with session.get(url, headers=headers, timeout=2) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    script_status_cache[user_id] = {
-                        'is_running': data.get('is_running', False),
-                        'is_paused': data.get('is_paused', False),
-                        'pause_until': data.get('pause_until'),
-                        'last_update': datetime.now(),
-                        'has_commands': data.get('has_commands', False)
-                    }
-                    
-                    last_status_update[user_id] = datetime.now()
-                    return script_status_cache[user_id]
-    except Exception as e:
-        logger.debug(f"API недоступно, используем кэш: {e}")
+    Зависят только от состояния скрипта (запущен, на паузе) и от того, открывает ли
+    панель пользователь или её обновляет мониторинг (background): вариантов немного,
+    и каждый отрисовывается один раз на весь бот
+    """
+    running, paused = bool(status['is_running']), bool(status['is_paused'])
+    return render_cache.get_or_render(('script_panel', None, None, (running, paused, background)),
+                                      lambda: _render_script_panel(status, background))
+
+def _render_script_panel(status: Dict, background: bool) -> tuple:
+    title, status_text, description = get_script_status_text(None, status)
+    text = f"{title}\n{status_text}\n\n{description}"
     
-    if user_id in script_status_cache:
-        return script_status_cache[user_id]
+    # Определяем кнопки в зависимости от статуса
+    keyboard_buttons = []
     
-    return {
-        'is_running': False,
-        'is_paused': False,
-        'pause_until': None,
-        'last_update': datetime.now()
-    }
+    if status['is_running']:
+        if status['is_paused']:
+            keyboard_buttons.append([
+                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.resume"), callback_data='script_resume'),
+                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
+            ])
+        else:
+            keyboard_buttons.append([
+                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.pause"), callback_data='script_pause'),
+                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
+            ])
+        keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.commands"), callback_data='menu_commands')])
+    else:
+        keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.coordinates"), callback_data='coordinates_main')])
+    
+    # Общие кнопки настроек
+    parameters_row = [InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.parameters"), callback_data='parameters_main')]
+    if background and status['is_running'] and not status['is_paused']:
+        # Обновление мониторингом при работающем скрипте - с пустой кнопкой рядом с Параметрами
+        parameters_row.append(InlineKeyboardButton(text=texts.get_text("MESSAGES.empty_button"), callback_data="empty"))
+    # При открытии панели пользователем кнопка Параметры на всю строку
+    keyboard_buttons.extend([
+        [
+            InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.delays"), callback_data='delays_main'),
+            InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.work_settings"), callback_data='work_settings')
+        ],
+        [
+            InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.modes"), callback_data='modes_main'),
+            InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.functions"), callback_data='functions_main')
+        ],
+        parameters_row
+    ])
+    
+    keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='menu_main')])
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
 async def send_photo_message(user_id: int, photo_path: str, caption: str, keyboard: InlineKeyboardMarkup = None):
     """Отправить сообщение с фото"""
     try:
         if os.path.exists(photo_path):
             photo = FSInputFile(photo_path)
-            msg = await bot.send_photo(
+            msg = await outbound.submit(user_id, lambda: bot.send_photo(
                 chat_id=user_id,
                 photo=photo,
                 caption=caption,
                 reply_markup=keyboard,
                 parse_mode="HTML"
-            )
+            ))
         else:
-            msg = await bot.send_message(
+            msg = await outbound.submit(user_id, lambda: bot.send_message(
                 chat_id=user_id,
                 text=caption,
                 reply_markup=keyboard,
                 parse_mode="HTML"
-            )
+            ))
         
-        if user_id in user_current_message_id:
+        old_message_id = ui_state.get_message_id(user_id)
+        if old_message_id is not None:
             try:
-                await bot.delete_message(user_id, user_current_message_id[user_id])
+                await outbound.submit(user_id, lambda: bot.delete_message(user_id, old_message_id), paced=False)
             except:
                 pass
         
-        user_current_message_id[user_id] = msg.message_id
+        ui_state.set_message_id(user_id, msg.message_id)
+        rendered_screens.forget(user_id)
         return True
     except Exception as e:
         logger.error(f"Error sending photo message: {e}")
@@ -283,19 +372,19 @@ def resolve_user_view_state(user: dict, user_key: dict | None) -> str:
         if user_key and user_key.get("is_frozen"):
             return "ADMIN_FROZEN"
         return "ADMIN_ACTIVE"
-
+    
     if not user_key or user_key.get("activated_by") != user["user_id"]:
         return "USER_NO_KEY"
-
+    
     if user_key.get("is_frozen"):
         return "USER_FROZEN"
-
+    
     return "USER_ACTIVE"
 
 async def update_user_menu_if_active(user_id: int, action_text: str = None):
     """Обновить меню пользователя если оно активно"""
     try:
-        if user_id in user_current_message_id:
+        if ui_state.get_message_id(user_id) is not None:
             user = db.get_user(user_id)
             key_info = db.get_user_key_info(user_id)
             
@@ -338,13 +427,13 @@ async def start_command(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username
     
-    db.get_or_create_user(user_id, username)
+    await asyncio.to_thread(db.get_or_create_user, user_id, username)
     
     if user_id in config.ADMIN_IDS:
         key_info = db.get_user_key_info(user_id)
         if not key_info:
-            key = db.create_key(user_id)
-            db.activate_key(key['key_value'], user_id)
+            key = await asyncio.to_thread(db.create_key, user_id)
+            await asyncio.to_thread(db.activate_key, key['key_value'], user_id)
             logger.info(f"Auto-created key for admin {user_id}: {key['key_value']}")
     
     await show_main_menu(user_id, state)
@@ -473,12 +562,12 @@ async def activate_key_process(message: Message, state: FSMContext):
         return
     
     # Активация ключа
-    if db.activate_key(key_value, user_id):
+    if await asyncio.to_thread(db.activate_key, key_value, user_id):
         text = texts.get_text("KEYS.activate.success.text")
         await edit_or_send_message(user_id, text)
         
-        await asyncio.sleep(1)
-        await show_main_menu(user_id, state)
+        # Сообщение об успехе видно секунду, затем главное меню; обработчик не ждёт
+        deferred.call_later(1, functools.partial(show_main_menu, user_id, state))
     else:
         text = texts.get_text("KEYS.activate.error.activation_error")
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -511,61 +600,9 @@ async def show_script_main_panel(callback: CallbackQuery, state: FSMContext):
     """Показывает основную панель скрипта с исправленной кнопкой Параметры"""
     user_id = callback.from_user.id
     
-    active_users_in_script_control[user_id] = datetime.now()
-    
-    status_data = await get_script_status_from_api(user_id, force_refresh=True)
-    
-    title, status_text, description = get_script_status_text(user_id)
-    text = f"{title}\n{status_text}\n\n{description}"
-    
-    # Определяем кнопки в зависимости от статуса
-    keyboard_buttons = []
-    
-    if status_data['is_running']:
-        if status_data['is_paused']:
-            keyboard_buttons.append([
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.resume"), callback_data='script_resume'),
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
-            ])
-        else:
-            keyboard_buttons.append([
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.pause"), callback_data='script_pause'),
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
-            ])
-        keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.commands"), callback_data='menu_commands')])
-    else:
-        keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.coordinates"), callback_data='coordinates_main')])
-    
-    # Общие кнопки настроек
-    if not status_data['is_running'] or status_data['is_paused']:
-        keyboard_buttons.extend([
-            [
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.delays"), callback_data='delays_main'),
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.work_settings"), callback_data='work_settings')
-            ],
-            [
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.modes"), callback_data='modes_main'),
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.functions"), callback_data='functions_main')
-            ],
-            [InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.parameters"), callback_data='parameters_main')]
-        ])
-    else:
-        # При включенном скрипте кнопка Параметры на всю строку
-        keyboard_buttons.extend([
-            [
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.delays"), callback_data='delays_main'),
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.work_settings"), callback_data='work_settings')
-            ],
-            [
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.modes"), callback_data='modes_main'),
-                InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.functions"), callback_data='functions_main')
-            ],
-            [InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.parameters"), callback_data='parameters_main')]
-        ])
-    
-    keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='menu_main')])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    status_data = services.get_script_status(user_id)
+    ui_state.open_panel(user_id, (bool(status_data['is_running']), bool(status_data['is_paused'])))
+    text, keyboard = render_script_panel(status_data)
     
     await edit_or_send_message(user_id, text, keyboard)
     await state.set_state(UserStates.script_main)
@@ -576,16 +613,8 @@ async def script_pause_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{config.API_HOST}:{config.API_PORT}/api/pause"
-            headers = {"api-key": config.API_SECRET_KEY}
-            data = {"user_id": user_id, "seconds": 86400}
-            
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    await show_script_main_panel(callback, state)
-                else:
-                    pass
+        await asyncio.to_thread(services.pause_script, user_id, 86400)
+        await show_script_main_panel(callback, state)
     except Exception as e:
         logger.error(f"Ошибка установки паузы: {e}")
 
@@ -595,16 +624,8 @@ async def script_resume_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{config.API_HOST}:{config.API_PORT}/api/pause"
-            headers = {"api-key": config.API_SECRET_KEY}
-            data = {"user_id": user_id, "seconds": 0}
-            
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    await show_script_main_panel(callback, state)
-                else:
-                    pass
+        await asyncio.to_thread(services.pause_script, user_id, 0)
+        await show_script_main_panel(callback, state)
     except Exception as e:
         logger.error(f"Ошибка снятия паузы: {e}")
 
@@ -614,16 +635,8 @@ async def script_stop_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{config.API_HOST}:{config.API_PORT}/api/command"
-            headers = {"api-key": config.API_SECRET_KEY}
-            data = {"user_id": user_id, "command": "stop"}
-            
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    await show_script_main_panel(callback, state)
-                else:
-                    pass
+        await asyncio.to_thread(services.stop_script, user_id)
+        await show_script_main_panel(callback, state)
     except Exception as e:
         logger.error(f"Ошибка остановки скрипта: {e}")
 
@@ -637,7 +650,7 @@ async def coordinates_main_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     # Проверяем статус скрипта
-    status_data = await get_script_status_from_api(user_id)
+    status_data = services.get_script_status(user_id)
     if status_data.get('is_running') and not status_data.get('is_paused'):
         text = texts.get_text("COORDINATES.error.only_offline")
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -673,15 +686,8 @@ async def coordinates_main_handler(callback: CallbackQuery, state: FSMContext):
     await edit_or_send_message(user_id, text, keyboard)
     await state.set_state(UserStates.coordinates_main)
 
-@router.callback_query(F.data.startswith("coord_group_"))
-async def coordinates_group_handler(callback: CallbackQuery, state: FSMContext):
-    """Показать группу координат"""
-    user_id = callback.from_user.id
-    group_key = callback.data.replace('coord_group_', '')
-    
-    if group_key not in config.COORDINATE_GROUPS:
-        return
-    
+def render_coordinates_group(user_id: int, group_key: str) -> tuple:
+    """Экран группы координат пользователя"""
     group = config.COORDINATE_GROUPS[group_key]
     coords = db.get_user_coordinates(user_id)
     
@@ -727,7 +733,19 @@ async def coordinates_group_handler(callback: CallbackQuery, state: FSMContext):
     
     keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='coordinates_main')])
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@router.callback_query(F.data.startswith("coord_group_"))
+async def coordinates_group_handler(callback: CallbackQuery, state: FSMContext):
+    """Показать группу координат"""
+    user_id = callback.from_user.id
+    group_key = callback.data.replace('coord_group_', '')
+    
+    if group_key not in config.COORDINATE_GROUPS:
+        return
+    
+    text, keyboard = cached_screen(f'coord_group_{group_key}', user_id,
+                                   lambda: render_coordinates_group(user_id, group_key))
     
     await edit_or_send_message(user_id, text, keyboard)
     await state.update_data(current_coord_group=group_key)
@@ -857,7 +875,7 @@ async def coordinate_input_process(message: Message, state: FSMContext):
         return
     
     # Сохранение координаты
-    db.save_user_coordinate(user_id, coord_name, x, y)
+    await asyncio.to_thread(db.save_user_coordinate, user_id, coord_name, x, y)
     
     # Возвращаемся к редактированию координаты
     await coordinate_edit_handler(FakeCallback(user_id, f'coord_edit_{coord_name}'), state)
@@ -868,7 +886,7 @@ async def coordinate_reset_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     coord_name = callback.data.replace('coord_reset_', '')
     
-    if db.delete_user_coordinate(user_id, coord_name):
+    if await asyncio.to_thread(db.delete_user_coordinate, user_id, coord_name):
         # Возвращаемся к редактированию координаты
         await coordinate_edit_handler(callback, state)
 
@@ -936,7 +954,7 @@ async def color_input_process(message: Message, state: FSMContext):
         # Сохраняем цвет в настройках
         settings = db.get_script_settings(user_id)
         settings[color_param] = color_value
-        db.save_script_settings(user_id, settings)
+        await asyncio.to_thread(db.save_script_settings, user_id, settings)
         
         # Возвращаемся к редактированию координаты
         await coordinate_edit_handler(FakeCallback(user_id, f'coord_edit_{coord_name}'), state)
@@ -952,10 +970,8 @@ async def color_input_process(message: Message, state: FSMContext):
 # ЗАДЕРЖКИ (ОБНОВЛЕННЫЙ РАЗДЕЛ)
 # ====================
 
-@router.callback_query(F.data == "delays_main")
-async def delays_main_handler(callback: CallbackQuery, state: FSMContext):
-    """Главное меню задержек - только основные задержки"""
-    user_id = callback.from_user.id
+def render_delays_main(user_id: int) -> tuple:
+    """Экран задержек пользователя"""
     settings = db.get_script_settings(user_id)
     
     # Формируем красивое отображение только основных задержек
@@ -1014,7 +1030,13 @@ async def delays_main_handler(callback: CallbackQuery, state: FSMContext):
     
     keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='script_main')])
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@router.callback_query(F.data == "delays_main")
+async def delays_main_handler(callback: CallbackQuery, state: FSMContext):
+    """Главное меню задержек - только основные задержки"""
+    user_id = callback.from_user.id
+    text, keyboard = cached_screen('delays_main', user_id, lambda: render_delays_main(user_id))
     
     await edit_or_send_message(user_id, text, keyboard)
     await state.set_state(UserStates.delays_main)
@@ -1094,7 +1116,7 @@ async def function_param_input_process(message: Message, state: FSMContext):
         
         # Сохраняем значение
         settings[param] = value
-        db.save_script_settings(user_id, settings)
+        await asyncio.to_thread(db.save_script_settings, user_id, settings)
         
         # Возвращаемся к меню настройки конкретной функции
         await function_view_handler(FakeCallback(user_id, f'function_view_{func_key}'), state)
@@ -1161,7 +1183,7 @@ async def universal_input_process(message: Message, state: FSMContext, input_typ
             
             settings = db.get_script_settings(user_id)
             settings[param_name] = value
-            db.save_script_settings(user_id, settings)
+            await asyncio.to_thread(db.save_script_settings, user_id, settings)
             
             # Возвращаемся в меню редактирования задержки
             await delays_main_handler(FakeCallback(user_id, 'delays_main'), state)
@@ -1180,7 +1202,7 @@ async def universal_input_process(message: Message, state: FSMContext, input_typ
             
             settings = db.get_script_settings(user_id)
             settings[param_name] = value
-            db.save_script_settings(user_id, settings)
+            await asyncio.to_thread(db.save_script_settings, user_id, settings)
             
             # Возвращаемся в меню редактирования параметра режима
             mode_key = data.get('editing_mode')
@@ -1200,7 +1222,7 @@ async def universal_input_process(message: Message, state: FSMContext, input_typ
             
             settings = db.get_script_settings(user_id)
             settings[param_name] = value
-            db.save_script_settings(user_id, settings)
+            await asyncio.to_thread(db.save_script_settings, user_id, settings)
             
             # Возвращаемся в меню редактирования параметра функции
             func_key = data.get('editing_func')
@@ -1214,7 +1236,7 @@ async def universal_input_process(message: Message, state: FSMContext, input_typ
             if value <= 0:
                 raise ValueError(texts.get_text("COMMANDS.error.positive"))
             
-            db.create_command(user_id, 'saleskin', {'salePrice': value})
+            await asyncio.to_thread(services.send_command, user_id, 'saleskin', {'salePrice': value})
             await commands_main_handler(FakeCallback(user_id, 'commands_main'), state)
         
         else:
@@ -1309,7 +1331,7 @@ async def work_platform_handler(callback: CallbackQuery, state: FSMContext):
         settings['keypaste'] = True
         settings['inpord'] = False
     
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     # Просто обновляем меню без уведомлений
     await work_settings_handler(callback, state)
@@ -1323,7 +1345,7 @@ async def work_change_platform_handler(callback: CallbackQuery, state: FSMContex
     settings['dcpaste'] = False
     settings['keypaste'] = False
     
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     # Просто обновляем меню без уведомлений
     await work_settings_handler(callback, state)
@@ -1360,7 +1382,7 @@ async def work_inpord_toggle_handler(callback: CallbackQuery, state: FSMContext)
     
     new_state = not settings.get('inpord', False)
     settings['inpord'] = new_state
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     await work_inpord_handler(callback, state)
 
@@ -1368,24 +1390,19 @@ async def work_inpord_toggle_handler(callback: CallbackQuery, state: FSMContext)
 # РЕЖИМЫ
 # ====================
 
-@router.callback_query(F.data == "modes_main")
-async def modes_main_handler(callback: CallbackQuery, state: FSMContext):
-    """Главное меню режимов"""
-    user_id = callback.from_user.id
-    settings = db.get_script_settings(user_id)
-    
-    # Определяем текущий активный режим
-    current_mode_key = None
-    mode_list = ['defM', 'pfullM', 'percentM', 'tenthM', 'integerM', 'halfM', 'randomM']
-    for mode in mode_list:
+MODE_LIST = ['defM', 'pfullM', 'percentM', 'tenthM', 'integerM', 'halfM', 'randomM']
+
+def current_mode(settings: dict) -> Optional[str]:
+    """Активный режим из настроек (None - ни один не включён)"""
+    for mode in MODE_LIST:
         if settings.get(mode, False):
-            current_mode_key = mode
-            break
-    
-    if not current_mode_key:
-        current_mode_key = 'defM'
-        settings['defM'] = True
-        db.save_script_settings(user_id, settings)
+            return mode
+    return None
+
+def render_modes_main(user_id: int) -> tuple:
+    """Экран текущего режима пользователя"""
+    settings = db.get_script_settings(user_id)
+    current_mode_key = current_mode(settings) or 'defM'
     
     mode_data = texts.get_text(f"MODES.modes.{current_mode_key}")
     emoji = mode_data['name'][0]
@@ -1416,7 +1433,19 @@ async def modes_main_handler(callback: CallbackQuery, state: FSMContext):
     )])
     keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='script_main')])
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@router.callback_query(F.data == "modes_main")
+async def modes_main_handler(callback: CallbackQuery, state: FSMContext):
+    """Главное меню режимов"""
+    user_id = callback.from_user.id
+    settings = db.get_script_settings(user_id)
+    
+    if not current_mode(settings):
+        settings['defM'] = True
+        await asyncio.to_thread(db.save_script_settings, user_id, settings)
+    
+    text, keyboard = cached_screen('modes_main', user_id, lambda: render_modes_main(user_id))
     
     await edit_or_send_message(user_id, text, keyboard)
     await state.set_state(UserStates.modes_main)
@@ -1493,7 +1522,7 @@ async def mode_activate_handler(callback: CallbackQuery, state: FSMContext):
     
     # Включаем выбранный режим
     settings[mode_key] = True
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     text = texts.get_text("MODES.activated", mode_name=texts.get_text(f"MODES.modes.{mode_key}.name"))
     await send_toast_notification(callback, text)
@@ -1534,10 +1563,8 @@ async def mode_param_handler(callback: CallbackQuery, state: FSMContext):
 # ФУНКЦИИ (ИСПРАВЛЕННАЯ ВЕРСИЯ - МГНОВЕННОЕ ОБНОВЛЕНИЕ)
 # ====================
 
-@router.callback_query(F.data == "functions_main")
-async def functions_main_handler(callback: CallbackQuery, state: FSMContext):
-    """Главное меню функций"""
-    user_id = callback.from_user.id
+def render_functions_main(user_id: int) -> tuple:
+    """Экран функций пользователя"""
     settings = db.get_script_settings(user_id)
     
     text = texts.get_text("FUNCTIONS.main_screen")
@@ -1590,7 +1617,13 @@ async def functions_main_handler(callback: CallbackQuery, state: FSMContext):
     
     keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='script_main')])
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@router.callback_query(F.data == "functions_main")
+async def functions_main_handler(callback: CallbackQuery, state: FSMContext):
+    """Главное меню функций"""
+    user_id = callback.from_user.id
+    text, keyboard = cached_screen('functions_main', user_id, lambda: render_functions_main(user_id))
     
     await edit_or_send_message(user_id, text, keyboard)
     await state.set_state(UserStates.functions_main)
@@ -1693,7 +1726,7 @@ async def function_toggle_handler(callback: CallbackQuery, state: FSMContext):
     # Меняем состояние
     new_state = not current_state
     settings[func_key] = new_state
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     # Немедленно обновляем текущее сообщение с новым статусом
     func_data = texts.get_text(f"FUNCTIONS.functions.{func_key}")
@@ -1763,16 +1796,10 @@ async def function_toggle_handler(callback: CallbackQuery, state: FSMContext):
     
     # Пытаемся отредактировать текущее сообщение
     try:
-        await bot.edit_message_text(
-            chat_id=user_id,
-            message_id=callback.message.message_id,
-            text=text,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
+        await edit_message(user_id, callback.message.message_id, text, keyboard)
         # Обновляем ID текущего сообщения
-        if user_id in user_current_message_id:
-            user_current_message_id[user_id] = callback.message.message_id
+        if ui_state.get_message_id(user_id) is not None:
+            ui_state.set_message_id(user_id, callback.message.message_id)
     except Exception as e:
         logger.debug(f"Не удалось редактировать сообщение, отправляем новое: {e}")
         # Если не удалось редактировать, отправляем новое сообщение
@@ -1861,7 +1888,7 @@ async def function_param_input_process(message: Message, state: FSMContext):
         
         # Сохраняем значение
         settings[param] = value
-        db.save_script_settings(user_id, settings)
+        await asyncio.to_thread(db.save_script_settings, user_id, settings)
         
         # Немедленно возвращаемся к меню функции с обновленными данными
         await function_view_handler(FakeCallback(user_id, f'function_view_{func_key}'), state)
@@ -1877,12 +1904,12 @@ async def function_param_input_process(message: Message, state: FSMContext):
         
         # Отправляем сообщение с ошибкой
         try:
-            await bot.send_message(
+            await outbound.submit(user_id, lambda: bot.send_message(
                 chat_id=user_id,
                 text=error_text,
                 reply_markup=keyboard,
                 parse_mode="HTML"
-            )
+            ))
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения об ошибке: {e}")
     except Exception as e:
@@ -1938,7 +1965,7 @@ async def param_scanM_toggle_handler(callback: CallbackQuery, state: FSMContext)
     
     new_state = not settings.get('scanM', False)
     settings['scanM'] = new_state
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     await param_scanM_handler(callback, state)
 
@@ -1969,7 +1996,7 @@ async def param_sendcatch_toggle_handler(callback: CallbackQuery, state: FSMCont
     
     new_state = not settings.get('sendcatch', False)
     settings['sendcatch'] = new_state
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     await param_sendcatch_handler(callback, state)
 
@@ -1984,27 +2011,14 @@ async def commands_main_handler(callback: CallbackQuery, state: FSMContext):
     
     text = texts.get_text("COMMANDS.main_screen")
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=texts.get_text("COMMANDS.restskin.name"), callback_data='cmd_restskin'),
-            InlineKeyboardButton(text=texts.get_text("COMMANDS.saleskin.name"), callback_data='cmd_saleskin')
-        ],
-        [
-            InlineKeyboardButton(text=texts.get_text("COMMANDS.compcheck.name"), callback_data='cmd_compcheck'),
-            InlineKeyboardButton(text=texts.get_text("COMMANDS.device_info.name"), callback_data='cmd_device_info')
-        ],
-        [InlineKeyboardButton(text=texts.get_text("COMMANDS.script_info.name"), callback_data='cmd_script_info')],
-        [InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='script_main')]
-    ])
-    
-    await edit_or_send_message(user_id, text, keyboard)
+    await edit_or_send_message(user_id, text, COMMANDS_MAIN_KEYBOARD)
     await state.set_state(UserStates.commands_main)
 
 @router.callback_query(F.data == "cmd_restskin")
 async def cmd_restskin_handler(callback: CallbackQuery, state: FSMContext):
     """Команда перезайти на скин"""
     user_id = callback.from_user.id
-    db.create_command(user_id, 'restskin')
+    await asyncio.to_thread(services.send_command, user_id, 'restskin')
     
     await send_toast_notification(callback, texts.get_text("COMMANDS.restskin.confirm"))
 
@@ -2030,7 +2044,7 @@ async def cmd_saleskin_handler(callback: CallbackQuery, state: FSMContext):
 async def cmd_compcheck_handler(callback: CallbackQuery, state: FSMContext):
     """Проверка КК"""
     user_id = callback.from_user.id
-    db.create_command(user_id, 'compcheck', {'compCheckVal': 1})
+    await asyncio.to_thread(services.send_command, user_id, 'compcheck', {'compCheckVal': 1})
     
     await send_toast_notification(callback, texts.get_text("COMMANDS.compcheck.confirm"))
 
@@ -2038,7 +2052,7 @@ async def cmd_compcheck_handler(callback: CallbackQuery, state: FSMContext):
 async def cmd_device_info_handler(callback: CallbackQuery, state: FSMContext):
     """Информация об устройстве"""
     user_id = callback.from_user.id
-    db.create_command(user_id, 'get_device_info')
+    await asyncio.to_thread(services.send_command, user_id, 'get_device_info')
     
     await send_toast_notification(callback, texts.get_text("COMMANDS.device_info.confirm"))
 
@@ -2046,7 +2060,7 @@ async def cmd_device_info_handler(callback: CallbackQuery, state: FSMContext):
 async def cmd_script_info_handler(callback: CallbackQuery, state: FSMContext):
     """Информация о скрипте"""
     user_id = callback.from_user.id
-    db.create_command(user_id, 'get_script_info')
+    await asyncio.to_thread(services.send_command, user_id, 'get_script_info')
     
     await send_toast_notification(callback, texts.get_text("COMMANDS.script_info.confirm"))
 
@@ -2067,7 +2081,7 @@ async def user_settings_handler(callback: CallbackQuery, state: FSMContext):
     # Информация о ключе
     if key_info:
         key_status = texts.get_text("USER_SETTINGS.key_status.frozen") if key_info['is_frozen'] else texts.get_text("USER_SETTINGS.key_status.active")
-        created_date = datetime.fromisoformat(key_info['created_at']).strftime("%d.%m.%Y %H:%M")
+        created_date = format_timestamp(key_info['created_at'])
         
         creator = db.get_user(key_info['created_by'])
         creator_name = creator['username'] if creator and creator['username'] else f"ID: {key_info['created_by']}"
@@ -2107,60 +2121,86 @@ async def admin_main_handler(callback: CallbackQuery, state: FSMContext):
     
     text = texts.get_text("ADMIN.main_screen")
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=texts.get_text("ADMIN.buttons.keys"), callback_data='admin_keys')],
-        [
-            InlineKeyboardButton(text=texts.get_text("ADMIN.buttons.stats"), callback_data='admin_statistics'),
-            InlineKeyboardButton(text=texts.get_text("ADMIN.buttons.loot"), callback_data='admin_loot')
-        ],
-        [InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='menu_main')]
-    ])
-    
-    await edit_or_send_message(user_id, text, keyboard)
+    await edit_or_send_message(user_id, text, ADMIN_MAIN_KEYBOARD)
     await state.set_state(UserStates.admin_main)
 
+def parse_keys_cursor(cursor_text: str) -> tuple:
+    """Разобрать курсор страницы ключей из callback_data: '<created_at>_<id>'"""
+    created_at, key_id = cursor_text.split('_', 1)
+    return int(created_at), int(key_id)
+
 @router.callback_query(F.data == "admin_keys")
+@router.callback_query(F.data.startswith("admin_keys_next_"))
+@router.callback_query(F.data.startswith("admin_keys_prev_"))
 async def admin_keys_handler(callback: CallbackQuery, state: FSMContext):
-    """Управление ключами"""
+    """Управление ключами (постраничный просмотр)"""
     user_id = callback.from_user.id
     
     if user_id not in config.ADMIN_IDS:
         return
     
-    all_keys = db.get_all_keys()
-    filtered_keys = []
+    # Возврат из карточки ключа или после удаления - на ту же страницу
+    if callback.data == "admin_keys" or callback.data.startswith(("admin_keys_next_", "admin_keys_prev_")):
+        page_data = callback.data
+    else:
+        page_data = (await state.get_data()).get('admin_keys_page', 'admin_keys')
+    
+    after = before = None
+    try:
+        if page_data.startswith("admin_keys_next_"):
+            after = parse_keys_cursor(page_data.replace('admin_keys_next_', '', 1))
+        elif page_data.startswith("admin_keys_prev_"):
+            before = parse_keys_cursor(page_data.replace('admin_keys_prev_', '', 1))
+    except ValueError:
+        page_data = 'admin_keys'
     
-    for key in all_keys:
-        if key['activated_by'] and key['activated_by'] in config.ADMIN_IDS:
-            continue
-        filtered_keys.append(key)
+    page = db.get_keys_page(exclude_owners=config.ADMIN_IDS, after=after, before=before)
+    keys = page['keys']
     
-    text = texts.get_text("KEYS.management.description", total=len(filtered_keys))
+    text = texts.get_text("KEYS.management.description", total=db.count_keys(exclude_owners=config.ADMIN_IDS))
     
     # Создаем клавиатуру с ключами
     keyboard_buttons = []
     row = []
     
-    for i, key in enumerate(filtered_keys[:15]):  # Показываем первые 15 ключей
+    for i, key in enumerate(keys):
         if key['activated_by']:
-            user = db.get_user(key['activated_by'])
-            username = user.get('username', '') if user else ''
+            username = key['owner_username']
             button_text = f"✅ @{username}" if username else f"✅ ID:{key['activated_by']}"
         else:
             button_text = "❌"
         
         row.append(InlineKeyboardButton(text=button_text, callback_data=f"key_view_{key['id']}"))
         
-        if len(row) == 3 or i == len(filtered_keys[:15]) - 1:
+        if len(row) == 3 or i == len(keys) - 1:
             keyboard_buttons.append(row)
             row = []
     
+    # Навигация по страницам
+    nav_row = []
+    if page['has_prev'] and keys:
+        first = keys[0]
+        nav_row.append(InlineKeyboardButton(
+            text=texts.get_text("KEYS.management.actions.prev_page"),
+            callback_data=f"admin_keys_prev_{first['created_at']}_{first['id']}"
+        ))
+    if page['has_next'] and keys:
+        last = keys[-1]
+        nav_row.append(InlineKeyboardButton(
+            text=texts.get_text("KEYS.management.actions.next_page"),
+            callback_data=f"admin_keys_next_{last['created_at']}_{last['id']}"
+        ))
+    if nav_row:
+        keyboard_buttons.append(nav_row)
+    
     keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("KEYS.management.actions.create"), callback_data='admin_create_key')])
+    keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("KEYS.management.actions.bulk"), callback_data='admin_keys_bulk')])
     keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='admin_main')])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     
     await edit_or_send_message(user_id, text, keyboard)
+    await state.update_data(admin_keys_page=page_data)
     await state.set_state(UserStates.admin_keys)
 
 @router.callback_query(F.data.startswith("key_view_"))
@@ -2186,7 +2226,7 @@ async def admin_key_detail_handler(callback: CallbackQuery, state: FSMContext):
         status = texts.get_text("KEYS.management.status.active")
         owner = db.get_user(key['activated_by'])
         owner_text = f"@{owner['username']}" if owner and owner['username'] else f"ID: {key['activated_by']}"
-        activated_date = datetime.fromisoformat(key['activated_at']).strftime("%d.%m.%Y %H:%M")
+        activated_date = format_timestamp(key['activated_at'])
         owner_section = texts.get_text("KEYS.management.owner_section",
                                       owner_text=owner_text,
                                       activated_date=activated_date)
@@ -2197,7 +2237,7 @@ async def admin_key_detail_handler(callback: CallbackQuery, state: FSMContext):
     
     creator = db.get_user(key['created_by'])
     creator_text = f"@{creator['username']}" if creator and creator['username'] else f"ID: {key['created_by']}"
-    created_date = datetime.fromisoformat(key['created_at']).strftime("%d.%m.%Y %H:%M")
+    created_date = format_timestamp(key['created_at'])
     
     frozen_text = texts.get_text("KEYS.management.frozen.yes") if key['is_frozen'] else texts.get_text("KEYS.management.frozen.no")
     
@@ -2266,10 +2306,10 @@ async def admin_key_detail_handler(callback: CallbackQuery, state: FSMContext):
                 )
             ])
     
-    # Третья строка: одна кнопка Назад
+    # Третья строка: одна кнопка Назад (на ту страницу списка, с которой пришли)
     keyboard_buttons.append([InlineKeyboardButton(
         text=texts.get_text("BUTTONS.back"), 
-        callback_data='admin_keys'
+        callback_data=(await state.get_data()).get('admin_keys_page', 'admin_keys')
     )])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
@@ -2287,7 +2327,7 @@ async def key_freeze_handler(callback: CallbackQuery, state: FSMContext):
     if not key:
         return
     
-    if db.freeze_key(key_id):
+    if await asyncio.to_thread(db.freeze_key, key_id):
         # Мгновенно обновляем меню ключа
         await admin_key_detail_handler(callback, state)
 
@@ -2301,7 +2341,7 @@ async def key_unfreeze_handler(callback: CallbackQuery, state: FSMContext):
     if not key:
         return
     
-    if db.unfreeze_key(key_id):
+    if await asyncio.to_thread(db.unfreeze_key, key_id):
         # Мгновенно обновляем меню ключа
         await admin_key_detail_handler(callback, state)
 
@@ -2315,7 +2355,7 @@ async def key_unbind_handler(callback: CallbackQuery, state: FSMContext):
     if not key:
         return
     
-    if db.unbind_key(key_id):
+    if await asyncio.to_thread(db.unbind_key, key_id):
         # Мгновенно обновляем меню ключа
         await admin_key_detail_handler(callback, state)
 
@@ -2329,7 +2369,7 @@ async def key_delete_handler(callback: CallbackQuery, state: FSMContext):
     if not key:
         return
     
-    if db.delete_key(key_id):
+    if await asyncio.to_thread(db.delete_key, key_id):
         # Обновляем список ключей
         await admin_keys_handler(callback, state)
 
@@ -2338,7 +2378,7 @@ async def admin_create_key_handler(callback: CallbackQuery, state: FSMContext):
     """Создать новый ключ"""
     user_id = callback.from_user.id
     
-    key = db.create_key(user_id)
+    key = await asyncio.to_thread(db.create_key, user_id)
     text = texts.get_text("KEYS.management.created", key_value=key['key_value'])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -2347,6 +2387,158 @@ async def admin_create_key_handler(callback: CallbackQuery, state: FSMContext):
     
     await edit_or_send_message(user_id, text, keyboard)
 
+# Массовые операции: действие -> метод БД
+BULK_KEY_ACTIONS = {
+    'freeze': db.freeze_keys,
+    'unfreeze': db.unfreeze_keys,
+    'unbind': db.unbind_keys,
+    'delete': db.delete_keys,
+}
+
+def bulk_back_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура с возвратом в меню массовых операций"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='admin_keys_bulk')]
+    ])
+
+@router.callback_query(F.data == "admin_keys_bulk")
+async def admin_keys_bulk_handler(callback: CallbackQuery, state: FSMContext):
+    """Меню массовых операций с ключами"""
+    user_id = callback.from_user.id
+    
+    if user_id not in config.ADMIN_IDS:
+        return
+    
+    keyboard_buttons = [
+        [InlineKeyboardButton(text=texts.get_text("KEYS.management.bulk.actions.generate"), callback_data='admin_bulk_generate')]
+    ]
+    for action in BULK_KEY_ACTIONS:
+        keyboard_buttons.append([InlineKeyboardButton(
+            text=texts.get_text(f"KEYS.management.bulk.actions.{action}"),
+            callback_data=f'admin_bulk_{action}'
+        )])
+    keyboard_buttons.append([InlineKeyboardButton(
+        text=texts.get_text("BUTTONS.back"),
+        callback_data=(await state.get_data()).get('admin_keys_page', 'admin_keys')
+    )])
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    
+    await edit_or_send_message(user_id, texts.get_text("KEYS.management.bulk.menu"), keyboard)
+    await state.set_state(UserStates.admin_keys)
+
+@router.callback_query(F.data == "admin_bulk_generate")
+async def admin_bulk_generate_handler(callback: CallbackQuery, state: FSMContext):
+    """Запрос количества ключей для генерации"""
+    user_id = callback.from_user.id
+    
+    if user_id not in config.ADMIN_IDS:
+        return
+    
+    text = texts.get_text("KEYS.management.bulk.count_prompt", max_count=config.KEYS_BULK_MAX)
+    
+    await edit_or_send_message(user_id, text, bulk_back_keyboard())
+    await state.set_state(UserStates.admin_bulk_count)
+
+@router.message(UserStates.admin_bulk_count)
+async def admin_bulk_count_process(message: Message, state: FSMContext):
+    """Генерация ключей и отправка их файлом"""
+    user_id = message.from_user.id
+    
+    try:
+        await message.delete()
+    except:
+        pass
+    
+    if user_id not in config.ADMIN_IDS:
+        return
+    
+    try:
+        count = int(message.text.strip())
+        if not 1 <= count <= config.KEYS_BULK_MAX:
+            raise ValueError
+    except (ValueError, AttributeError):
+        text = texts.get_text("KEYS.management.bulk.invalid_count", max_count=config.KEYS_BULK_MAX)
+        await edit_or_send_message(user_id, text, bulk_back_keyboard())
+        return
+    
+    # До KEYS_BULK_MAX строк одной записью - не в event loop
+    keys = await asyncio.to_thread(db.create_keys, user_id, count)
+    
+    text = texts.get_text("KEYS.management.bulk.generated", count=len(keys))
+    await edit_or_send_message(user_id, text, bulk_back_keyboard())
+    
+    content = '\n'.join(key['key_value'] for key in keys).encode()
+    filename = f"keys_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    await outbound.submit(
+        user_id,
+        functools.partial(
+            bot.send_document,
+            user_id,
+            BufferedInputFile(content, filename=filename),
+            caption=texts.get_text("KEYS.management.bulk.file_caption", count=len(keys))
+        ),
+        Priority.INTERACTIVE
+    )
+    await state.set_state(UserStates.admin_keys)
+
+@router.callback_query(F.data.in_({f"admin_bulk_{action}" for action in BULK_KEY_ACTIONS}))
+async def admin_bulk_action_handler(callback: CallbackQuery, state: FSMContext):
+    """Запрос списка ключей для массовой операции"""
+    user_id = callback.from_user.id
+    
+    if user_id not in config.ADMIN_IDS:
+        return
+    
+    action = callback.data.replace('admin_bulk_', '', 1)
+    text = texts.get_text(
+        "KEYS.management.bulk.keys_prompt",
+        action=texts.get_text(f"KEYS.management.bulk.actions.{action}"),
+        max_count=config.KEYS_BULK_MAX
+    )
+    
+    await edit_or_send_message(user_id, text, bulk_back_keyboard())
+    await state.update_data(bulk_action=action)
+    await state.set_state(UserStates.admin_bulk_keys)
+
+@router.message(UserStates.admin_bulk_keys)
+async def admin_bulk_keys_process(message: Message, state: FSMContext):
+    """Применение массовой операции к списку ключей"""
+    user_id = message.from_user.id
+    
+    try:
+        await message.delete()
+    except:
+        pass
+    
+    if user_id not in config.ADMIN_IDS:
+        return
+    
+    action = (await state.get_data()).get('bulk_action')
+    if action not in BULK_KEY_ACTIONS:
+        await admin_keys_bulk_handler(FakeCallback(user_id, 'admin_keys_bulk'), state)
+        return
+    
+    # Ключи по одному на строке; допускаем также пробелы и запятые между ними
+    values = list(dict.fromkeys(re.findall(r'[^\s,]+', (message.text or '').upper())))
+    if len(values) > config.KEYS_BULK_MAX:
+        text = texts.get_text("KEYS.management.bulk.too_many", count=len(values), max_count=config.KEYS_BULK_MAX)
+        await edit_or_send_message(user_id, text, bulk_back_keyboard())
+        return
+    
+    keys = db.get_keys_by_values(values)
+    affected = await asyncio.to_thread(BULK_KEY_ACTIONS[action], [key['id'] for key in keys])
+    
+    text = texts.get_text("KEYS.management.bulk.done", affected=affected, found=len(keys))
+    found_values = {key['key_value'] for key in keys}
+    missing = [value for value in values if value not in found_values]
+    if missing:
+        shown = html.escape('\n'.join(missing[:20])) + ('\n...' if len(missing) > 20 else '')
+        text += texts.get_text("KEYS.management.bulk.not_found", count=len(missing), values=shown)
+    
+    await edit_or_send_message(user_id, text, bulk_back_keyboard())
+    await state.set_state(UserStates.admin_keys)
+
 @router.callback_query(F.data == "admin_statistics")
 async def admin_statistics_handler(callback: CallbackQuery, state: FSMContext):
     """Статистика системы"""
@@ -2365,6 +2557,11 @@ async def admin_statistics_handler(callback: CallbackQuery, state: FSMContext):
                          running=stats['scripts']['running'],
                          paused=stats['scripts']['paused'],
                          offline=stats['scripts']['offline'])
+    text += texts.get_text("STATISTICS.outbound",
+                           sent=outbound.stats['sent'],
+                           retried=outbound.stats['retried'],
+                           coalesced=outbound.stats['coalesced'],
+                           suppressed=rendered_screens.suppressed)
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='admin_main')]
@@ -2405,7 +2602,7 @@ async def admin_loot_toggle_receive_handler(callback: CallbackQuery, state: FSMC
     
     new_state = not settings.get('admin_receive_loot', False)
     settings['admin_receive_loot'] = new_state
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     await admin_loot_handler(callback, state)
 
@@ -2417,7 +2614,7 @@ async def admin_loot_toggle_source_handler(callback: CallbackQuery, state: FSMCo
     
     new_state = not settings.get('admin_receive_all', True)
     settings['admin_receive_all'] = new_state
-    db.save_script_settings(user_id, settings)
+    await asyncio.to_thread(db.save_script_settings, user_id, settings)
     
     await admin_loot_handler(callback, state)
 
@@ -2465,8 +2662,7 @@ async def back_to_main_handler(callback: CallbackQuery, state: FSMContext):
     """Возврат в главное меню"""
     user_id = callback.from_user.id
     
-    if user_id in active_users_in_script_control:
-        del active_users_in_script_control[user_id]
+    ui_state.close_panel(user_id)
     
     await show_main_menu(user_id, state)
 
@@ -2494,38 +2690,38 @@ class FakeCallback:
 # ====================
 
 async def monitor_script_changes():
-    """Мониторинг изменений статуса скриптов"""
+    """
+    Мониторинг изменений статуса скриптов
+    
+    Одна лента изменений на всех пользователей (services.get_status_changes) вместо запроса
+    на каждого: за такт читаются только изменившиеся статусы, пачками по BATCH_SIZE.
+    Панель перерисовывается, только если статус отличается от отрисованного.
+    """
     logger.info(texts.get_text("LOGS.monitor_start"))
     
-    last_known_status = {}
+    cursor = None
     
     while True:
         try:
-            active_user_ids = list(active_users_in_script_control.keys())
+            # Закрываем панели без действий дольше UI_PANEL_IDLE_SECONDS, чистим давние записи
+            ui_state.expire()
             
-            for user_id in active_user_ids:
-                try:
-                    current_status = await get_script_status_from_api(user_id, force_refresh=False)
-                    old_status = last_known_status.get(user_id)
-                    
-                    if old_status is None or (
-                        old_status.get('is_running') != current_status.get('is_running') or
-                        old_status.get('is_paused') != current_status.get('is_paused')
-                    ):
-                        if user_id in active_users_in_script_control:
-                            await update_script_panel_for_user(user_id)
-                    
-                    last_known_status[user_id] = current_status
-                    
-                    # Удаляем неактивных пользователей (больше 5 минут)
-                    last_active = active_users_in_script_control.get(user_id)
-                    if last_active and (datetime.now() - last_active).total_seconds() > 300:
-                        del active_users_in_script_control[user_id]
-                        if user_id in last_known_status:
-                            del last_known_status[user_id]
-                            
-                except Exception as e:
-                    logger.debug(f"Ошибка обновления статуса для user_id={user_id}: {e}")
+            if not ui_state.has_open_panels():
+                # Смотреть некому: при появлении панели лента начнётся с текущего момента,
+                # панель и так отрисована по свежему статусу
+                cursor = None
+                await asyncio.sleep(3)
+                continue
+            
+            while True:
+                # Чтение SQLite - в потоке, event loop не ждёт
+                changes, cursor = await asyncio.to_thread(services.get_status_changes, cursor, config.BATCH_SIZE)
+                for change in changes:
+                    drawn = ui_state.panel_status(change['user_id'])
+                    if drawn is not None and drawn != (bool(change['is_running']), bool(change['is_paused'])):
+                        await update_script_panel_for_user(change['user_id'], change)
+                if len(changes) < config.BATCH_SIZE:
+                    break
             
             await asyncio.sleep(3)
             
@@ -2584,72 +2780,75 @@ async def cleanup_old_logs():
         # Проверяем раз в день
         await asyncio.sleep(24 * 60 * 60)
 
-async def update_script_panel_for_user(user_id: int):
+async def cleanup_old_commands_task():
+    """Периодическая очистка выполненных и просроченных команд и давних состояний диалогов"""
+    while True:
+        try:
+            # В отдельном потоке: очистка идёт пачками с паузами и не должна тормозить бота
+            deleted = await asyncio.to_thread(db.cleanup_old_commands)
+            if deleted:
+                logger.info(f"Очищено команд: {deleted}")
+            
+            deleted = await asyncio.to_thread(db.cleanup_fsm_records)
+            if deleted:
+                logger.info(f"Удалено давних состояний диалогов: {deleted}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки команд: {e}")
+        
+        await asyncio.sleep(config.COMMANDS_CLEANUP_INTERVAL_SECONDS)
+
+async def expire_script_statuses_task():
+    """Периодически снимать истёкшие паузы и помечать остановленными скрипты без heartbeat"""
+    while True:
+        await asyncio.sleep(config.HEARTBEAT_INTERVAL_SECONDS)
+        try:
+            expired = await asyncio.to_thread(db.expire_script_statuses)
+            if expired['stale']:
+                logger.info(f"Скриптов без heartbeat помечено остановленными: {expired['stale']}")
+        except Exception as e:
+            logger.error(f"Ошибка проверки статусов скриптов: {e}")
+
+async def reconcile_statistics_task():
+    """Периодическая сверка счётчиков статистики с реальными данными"""
+    while True:
+        await asyncio.sleep(config.STATS_RECONCILE_INTERVAL_SECONDS)
+        try:
+            # В отдельном потоке: полный пересчёт по таблицам не должен останавливать event loop
+            drift = await asyncio.to_thread(db.reconcile_statistics)
+            if drift:
+                logger.warning(f"Счётчики статистики расходились с данными и исправлены: {drift}")
+        except Exception as e:
+            logger.error(f"Ошибка сверки статистики: {e}")
+
+async def deliver_notifications():
+    """Отправка пользователям уведомлений, поставленных API (в общем процессе launcher.py)"""
+    def sent(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Ошибка отправки уведомления: {future.exception()}")
+    
+    queue = services.register_notification_consumer()
+    while True:
+        notification = await queue.get()
+        # Не ждём отправки: уведомления разных чатов идут параллельно в пределах лимитов
+        outbound.submit(
+            notification['user_id'],
+            functools.partial(bot.send_message, chat_id=notification['user_id'], text=notification['message']),
+            Priority.NOTIFICATION
+        ).add_done_callback(sent)
+
+async def update_script_panel_for_user(user_id: int, status_data: Optional[Dict] = None):
     """Обновление панели скрипта для пользователя"""
     try:
-        status_data = await get_script_status_from_api(user_id, force_refresh=True)
-        
-        title, status_text, description = get_script_status_text(user_id)
-        text = f"{title}\n{status_text}\n\n{description}"
-        
-        # Определяем кнопки в зависимости от статуса
-        keyboard_buttons = []
-        
-        if status_data['is_running']:
-            if status_data['is_paused']:
-                keyboard_buttons.append([
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.resume"), callback_data='script_resume'),
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
-                ])
-            else:
-                keyboard_buttons.append([
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.pause"), callback_data='script_pause'),
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
-                ])
-            keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.commands"), callback_data='menu_commands')])
-        else:
-            keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.coordinates"), callback_data='coordinates_main')])
-        
-        # Общие кнопки настроек
-        if not status_data['is_running'] or status_data['is_paused']:
-            keyboard_buttons.extend([
-                [
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.delays"), callback_data='delays_main'),
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.work_settings"), callback_data='work_settings')
-                ],
-                [
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.modes"), callback_data='modes_main'),
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.functions"), callback_data='functions_main')
-                ],
-                [InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.parameters"), callback_data='parameters_main')]
-            ])
-        else:
-            keyboard_buttons.extend([
-                [
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.delays"), callback_data='delays_main'),
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.work_settings"), callback_data='work_settings')
-                ],
-                [
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.modes"), callback_data='modes_main'),
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.functions"), callback_data='functions_main')
-                ],
-                [
-                    InlineKeyboardButton(text=texts.get_text("SCRIPT_SECTION.buttons.parameters"), callback_data='parameters_main'),
-                    InlineKeyboardButton(text=texts.get_text("MESSAGES.empty_button"), callback_data="empty")
-                ]
-            ])
-        
-        keyboard_buttons.append([InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='menu_main')])
+        if status_data is None:
+            status_data = services.get_script_status(user_id)
+        ui_state.set_panel_status(user_id, (bool(status_data['is_running']), bool(status_data['is_paused'])))
+        text, keyboard = render_script_panel(status_data, background=True)
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-        
-        await bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_current_message_id.get(user_id),
-            text=text,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
+        message_id = ui_state.get_message_id(user_id)
+        if message_id is None:
+            return
+        # Фоновое обновление: не ждём отправки, несколько обновлений одной панели в очереди схлопываются
+        await edit_message(user_id, message_id, text, keyboard, Priority.BACKGROUND, wait=False)
     except Exception as e:
         logger.debug(f"Не удалось обновить статус для user_id={user_id}: {e}")
 
@@ -2661,12 +2860,35 @@ async def main():
     """Основная функция запуска бота"""
     logger.info(texts.get_text("LOGS.bot_start"))
     
+    # Очередь отправки - до фоновых задач, они пишут в неё сразу
+    outbound.start()
+    deferred.start()
+    
+    # Фоновое сохранение состояний диалогов (последнее - при остановке диспетчера)
+    storage.start()
+    
     # Запускаем мониторинг в фоне
     asyncio.create_task(monitor_script_changes())
     
     # Запускаем очистку логов
     asyncio.create_task(cleanup_old_logs())
     
+    # Запускаем очистку старых команд
+    asyncio.create_task(cleanup_old_commands_task())
+    
+    # Запускаем снятие истёкших пауз и зависших статусов
+    asyncio.create_task(expire_script_statuses_task())
+    
+    # Запускаем сверку счётчиков статистики
+    asyncio.create_task(reconcile_statistics_task())
+    
+    # Резервные копии - в отдельном потоке, backup API копирует порциями
+    if db.db_paths:
+        backup.start_backup_thread(db.db_paths)
+    
+    # Запускаем отправку уведомлений от скриптов
+    asyncio.create_task(deliver_notifications())
+    
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
@@ -9,9 +9,25 @@ KEY_PREFIX = "DV_"
 # API настройки
 API_HOST = "0.0.0.0"
 API_PORT = 8080
+# Уведомления от скриптов, ожидающие отправки ботом (при переполнении вытесняются старые)
+NOTIFICATION_QUEUE_SIZE = 1000
 
 # База данных
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | memory (memory - только для тестов и симуляций)
 DATABASE_PATH = "darkveil.db"
+# Шардирование по user_id (1 - одна БД). Каталог users/keys остаётся в DATABASE_PATH.
+# Число шардов после запуска не менять: от него зависит, где лежат данные пользователя
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_PATH_TEMPLATE = "darkveil.shard{}.db"
+WRITE_BATCH_MAX_OPS = 100  # операций записи в одной транзакции
+WRITE_BATCH_MAX_DELAY_MS = 2  # сколько поток записи собирает пачку из уже накопившихся операций
+
+# Резервные копии
+BACKUP_DIR = "backups"
+BACKUP_INTERVAL_SECONDS = 6 * 3600
+BACKUP_KEEP = 28  # сколько сжатых копий хранить
+BACKUP_PAGES_PER_STEP = 256  # страниц БД за один шаг backup API
+BACKUP_STEP_SLEEP_SECONDS = 0.01  # пауза между шагами, чтобы не мешать записи
 
 # Админы (Telegram ID)
 ADMIN_IDS = [1581297002, 8385568563, 8414792453]
@@ -22,11 +38,47 @@ COMMAND_TIMEOUT_SECONDS = 90
 HEARTBEAT_INTERVAL_SECONDS = 30
 HEARTBEAT_TIMEOUT_SECONDS = 120
 
+# Хранение команд
+COMMANDS_RETENTION_DAYS = 7  # сколько хранить выполненные команды
+COMMANDS_CLEANUP_INTERVAL_SECONDS = 600  # как часто запускать очистку
+COMMANDS_CLEANUP_BATCH_SIZE = 500  # строк за одну транзакцию
+COMMANDS_CLEANUP_PAUSE_SECONDS = 0.05  # пауза между пачками, чтобы не держать блокировку записи
+
 # Оптимизация для 150+ пользователей
-CACHE_TTL_STATUS = 3  # секунды
-CACHE_TTL_SETTINGS = 30  # секунды
+# Кэш согласуется между ботом и API через журнал инвалидаций, TTL - лишь страховка
+CACHE_TTL_STATUS = 30  # секунды
+CACHE_TTL_SETTINGS = 300  # секунды
+CACHE_INVALIDATION_LOG_SIZE = 5000  # сколько последних инвалидаций хранить в БД
 BATCH_SIZE = 50  # размер пакета для обработки
 MAX_CONCURRENT_REQUESTS = 100
+STATS_RECONCILE_INTERVAL_SECONDS = 3600  # сверка счётчиков статистики с данными
+ADMIN_KEYS_PAGE_SIZE = 15  # ключей на странице в админке
+KEY_GENERATION_ATTEMPTS = 5  # попыток подобрать уникальное значение ключа
+KEYS_BULK_MAX = 1000  # максимум ключей в одной массовой операции
+SQL_IN_CHUNK_SIZE = 500  # максимум параметров в одном списке IN (...)
+
+# Отправка в Telegram (outbound.py)
+OUTBOUND_GLOBAL_RATE = 25  # запросов в секунду на всего бота (лимит Telegram - около 30)
+OUTBOUND_GLOBAL_BURST = 25  # сколько можно отправить разом после простоя
+OUTBOUND_CHAT_INTERVAL_SECONDS = 1.0  # пауза между уведомлениями/фоновыми сообщениями в одном чате
+OUTBOUND_MAX_RETRIES = 3  # повторов после RetryAfter
+OUTBOUND_LANE_LIMIT = 1000  # запросов в полосе уведомлений/фона, старые вытесняются
+
+# Состояния диалогов бота (fsm_storage.py): в памяти, в БД - пачками в фоне
+FSM_FLUSH_INTERVAL_SECONDS = 2  # как часто сбрасывать изменённые состояния в БД
+FSM_IDLE_SECONDS = 1800  # состояние без обращений дольше - выгружается из памяти (в БД остаётся)
+FSM_RETENTION_DAYS = 30  # состояние без изменений дольше - удаляется из БД
+
+# Отложенные действия бота (deferred.py)
+DEFERRED_BATCH_WINDOW_SECONDS = 0.5  # удаления в чате, наступающие в пределах окна, уходят одним deleteMessages
+DEFERRED_RETRY_SECONDS = 5  # повтор удаления, вытесненного из переполненной очереди отправки
+
+# Состояние интерфейса по пользователям (ui_state.py)
+UI_STATE_MAX_USERS = 10000  # пользователей в памяти, давно не использованные вытесняются
+UI_STATE_TTL_SECONDS = 6 * 3600  # запись без обращений дольше - удаляется из памяти
+UI_PANEL_IDLE_SECONDS = 300  # панель скрипта без действий дольше - не обновляется мониторингом
+
+RENDER_CACHE_SIZE = 2000  # отрисованных экранов в памяти (screens.py), давно не нужные вытесняются
 
 # Координаты по умолчанию
 DEFAULT_COORDINATES = {
@@ -67,6 +119,35 @@ DEFAULT_COORDINATES = {
     "arrow": {"x": 0, "y": 0, "description": "Точка стрелочки назад", "group": "additional"},
 }
 
+# Числовые id координат в БД (вместо имён в каждой строке).
+# Только дописывать новые: id уже сохранены у пользователей и не переиспользуются
+COORDINATE_IDS = {
+    "rleftT": 1,
+    "rrightB": 2,
+    "pleftT": 3,
+    "prightB": 4,
+    "bleftT": 5,
+    "brightB": 6,
+    "paste": 7,
+    "inpClose": 8,
+    "prinp": 9,
+    "nleftT": 10,
+    "nrightB": 11,
+    "sell": 12,
+    "chskin": 13,
+    "select": 14,
+    "inprice": 15,
+    "invent": 16,
+    "market": 17,
+    "myreq": 18,
+    "reqbuy": 19,
+    "tenskin": 20,
+    "findmark": 21,
+    "back": 22,
+    "ok": 23,
+    "arrow": 24,
+}
+
 # Группы координат для UI
 COORDINATE_GROUPS = {
     "main": {
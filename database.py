@@ -1,57 +1,281 @@
 import sqlite3
 import json
-import secrets
+import queue
+import threading
 import time
+import atexit
+from concurrent.futures import Future
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Tuple, Set
 from contextlib import contextmanager
 import config
 import logging
+from storage import Storage, MemoryStorage, CONFIG_DEFAULTS_HASH
+from timeutil import SQL_NOW_MS, now_ms
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Таблицы приложения. Все STRICT; таблицы старого формата пересоздаются при запуске
+TABLES = [
+    'users', 'keys', 'script_settings', 'coordinates', 'commands',
+    'script_status', 'cache_invalidations', 'script_config', 'stats_counters', 'fsm_state',
+    'scheduled_deletions',
+]
+
+# Колонки времени (миллисекунды Unix, UTC); в старых таблицах - текст CURRENT_TIMESTAMP
+TIMESTAMP_COLUMNS = {
+    'users': ['created_at', 'last_seen'],
+    'keys': ['created_at', 'activated_at'],
+    'script_settings': ['updated_at'],
+    'coordinates': ['updated_at'],
+    'commands': ['created_at', 'executed_at'],
+    'script_status': ['last_heartbeat', 'pause_until'],
+    'cache_invalidations': ['created_at'],
+}
+
+# Флаги 0/1; в старых таблицах - колонки BOOLEAN без проверки значений
+BOOLEAN_COLUMNS = {
+    'users': ['is_admin'],
+    'keys': ['is_frozen'],
+    'script_status': ['is_running', 'is_paused'],
+}
+
+# Счётчики статистики: имя -> (таблица, условие для строки; {row} = NEW/OLD).
+# Поддерживаются триггерами и периодически сверяются полным пересчётом
+STATS_COUNTERS = {
+    'users_total': ('users', '1'),
+    'users_admins': ('users', '{row}.is_admin = 1'),
+    'keys_total': ('keys', '1'),
+    'keys_used': ('keys', '{row}.activated_by IS NOT NULL'),
+    'keys_frozen': ('keys', '{row}.is_frozen = 1'),
+    'scripts_running': ('script_status', '{row}.is_running = 1 AND {row}.is_paused = 0'),
+    'scripts_paused': ('script_status', '{row}.is_paused = 1'),
+    'scripts_offline': ('script_status', '{row}.is_running = 0'),
+}
+
+# Колонки, изменение которых влияет на счётчики (остальные UPDATE триггер не трогают)
+STATS_TRACKED_COLUMNS = {
+    'users': 'is_admin',
+    'keys': 'activated_by, is_frozen',
+    'script_status': 'is_running, is_paused',
+}
+
 class CacheManager:
     """Менеджер кэша для оптимизации запросов"""
-    def __init__(self):
+    def __init__(self, validator: Optional[Callable[[], None]] = None):
         self.cache = {}
         self.cache_times = {}
+        # Вызывается перед каждым чтением, чтобы подтянуть инвалидации других процессов
+        self.validator = validator
+        # Кэш инвалидируется и из потока записи
+        self.lock = threading.RLock()
     
     def get(self, key: str, ttl: int = 30) -> Optional[Any]:
         """Получить значение из кэша"""
-        if key not in self.cache:
-            return None
-        
-        # Проверяем время жизни
-        if time.time() - self.cache_times.get(key, 0) > ttl:
-            del self.cache[key]
-            del self.cache_times[key]
-            return None
+        if self.validator is not None:
+            self.validator()
         
-        return self.cache[key]
+        with self.lock:
+            if key not in self.cache:
+                return None
+            
+            # Проверяем время жизни
+            if time.time() - self.cache_times.get(key, 0) > ttl:
+                del self.cache[key]
+                del self.cache_times[key]
+                return None
+            
+            return self.cache[key]
     
     def set(self, key: str, value: Any):
         """Сохранить значение в кэш"""
-        self.cache[key] = value
-        self.cache_times[key] = time.time()
+        with self.lock:
+            self.cache[key] = value
+            self.cache_times[key] = time.time()
+    
+    def discard(self, key: str):
+        """Удалить один ключ из кэша этого процесса"""
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache_times.pop(key, None)
+    
+    @staticmethod
+    def matches(key: str, pattern: str) -> bool:
+        """
+        Ключ задевается паттерном: паттерн - начало ключа по целым сегментам через "_"
+        
+        "user_1" задевает user_1 и user_1_key, но не user_12; "keys_" - все keys_*
+        """
+        return key == pattern or key.startswith(pattern if pattern.endswith('_') else pattern + '_')
     
     def invalidate(self, pattern: str = None):
-        """Инвалидировать кэш по паттерну"""
-        if pattern is None:
-            self.cache.clear()
-            self.cache_times.clear()
-        else:
-            keys_to_delete = [k for k in self.cache.keys() if pattern in k]
-            for key in keys_to_delete:
-                del self.cache[key]
-                if key in self.cache_times:
-                    del self.cache_times[key]
+        """Инвалидировать кэш по паттерну (None - весь кэш)"""
+        with self.lock:
+            if pattern is None:
+                self.cache.clear()
+                self.cache_times.clear()
+            else:
+                keys_to_delete = [k for k in self.cache.keys() if self.matches(k, pattern)]
+                for key in keys_to_delete:
+                    del self.cache[key]
+                    if key in self.cache_times:
+                        del self.cache_times[key]
 
-class Database:
+class WriteQueue:
+    """
+    Единственный поток записи в БД с групповым коммитом
+    
+    Операции (функции от курсора) ставятся в очередь, поток записи забирает всё
+    накопившееся (до WRITE_BATCH_MAX_OPS операций, собирая не дольше
+    WRITE_BATCH_MAX_DELAY_MS) и выполняет одной транзакцией. Каждая операция
+    обёрнута в SAVEPOINT: ошибка в одной откатывает только её. Результат
+    возвращается через Future.
+    """
+    def __init__(self, db_path: str, max_ops: int = config.WRITE_BATCH_MAX_OPS,
+                 max_delay_ms: float = config.WRITE_BATCH_MAX_DELAY_MS):
+        self.db_path = db_path
+        self.max_ops = max_ops
+        self.max_delay = max_delay_ms / 1000
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+    
+    def submit(self, operation: Callable[[sqlite3.Cursor], Any]) -> Future:
+        """Поставить операцию в очередь. Результат - Future (для asyncio: asyncio.wrap_future)"""
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("Операция записи не может ждать другую операцию записи")
+        if self.closed:
+            raise RuntimeError("Поток записи остановлен")
+        
+        future = Future()
+        self.queue.put((operation, future))
+        return future
+    
+    def close(self):
+        """Дописать очередь и остановить поток записи"""
+        self.closed = True
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=10)
+    
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            # WAL: читатели не блокируют единственного писателя и наоборот
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Не удалось включить WAL: {e}")
+        
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            
+            # Пачка - то, что накопилось, пока шёл предыдущий коммит: пустая очередь -
+            # коммитим сразу, одиночная запись не ждёт. Сбор пачки - не дольше max_delay
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_ops and time.monotonic() < deadline:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            
+            self._commit_batch(conn, batch)
+        
+        conn.close()
+    
+    @staticmethod
+    def _commit_batch(conn: sqlite3.Connection, batch: List[Tuple[Callable, Future]]):
+        """Выполнить пачку операций одной транзакцией"""
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for operation, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                
+                cursor = conn.cursor()
+                cursor.execute('SAVEPOINT op')
+                try:
+                    result = operation(cursor)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO op')
+                    cursor.execute('RELEASE op')
+                    outcomes.append((future, e, True))
+                else:
+                    cursor.execute('RELEASE op')
+                    outcomes.append((future, result, False))
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            logger.error(f"Ошибка группового коммита ({len(batch)} операций): {e}")
+            for _, future in batch:
+                if future.running():
+                    future.set_exception(e)
+            return
+        
+        # Результаты отдаём только после коммита
+        for future, value, failed in outcomes:
+            if failed:
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+class Database(Storage):
+    """Хранилище на SQLite: чтение - короткими соединениями, запись - через WriteQueue"""
     def __init__(self, db_path: str = config.DATABASE_PATH):
         self.db_path = db_path
-        self.cache = CacheManager()
+        self.cache = CacheManager(validator=self._sync_cache)
         self.init_database()
+        
+        # Все изменения идут через один поток записи
+        self.writer = WriteQueue(self.db_path)
+        atexit.register(self.close)
+        
+        # Отдельное долгоживущее соединение для PRAGMA data_version:
+        # значение меняется, только когда коммитит другое соединение (в т.ч. другой процесс)
+        self._sync_lock = threading.Lock()
+        self._watch_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._data_version = self._watch_conn.execute('PRAGMA data_version').fetchone()[0]
+        self._last_invalidation_id = self._watch_conn.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM cache_invalidations'
+        ).fetchone()[0]
+    
+    def close(self):
+        """Дописать очередь записи и закрыть соединения"""
+        self.writer.close()
+        with self._sync_lock:
+            if self._watch_conn is not None:
+                self._watch_conn.close()
+                self._watch_conn = None
+    
+    @property
+    def db_paths(self) -> List[str]:
+        return [self.db_path]
+    
+    def _write(self, operation: Callable[[sqlite3.Cursor], Any], wait: bool = True):
+        """
+        Выполнить операцию записи через поток записи
+        
+        Args:
+            operation: Функция от курсора; выполняется внутри общей транзакции
+            wait: True - дождаться коммита и вернуть результат, False - вернуть Future
+        
+        wait=True блокирует поток до коммита: в event loop - только через
+        asyncio.to_thread или asyncio.wrap_future(..., wait=False)
+        """
+        future = self.writer.submit(operation)
+        return future.result() if wait else future
     
     @contextmanager
     def get_connection(self):
@@ -68,124 +292,417 @@ class Database:
             conn.close()
     
     def init_database(self):
-        """Инициализация структуры базы данных"""
+        """
+        Привести схему базы к текущей версии
+        
+        Версия схемы - PRAGMA user_version, число применённых миграций из MIGRATIONS.
+        Если схема актуальна, всё сводится к одному чтению PRAGMA.
+        """
         with self.get_connection() as conn:
-            cursor = conn.cursor()
+            if conn.execute('PRAGMA user_version').fetchone()[0] == len(self.MIGRATIONS):
+                return
             
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    is_admin BOOLEAN DEFAULT 0,
-                    last_message_id INTEGER,  -- ДОБАВЛЕНО
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            cursor = conn.cursor()
+            # Все миграции - одной транзакцией: бот и API могут стартовать одновременно
+            cursor.execute('BEGIN IMMEDIATE')
+            # Пока ждали блокировку, схему мог обновить другой процесс
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if version > len(self.MIGRATIONS):
+                raise RuntimeError(
+                    f"Схема {self.db_path} версии {version} новее кода (версия {len(self.MIGRATIONS)})"
                 )
-            ''')
             
-            # Таблица ключей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS keys (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key_value TEXT UNIQUE NOT NULL,
-                    created_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    activated_by INTEGER,
-                    activated_at TIMESTAMP,
-                    is_frozen BOOLEAN DEFAULT 0,
-                    FOREIGN KEY (created_by) REFERENCES users(user_id),
-                    FOREIGN KEY (activated_by) REFERENCES users(user_id)
-                )
-            ''')
+            for number, migration in enumerate(self.MIGRATIONS[version:], version + 1):
+                logger.info(f"Миграция схемы {self.db_path} до версии {number}: {migration.__doc__}")
+                migration(self, cursor)
+            cursor.execute(f'PRAGMA user_version = {len(self.MIGRATIONS)}')
             
-            # Таблица настроек скрипта
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS script_settings (
-                    user_id INTEGER PRIMARY KEY,
-                    settings TEXT NOT NULL,
-                    config_version INTEGER DEFAULT 1,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
+            conn.commit()
+    
+    # ===== МИГРАЦИИ СХЕМЫ =====
+    
+    def _migration_baseline(self, cursor):
+        """Исходная схема"""
+        # Базы без версии: таблицы старого формата откладываем в сторону, данные перенесём в новые ниже
+        legacy_tables = self._rename_legacy_tables(cursor)
+        
+        # Таблица пользователей
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                is_admin INTEGER NOT NULL DEFAULT 0 CHECK (is_admin IN (0, 1)),
+                last_message_id INTEGER,
+                created_at INTEGER DEFAULT ({SQL_NOW_MS}),
+                last_seen INTEGER DEFAULT ({SQL_NOW_MS})
+            ) STRICT
+        ''')
+        
+        # Таблица ключей
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS keys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key_value TEXT UNIQUE NOT NULL,
+                created_by INTEGER,
+                created_at INTEGER DEFAULT ({SQL_NOW_MS}),
+                activated_by INTEGER,
+                activated_at INTEGER,
+                is_frozen INTEGER NOT NULL DEFAULT 0 CHECK (is_frozen IN (0, 1)),
+                FOREIGN KEY (created_by) REFERENCES users(user_id),
+                FOREIGN KEY (activated_by) REFERENCES users(user_id)
+            ) STRICT
+        ''')
+        
+        # Таблица настроек скрипта
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS script_settings (
+                user_id INTEGER PRIMARY KEY,
+                settings TEXT NOT NULL,
+                config_version INTEGER DEFAULT 1,
+                updated_at INTEGER DEFAULT ({SQL_NOW_MS}),
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            ) STRICT
+        ''')
+        
+        # Таблица координат: имя координаты - небольшое число из COORDINATE_IDS, описание берётся
+        # из DEFAULT_COORDINATES. WITHOUT ROWID: строки лежат прямо в B-дереве первичного ключа
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS coordinates (
+                user_id INTEGER NOT NULL,
+                coord_id INTEGER NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                updated_at INTEGER DEFAULT ({SQL_NOW_MS}),
+                PRIMARY KEY (user_id, coord_id),
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            ) STRICT, WITHOUT ROWID
+        ''')
+        
+        # Таблица команд (очередь)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS commands (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                command_type TEXT NOT NULL,
+                params TEXT,
+                status TEXT DEFAULT 'pending',
+                result TEXT,
+                created_at INTEGER DEFAULT ({SQL_NOW_MS}),
+                executed_at INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            ) STRICT
+        ''')
+        
+        # Таблица статусов скриптов (user_id INTEGER PRIMARY KEY - это и есть rowid)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS script_status (
+                user_id INTEGER PRIMARY KEY,
+                is_running INTEGER NOT NULL DEFAULT 0 CHECK (is_running IN (0, 1)),
+                is_paused INTEGER NOT NULL DEFAULT 0 CHECK (is_paused IN (0, 1)),
+                pause_until INTEGER,
+                last_heartbeat INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            ) STRICT
+        ''')
+        
+        # Журнал инвалидаций кэша (согласованность кэша между ботом и API)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pattern TEXT NOT NULL,
+                created_at INTEGER DEFAULT ({SQL_NOW_MS})
+            ) STRICT
+        ''')
+        
+        # Готовый конфиг скрипта, пересобирается при изменении настроек и координат
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS script_config (
+                user_id INTEGER PRIMARY KEY,
+                config_version INTEGER NOT NULL,
+                defaults_hash TEXT NOT NULL,
+                payload BLOB NOT NULL
+            ) STRICT
+        ''')
+        
+        # Счётчики статистики
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            ) STRICT, WITHOUT ROWID
+        ''')
+        self._copy_legacy_tables(cursor, legacy_tables)
+        self._create_stats_triggers(cursor)
+        
+        # Индексы для оптимизации
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_activated ON keys(activated_by)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_frozen ON keys(is_frozen)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_created ON keys(created_at, id)')
+        # Частичный индекс: get_pending_commands читает только живые команды, уже упорядоченные по времени
+        cursor.execute('DROP INDEX IF EXISTS idx_commands_status')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_commands_pending ON commands(user_id, created_at) WHERE status = 'pending'"
+        )
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_commands_created ON commands(created_at)')
+        # Поиск зависших скриптов и истёкших пауз - диапазоном по индексу.
+        # (is_running, last_heartbeat) заменяет прежний индекс по одному is_running
+        cursor.execute('DROP INDEX IF EXISTS idx_script_status_running')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_script_status_heartbeat ON script_status(is_running, last_heartbeat)'
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_script_status_pause ON script_status(pause_until) WHERE is_paused = 1'
+        )
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_admin ON users(is_admin)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_settings_updated ON script_settings(updated_at)')
+        
+        # Счётчики статистики заполняем из уже имеющихся данных
+        self._reconcile_counters(cursor)
+    
+    def _migration_compact_settings(self, cursor):
+        """Настройки хранятся только отличиями от DEFAULT_SETTINGS"""
+        cursor.execute('SELECT user_id, settings FROM script_settings')
+        for row in cursor.fetchall():
+            compact = json.dumps(self._settings_overrides(json.loads(row['settings'])))
+            if compact != row['settings']:
+                cursor.execute('UPDATE script_settings SET settings = ? WHERE user_id = ?', (compact, row['user_id']))
+    
+    def _migration_pending_expiry_index(self, cursor):
+        """Индекс просроченных команд для cleanup_old_commands"""
+        # Без него поиск просроченных pending идёт по idx_commands_created через все выполненные команды
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_commands_pending_created ON commands(created_at) WHERE status = 'pending'"
+        )
+    
+    def _migration_status_feed(self, cursor):
+        """Номер изменения статуса скрипта для ленты get_status_changes"""
+        cursor.execute('ALTER TABLE script_status ADD COLUMN status_seq INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_script_status_seq ON script_status(status_seq)')
+        
+        # Номер - следующий за максимальным (MAX берётся из индекса). Запись сериализована,
+        # поэтому номера растут в порядке коммитов и читатель с курсором ничего не пропускает.
+        # Heartbeat без смены статуса номер не меняет
+        next_seq = '''
+            UPDATE script_status SET status_seq = (SELECT MAX(status_seq) FROM script_status) + 1
+            WHERE user_id = NEW.user_id;
+        '''
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_script_status_seq_insert AFTER INSERT ON script_status
+            BEGIN {next_seq} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_script_status_seq_update
+            AFTER UPDATE OF is_running, is_paused, pause_until ON script_status
+            WHEN OLD.is_running IS NOT NEW.is_running
+                OR OLD.is_paused IS NOT NEW.is_paused
+                OR OLD.pause_until IS NOT NEW.pause_until
+            BEGIN {next_seq} END
+        ''')
+    
+    def _migration_fsm_state(self, cursor):
+        """Состояния диалогов бота (FSM): переживают перезапуск бота"""
+        # key - ключ aiogram (бот, чат, пользователь, ...), data - JSON данных состояния
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_state (
+                key TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            ) STRICT
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)')
+    
+    def _migration_scheduled_deletions(self, cursor):
+        """Сообщения бота, которые нужно удалить позже: удаление переживает перезапуск"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_deletions (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                due_at INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) STRICT, WITHOUT ROWID
+        ''')
+    
+    # Миграции по порядку: после N-й user_version = N. Только дописывать в конец,
+    # уже выпущенные не менять - они применены у существующих баз
+    MIGRATIONS = [
+        _migration_baseline,
+        _migration_compact_settings,
+        _migration_pending_expiry_index,
+        _migration_status_feed,
+        _migration_fsm_state,
+        _migration_scheduled_deletions,
+    ]
+    
+    @staticmethod
+    def _rename_legacy_tables(cursor) -> List[str]:
+        """Переименовать таблицы старого формата (не STRICT) в <таблица>_legacy"""
+        cursor.execute("SELECT name FROM pragma_table_list WHERE schema = 'main' AND strict = 0")
+        existing = {row['name'] for row in cursor.fetchall()}
+        
+        # Не переписывать ссылки FOREIGN KEY в остальных таблицах на имя <таблица>_legacy
+        cursor.execute('PRAGMA legacy_alter_table = ON')
+        renamed = []
+        for table in TABLES:
+            if table in existing:
+                cursor.execute(f'DROP TABLE IF EXISTS {table}_legacy')
+                cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+                renamed.append(table)
+        cursor.execute('PRAGMA legacy_alter_table = OFF')
+        return renamed
+    
+    @staticmethod
+    def _legacy_column_expression(table: str, column: str, legacy_columns: Set[str]) -> Optional[str]:
+        """Выражение для переноса значения колонки из <таблица>_legacy (None - колонку не переносить)"""
+        if table == 'coordinates' and column == 'coord_id' and 'coord_name' in legacy_columns:
+            cases = ' '.join(f"WHEN '{name}' THEN {coord_id}" for name, coord_id in config.COORDINATE_IDS.items())
+            return f"CASE coord_name {cases} END"
+        if column not in legacy_columns:
+            return None
+        if column in TIMESTAMP_COLUMNS.get(table, []):
+            # Старые значения - текст UTC 'YYYY-MM-DD HH:MM:SS'
+            return f"CASE WHEN typeof({column}) = 'text' THEN CAST(strftime('%s', {column}) AS INTEGER) * 1000 ELSE {column} END"
+        if column in BOOLEAN_COLUMNS.get(table, []):
+            return f"COALESCE({column}, 0) != 0"
+        return column
+    
+    def _copy_legacy_tables(self, cursor, tables: List[str]):
+        """Перенести данные из <таблица>_legacy в новые таблицы и удалить старые"""
+        for table in tables:
+            cursor.execute(f'PRAGMA table_info({table}_legacy)')
+            legacy_columns = {row['name'] for row in cursor.fetchall()}
+            cursor.execute(f'PRAGMA table_info({table})')
+            columns = {}
+            for row in cursor.fetchall():
+                expression = self._legacy_column_expression(table, row['name'], legacy_columns)
+                if expression is not None:
+                    columns[row['name']] = expression
             
-            # Таблица координат
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS coordinates (
-                    user_id INTEGER,
-                    coord_name TEXT,
-                    x INTEGER NOT NULL,
-                    y INTEGER NOT NULL,
-                    description TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user_id, coord_name),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
+            select = ', '.join(f'{expression} AS {column}' for column, expression in columns.items())
+            # Координаты с именами не из COORDINATE_IDS не переносятся
+            condition = 'coord_id IS NOT NULL' if 'coord_id' in columns else '1'
+            cursor.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"SELECT * FROM (SELECT {select} FROM {table}_legacy) WHERE {condition}"
+            )
             
-            # Таблица команд (очередь)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS commands (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    command_type TEXT NOT NULL,
-                    params TEXT,
-                    status TEXT DEFAULT 'pending',
-                    result TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    executed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
+            # AUTOINCREMENT не должен выдавать заново id удалённых строк
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (f'{table}_legacy',))
+            sequence = cursor.fetchone()
+            if sequence:
+                cursor.execute('DELETE FROM sqlite_sequence WHERE name = ?', (table,))
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, sequence['seq']))
             
-            # Таблица статусов скриптов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS script_status (
-                    user_id INTEGER PRIMARY KEY,
-                    is_running BOOLEAN DEFAULT 0,
-                    is_paused BOOLEAN DEFAULT 0,
-                    pause_until TIMESTAMP,
-                    last_heartbeat TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
+            cursor.execute(f'DROP TABLE {table}_legacy')
+            logger.info(f"Таблица {table} перенесена в новый формат")
+    
+    @staticmethod
+    def _create_stats_triggers(cursor):
+        """Создать триггеры, поддерживающие stats_counters"""
+        def flag(cond: str, row: str) -> str:
+            return f"(CASE WHEN {cond.format(row=row)} THEN 1 ELSE 0 END)"
+        
+        def update_counters(deltas: Dict[str, str]) -> str:
+            cases = ' '.join(f"WHEN '{name}' THEN {expr}" for name, expr in deltas.items())
+            names = ', '.join(f"'{name}'" for name in deltas)
+            return f"UPDATE stats_counters SET value = value + CASE name {cases} END WHERE name IN ({names});"
+        
+        for table, columns in STATS_TRACKED_COLUMNS.items():
+            counters = {name: cond for name, (t, cond) in STATS_COUNTERS.items() if t == table}
+            
+            on_insert = {name: flag(cond, 'NEW') for name, cond in counters.items()}
+            on_delete = {name: f"-{flag(cond, 'OLD')}" for name, cond in counters.items()}
+            # Безусловные счётчики (всего строк) от UPDATE не меняются
+            on_update = {
+                name: f"{flag(cond, 'NEW')} - {flag(cond, 'OLD')}"
+                for name, cond in counters.items() if '{row}' in cond
+            }
+            
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_insert AFTER INSERT ON {table}
+                BEGIN {update_counters(on_insert)} END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_delete AFTER DELETE ON {table}
+                BEGIN {update_counters(on_delete)} END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_update AFTER UPDATE OF {columns} ON {table}
+                BEGIN {update_counters(on_update)} END
             ''')
+    
+    # ===== СОГЛАСОВАННОСТЬ КЭША =====
+    
+    def _invalidate(self, cursor, pattern: str):
+        """Инвалидировать кэш локально и записать инвалидацию в журнал для других процессов"""
+        self.cache.invalidate(pattern)
+        cursor.execute('INSERT INTO cache_invalidations (pattern) VALUES (?)', (pattern,))
+        
+        # Периодически обрезаем журнал, оставляя последние CACHE_INVALIDATION_LOG_SIZE записей
+        if cursor.lastrowid % 1000 == 0:
+            cursor.execute(
+                'DELETE FROM cache_invalidations WHERE id <= ?',
+                (cursor.lastrowid - config.CACHE_INVALIDATION_LOG_SIZE,)
+            )
+    
+    def _sync_cache(self):
+        """Применить инвалидации, записанные другими процессами (одно чтение PRAGMA, если изменений нет)"""
+        with self._sync_lock:
+            if self._watch_conn is None:
+                return
             
-            # Индексы для оптимизации
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_activated ON keys(activated_by)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_frozen ON keys(is_frozen)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_commands_status ON commands(user_id, status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_commands_created ON commands(created_at)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_script_status_running ON script_status(is_running)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_admin ON users(is_admin)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_settings_updated ON script_settings(updated_at)')
+            data_version = self._watch_conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
             
-            conn.commit()
+            rows = self._watch_conn.execute(
+                'SELECT id, pattern FROM cache_invalidations WHERE id > ? ORDER BY id',
+                (self._last_invalidation_id,)
+            ).fetchall()
+            if not rows:
+                return
+            
+            if rows[0][0] > self._last_invalidation_id + 1:
+                # Часть журнала уже обрезана - не знаем, что пропустили, сбрасываем всё
+                self.cache.invalidate()
+            else:
+                for _, pattern in rows:
+                    self.cache.invalidate(pattern)
+            
+            self._last_invalidation_id = rows[-1][0]
     
     # ===== ПОЛЬЗОВАТЕЛИ =====
     
-    def get_or_create_user(self, user_id: int, username: str = None) -> Dict:
-        """Получить или создать пользователя с кэшированием"""
+    def get_or_create_user(self, user_id: int, username: str = None, create_user_rows: bool = True) -> Dict:
+        """
+        Получить или создать пользователя с кэшированием
+        
+        Args:
+            create_user_rows: Создать и строки настроек/статуса нового пользователя
+                (False - они живут в другой БД, см. ShardedDatabase)
+        """
         cache_key = f"user_{user_id}"
         cached = self.cache.get(cache_key, ttl=config.CACHE_TTL_STATUS)
-        if cached:
+        # Сменился username - идём в БД, иначе новое имя не сохранится до истечения кэша
+        if cached and cached['username'] == username:
             return cached
         
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            is_admin = user_id in config.ADMIN_IDS
-            
+        is_admin = user_id in config.ADMIN_IDS
+        
+        def operation(cursor):
             cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
             user = cursor.fetchone()
             
             if user:
+                now = now_ms()
                 cursor.execute(
-                    'UPDATE users SET last_seen = CURRENT_TIMESTAMP, username = ?, is_admin = ? WHERE user_id = ?',
-                    (username, is_admin, user_id)
+                    'UPDATE users SET last_seen = ?, username = ?, is_admin = ? WHERE user_id = ?',
+                    (now, username, is_admin, user_id)
                 )
                 result = dict(user)
-                result['is_admin'] = is_admin
+                result.update(username=username, is_admin=is_admin, last_seen=now)
                 # Убедимся, что last_message_id есть в результате
                 if 'last_message_id' not in result:
                     result['last_message_id'] = None
@@ -195,25 +712,32 @@ class Database:
                     (user_id, username, is_admin)
                 )
                 
-                self._create_default_settings(user_id, cursor)
-                cursor.execute(
-                    'INSERT INTO script_status (user_id) VALUES (?)',
-                    (user_id,)
-                )
+                if create_user_rows:
+                    self._create_user_rows(user_id, cursor)
                 
                 cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
                 result = dict(cursor.fetchone())
                 result['last_message_id'] = None
-            
-            self.cache.set(cache_key, result)
             return result
+        
+        result = self._write(operation)
+        self.cache.set(cache_key, result)
+        return result
+    
+    def _create_user_rows(self, user_id: int, cursor):
+        """Создать строки настроек и статуса скрипта нового пользователя"""
+        self._create_default_settings(user_id, cursor)
+        cursor.execute('INSERT OR IGNORE INTO script_status (user_id) VALUES (?)', (user_id,))
+    
+    def create_user_rows(self, user_id: int):
+        """Создать строки настроек и статуса пользователя, если их ещё нет"""
+        self._write(lambda cursor: self._create_user_rows(user_id, cursor))
     
     def _create_default_settings(self, user_id: int, cursor):
-        """Создать настройки по умолчанию для пользователя"""
-        settings_json = json.dumps(config.DEFAULT_SETTINGS)
+        """Создать настройки по умолчанию для пользователя (пустой набор переопределений)"""
         cursor.execute(
-            'INSERT INTO script_settings (user_id, settings) VALUES (?, ?)',
-            (user_id, settings_json)
+            'INSERT OR IGNORE INTO script_settings (user_id, settings) VALUES (?, ?)',
+            (user_id, '{}')
         )
     
     def get_user(self, user_id: int) -> Optional[Dict]:
@@ -250,44 +774,63 @@ class Database:
                 return result
             return None
     
-    def set_last_message_id(self, user_id: int, message_id: int) -> bool:
+    def set_last_message_id(self, user_id: int, message_id: int, wait: bool = True) -> bool:
         """Установить последний message_id пользователя"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
+            cursor.execute('SELECT last_message_id FROM users WHERE user_id = ?', (user_id,))
+            before = cursor.fetchone()
+            if before is None:
+                return False
+            if before['last_message_id'] == message_id:
+                # Меняется почти с каждым экраном: без изменения журнал инвалидаций не трогаем
+                return True
+            
             cursor.execute(
                 'UPDATE users SET last_message_id = ? WHERE user_id = ?',
                 (message_id, user_id)
             )
-            
-            cache_key = f"user_{user_id}_last_msg"
-            self.cache.set(cache_key, message_id)
-            # Инвалидируем кэш пользователя
-            self.cache.invalidate(f"user_{user_id}")
-            return cursor.rowcount > 0
+            # В журнал - только этот ключ: last_message_id читают через get_last_message_id.
+            # Запись пользователя в кэше других процессов может отставать в пределах CACHE_TTL_STATUS
+            self._invalidate(cursor, f"user_{user_id}_last_msg")
+            self.cache.discard(f"user_{user_id}")
+            return True
+        
+        return self._write(operation, wait)
     
     # ===== КЛЮЧИ =====
     
+    @staticmethod
+    def _chunks(items: List, size: int = config.SQL_IN_CHUNK_SIZE):
+        """Разбить список на части для IN (...) с ограниченным числом параметров"""
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+    
     def create_key(self, created_by: int) -> Dict:
         """Создать новый ключ"""
-        key_value = f"{config.KEY_PREFIX}{secrets.token_hex(4).upper()}"
-        
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO keys (key_value, created_by) VALUES (?, ?)',
-                (key_value, created_by)
-            )
+        def operation(cursor):
+            # Суффикс ключа короткий - при совпадении подбираем новое значение
+            for _ in range(config.KEY_GENERATION_ATTEMPTS):
+                cursor.execute(
+                    'INSERT OR IGNORE INTO keys (key_value, created_by) VALUES (?, ?)',
+                    (self._generate_key_value(), created_by)
+                )
+                if cursor.rowcount > 0:
+                    break
+            else:
+                raise RuntimeError("Не удалось сгенерировать уникальный ключ")
+            
             key_id = cursor.lastrowid
             cursor.execute('SELECT * FROM keys WHERE id = ?', (key_id,))
+            result = dict(cursor.fetchone())
             
-            self.cache.invalidate("keys_")
-            return dict(cursor.fetchone())
+            self._invalidate(cursor, "keys_")
+            return result
+        
+        return self._write(operation)
     
     def activate_key(self, key_value: str, user_id: int) -> bool:
         """Активировать ключ"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
+        def operation(cursor):
             cursor.execute(
                 'SELECT * FROM keys WHERE key_value = ? AND activated_by IS NULL AND is_frozen = 0',
                 (key_value,)
@@ -298,13 +841,15 @@ class Database:
                 return False
             
             cursor.execute(
-                'UPDATE keys SET activated_by = ?, activated_at = CURRENT_TIMESTAMP WHERE key_value = ?',
-                (user_id, key_value)
+                'UPDATE keys SET activated_by = ?, activated_at = ? WHERE key_value = ?',
+                (user_id, now_ms(), key_value)
             )
             
-            self.cache.invalidate(f"user_{user_id}_key")
-            self.cache.invalidate("keys_")
+            self._invalidate(cursor, f"user_{user_id}_key")
+            self._invalidate(cursor, "keys_")
             return True
+        
+        return self._write(operation)
     
     def get_user_key_info(self, user_id: int) -> Optional[Dict]:
         """Получить информацию о ключе пользователя с кэшированием"""
@@ -326,40 +871,155 @@ class Database:
                 return result
             return None
     
+    def _invalidate_key(self, cursor, key_id: int):
+        """Инвалидировать списки ключей и кэш ключа его владельца"""
+        cursor.execute('SELECT activated_by FROM keys WHERE id = ?', (key_id,))
+        row = cursor.fetchone()
+        if row and row['activated_by']:
+            self._invalidate(cursor, f"user_{row['activated_by']}_key")
+        self._invalidate(cursor, "keys_")
+    
     def freeze_key(self, key_id: int) -> bool:
         """Заморозить ключ"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
+            self._invalidate_key(cursor, key_id)
             cursor.execute('UPDATE keys SET is_frozen = 1 WHERE id = ?', (key_id,))
-            self.cache.invalidate("keys_")
             return cursor.rowcount > 0
+        
+        return self._write(operation)
     
     def unfreeze_key(self, key_id: int) -> bool:
         """Разморозить ключ"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
+            self._invalidate_key(cursor, key_id)
             cursor.execute('UPDATE keys SET is_frozen = 0 WHERE id = ?', (key_id,))
-            self.cache.invalidate("keys_")
             return cursor.rowcount > 0
+        
+        return self._write(operation)
     
     def unbind_key(self, key_id: int) -> bool:
         """Отвязать ключ от пользователя"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
+            self._invalidate_key(cursor, key_id)
             cursor.execute(
                 'UPDATE keys SET activated_by = NULL, activated_at = NULL WHERE id = ?',
                 (key_id,)
             )
-            self.cache.invalidate("keys_")
             return cursor.rowcount > 0
+        
+        return self._write(operation)
     
     def delete_key(self, key_id: int) -> bool:
         """Удалить ключ"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
+            self._invalidate_key(cursor, key_id)
             cursor.execute('DELETE FROM keys WHERE id = ?', (key_id,))
-            self.cache.invalidate("keys_")
             return cursor.rowcount > 0
+        
+        return self._write(operation)
+    
+    def create_keys(self, created_by: int, count: int) -> List[Dict]:
+        """
+        Создать count новых ключей одной транзакцией
+        
+        Значения генерируются пачкой; совпавшие с существующими ключами
+        отбрасываются и догенерируются.
+        
+        Returns:
+            Список созданных ключей
+        """
+        count = min(count, config.KEYS_BULK_MAX)
+        
+        def operation(cursor):
+            created = []
+            for _ in range(config.KEY_GENERATION_ATTEMPTS):
+                missing = count - len(created)
+                if missing <= 0:
+                    break
+                
+                candidates = list({self._generate_key_value() for _ in range(missing)})
+                taken = set()
+                for chunk in self._chunks(candidates):
+                    placeholders = ','.join('?' * len(chunk))
+                    cursor.execute(f'SELECT key_value FROM keys WHERE key_value IN ({placeholders})', chunk)
+                    taken.update(row['key_value'] for row in cursor.fetchall())
+                
+                fresh = [value for value in candidates if value not in taken]
+                cursor.executemany(
+                    'INSERT INTO keys (key_value, created_by) VALUES (?, ?)',
+                    [(value, created_by) for value in fresh]
+                )
+                created.extend(fresh)
+            
+            if len(created) < count:
+                raise RuntimeError("Не удалось сгенерировать уникальные ключи")
+            
+            result = []
+            for chunk in self._chunks(created):
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT * FROM keys WHERE key_value IN ({placeholders})', chunk)
+                result.extend(dict(row) for row in cursor.fetchall())
+            # Сортируем здесь, а не ORDER BY: строки приходят в порядке индекса key_value
+            result.sort(key=lambda row: row['id'])
+            
+            self._invalidate(cursor, "keys_")
+            return result
+        
+        return self._write(operation)
+    
+    def _update_keys(self, key_ids: List[int], statement: str) -> int:
+        """
+        Применить statement ко множеству ключей одной транзакцией
+        
+        Args:
+            key_ids: ID ключей
+            statement: UPDATE/DELETE с плейсхолдером {ids} для списка IN
+        
+        Returns:
+            Количество затронутых ключей
+        """
+        key_ids = list(dict.fromkeys(key_ids))
+        if not key_ids:
+            return 0
+        
+        def operation(cursor):
+            affected = 0
+            for chunk in self._chunks(key_ids):
+                placeholders = ','.join('?' * len(chunk))
+                
+                cursor.execute(
+                    f'SELECT activated_by FROM keys WHERE id IN ({placeholders}) AND activated_by IS NOT NULL',
+                    chunk
+                )
+                for owner in {row['activated_by'] for row in cursor.fetchall()}:
+                    self._invalidate(cursor, f"user_{owner}_key")
+                
+                cursor.execute(statement.format(ids=placeholders), chunk)
+                affected += cursor.rowcount
+            
+            self._invalidate(cursor, "keys_")
+            return affected
+        
+        return self._write(operation)
+    
+    def freeze_keys(self, key_ids: List[int]) -> int:
+        """Заморозить несколько ключей"""
+        return self._update_keys(key_ids, 'UPDATE keys SET is_frozen = 1 WHERE id IN ({ids}) AND is_frozen = 0')
+    
+    def unfreeze_keys(self, key_ids: List[int]) -> int:
+        """Разморозить несколько ключей"""
+        return self._update_keys(key_ids, 'UPDATE keys SET is_frozen = 0 WHERE id IN ({ids}) AND is_frozen = 1')
+    
+    def unbind_keys(self, key_ids: List[int]) -> int:
+        """Отвязать несколько ключей"""
+        return self._update_keys(
+            key_ids,
+            'UPDATE keys SET activated_by = NULL, activated_at = NULL WHERE id IN ({ids}) AND activated_by IS NOT NULL'
+        )
+    
+    def delete_keys(self, key_ids: List[int]) -> int:
+        """Удалить несколько ключей"""
+        return self._update_keys(key_ids, 'DELETE FROM keys WHERE id IN ({ids})')
     
     def get_all_keys(self, limit: int = None, offset: int = 0) -> List[Dict]:
         """Получить все ключи с пагинацией"""
@@ -382,6 +1042,85 @@ class Database:
             self.cache.set(cache_key, result)
             return result
     
+    def get_keys_page(self, exclude_owners: List[int] = None, after: Tuple = None,
+                      before: Tuple = None, limit: int = config.ADMIN_KEYS_PAGE_SIZE) -> Dict:
+        """
+        Получить страницу ключей (от новых к старым) с username владельца одним запросом
+        
+        Args:
+            exclude_owners: Не показывать ключи, привязанные к этим пользователям
+            after: Курсор (created_at, id) последнего ключа предыдущей страницы - следующая страница
+            before: Курсор (created_at, id) первого ключа текущей страницы - предыдущая страница
+            limit: Размер страницы
+        
+        Returns:
+            {'keys': [...], 'has_prev': bool, 'has_next': bool}
+        """
+        cache_key = f"keys_page_{exclude_owners}_{after}_{before}_{limit}"
+        cached = self.cache.get(cache_key, ttl=10)
+        if cached:
+            return cached
+        
+        where = []
+        params = []
+        
+        if exclude_owners:
+            placeholders = ', '.join('?' * len(exclude_owners))
+            where.append(f'(k.activated_by IS NULL OR k.activated_by NOT IN ({placeholders}))')
+            params.extend(exclude_owners)
+        
+        if before is not None:
+            where.append('(k.created_at, k.id) > (?, ?)')
+            params.extend(before)
+            order = 'ASC'
+        else:
+            if after is not None:
+                where.append('(k.created_at, k.id) < (?, ?)')
+                params.extend(after)
+            order = 'DESC'
+        
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Берём на одну строку больше, чтобы узнать, есть ли ещё страница в этом направлении
+            cursor.execute(
+                f'''SELECT k.*, u.username AS owner_username
+                    FROM keys k
+                    LEFT JOIN users u ON u.user_id = k.activated_by
+                    {where_sql}
+                    ORDER BY k.created_at {order}, k.id {order}
+                    LIMIT ?''',
+                (*params, limit + 1)
+            )
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        if before is not None:
+            rows.reverse()
+            result = {'keys': rows, 'has_prev': has_more, 'has_next': True}
+        else:
+            result = {'keys': rows, 'has_prev': after is not None, 'has_next': has_more}
+        
+        self.cache.set(cache_key, result)
+        return result
+    
+    def count_keys(self, exclude_owners: List[int] = None) -> int:
+        """Количество ключей без привязанных к exclude_owners (счётчик статистики + поиск по индексу)"""
+        exclude_owners = exclude_owners or []
+        placeholders = ', '.join('?' * len(exclude_owners)) or 'NULL'
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'''SELECT (SELECT value FROM stats_counters WHERE name = 'keys_total')
+                        - (SELECT COUNT(*) FROM keys WHERE activated_by IN ({placeholders}))''',
+                exclude_owners
+            )
+            return cursor.fetchone()[0] or 0
+    
     def get_key_by_id(self, key_id: int) -> Optional[Dict]:
         """Получить ключ по ID"""
         with self.get_connection() as conn:
@@ -390,6 +1129,19 @@ class Database:
             row = cursor.fetchone()
             return dict(row) if row else None
     
+    def get_keys_by_values(self, key_values: List[str]) -> List[Dict]:
+        """Получить ключи по списку значений в порядке списка (отсутствующие пропускаются)"""
+        values = list(dict.fromkeys(key_values))
+        found = {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for chunk in self._chunks(values):
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT * FROM keys WHERE key_value IN ({placeholders})', chunk)
+                found.update((row['key_value'], dict(row)) for row in cursor.fetchall())
+        # Строки приходят в порядке индекса key_value - возвращаем в порядке запроса
+        return [found[value] for value in values if value in found]
+    
     def get_key_by_value(self, key_value: str) -> Optional[Dict]:
         """Получить ключ по значению"""
         with self.get_connection() as conn:
@@ -411,38 +1163,105 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('SELECT settings FROM script_settings WHERE user_id = ?', (user_id,))
             row = cursor.fetchone()
-            
-            if row:
-                result = json.loads(row['settings'])
-            else:
-                self._create_default_settings(user_id, cursor)
-                result = config.DEFAULT_SETTINGS.copy()
-            
-            self.cache.set(cache_key, result)
-            return result
+        
+        if row:
+            overrides = json.loads(row['settings'])
+        else:
+            self._write(lambda cursor: self._create_default_settings(user_id, cursor))
+            overrides = {}
+        
+        result = self._compose_settings(overrides)
+        self.cache.set(cache_key, result)
+        return result
     
-    def save_script_settings(self, user_id: int, settings: Dict) -> bool:
-        """Сохранить настройки скрипта"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            settings_json = json.dumps(settings)
+    def save_script_settings(self, user_id: int, settings: Dict, wait: bool = True) -> bool:
+        """Сохранить настройки скрипта (в БД хранятся только переопределения)"""
+        settings_json = json.dumps(self._settings_overrides(settings))
+        
+        def operation(cursor):
             cursor.execute(
                 '''UPDATE script_settings 
-                   SET settings = ?, config_version = config_version + 1, updated_at = CURRENT_TIMESTAMP 
+                   SET settings = ?, config_version = config_version + 1, updated_at = ? 
                    WHERE user_id = ?''',
-                (settings_json, user_id)
+                (settings_json, now_ms(), user_id)
             )
+            updated = cursor.rowcount > 0
             
-            self.cache.invalidate(f"settings_{user_id}")
-            return cursor.rowcount > 0
+            self._rebuild_script_config(cursor, user_id)
+            self._invalidate(cursor, f"settings_{user_id}")
+            self._invalidate(cursor, f"config_version_{user_id}")
+            return updated
+        
+        return self._write(operation, wait)
     
     def get_config_version(self, user_id: int) -> int:
-        """Получить версию конфигурации"""
+        """Получить версию конфигурации (с кэшированием: по ней бот кэширует отрисованные экраны)"""
+        cache_key = f"config_version_{user_id}"
+        cached = self.cache.get(cache_key, ttl=config.CACHE_TTL_SETTINGS)
+        if cached:
+            return cached
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT config_version FROM script_settings WHERE user_id = ?', (user_id,))
             row = cursor.fetchone()
-            return row['config_version'] if row else 1
+        
+        version = row['config_version'] if row else 1
+        self.cache.set(cache_key, version)
+        return version
+    
+    def _rebuild_script_config(self, cursor, user_id: int) -> Optional[bytes]:
+        """Пересобрать готовый конфиг скрипта пользователя (внутри транзакции записи)"""
+        cursor.execute('SELECT settings, config_version FROM script_settings WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        cursor.execute('SELECT coord_id, x, y FROM coordinates WHERE user_id = ?', (user_id,))
+        payload = self._build_script_config(
+            self._compose_settings(json.loads(row['settings'])),
+            self._compose_coordinates(cursor.fetchall())
+        )
+        
+        cursor.execute(
+            '''INSERT INTO script_config (user_id, config_version, defaults_hash, payload)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET
+                   config_version = excluded.config_version,
+                   defaults_hash = excluded.defaults_hash,
+                   payload = excluded.payload''',
+            (user_id, row['config_version'], CONFIG_DEFAULTS_HASH, payload)
+        )
+        self._invalidate(cursor, f"script_config_{user_id}")
+        return payload
+    
+    def get_script_config(self, user_id: int) -> bytes:
+        """Получить готовый конфиг скрипта (JSON в байтах) одним чтением"""
+        cache_key = f"script_config_{user_id}"
+        cached = self.cache.get(cache_key, ttl=config.CACHE_TTL_SETTINGS)
+        if cached:
+            return cached
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Конфиг актуален, если собран для текущей версии и текущих значений по умолчанию
+            cursor.execute(
+                '''SELECT c.payload FROM script_config c
+                   JOIN script_settings s ON s.user_id = c.user_id
+                   WHERE c.user_id = ? AND c.config_version = s.config_version AND c.defaults_hash = ?''',
+                (user_id, CONFIG_DEFAULTS_HASH)
+            )
+            row = cursor.fetchone()
+        
+        if row:
+            payload = bytes(row['payload'])
+        else:
+            # Конфига ещё нет (или сменились значения по умолчанию) - собираем один раз
+            self.get_script_settings(user_id)
+            payload = self._write(lambda cursor: self._rebuild_script_config(cursor, user_id))
+        
+        self.cache.set(cache_key, payload)
+        return payload
     
     # ===== КООРДИНАТЫ =====
     
@@ -455,22 +1274,10 @@ class Database:
         
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM coordinates WHERE user_id = ?', (user_id,))
+            cursor.execute('SELECT coord_id, x, y FROM coordinates WHERE user_id = ?', (user_id,))
             rows = cursor.fetchall()
             
-            coords = {}
-            for row in rows:
-                coords[row['coord_name']] = {
-                    'x': row['x'],
-                    'y': row['y'],
-                    'description': row['description']
-                }
-            
-            # Добавляем координаты по умолчанию
-            for name, default in config.DEFAULT_COORDINATES.items():
-                if name not in coords:
-                    coords[name] = default.copy()
-            
+            coords = self._compose_coordinates(rows)
             self.cache.set(cache_key, coords)
             return coords
     
@@ -479,14 +1286,13 @@ class Database:
         if coord_name not in config.DEFAULT_COORDINATES:
             return False
         
-        description = config.DEFAULT_COORDINATES[coord_name].get('description', '')
+        coord_id = config.COORDINATE_IDS[coord_name]
         
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
             cursor.execute(
-                '''INSERT OR REPLACE INTO coordinates (user_id, coord_name, x, y, description, updated_at)
-                   VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
-                (user_id, coord_name, x, y, description)
+                '''INSERT OR REPLACE INTO coordinates (user_id, coord_id, x, y, updated_at)
+                   VALUES (?, ?, ?, ?, ?)''',
+                (user_id, coord_id, x, y, now_ms())
             )
             
             cursor.execute(
@@ -494,50 +1300,51 @@ class Database:
                 (user_id,)
             )
             
-            self.cache.invalidate(f"coords_{user_id}")
+            self._rebuild_script_config(cursor, user_id)
+            self._invalidate(cursor, f"coords_{user_id}")
+            self._invalidate(cursor, f"config_version_{user_id}")
             return True
+        
+        return self._write(operation)
     
     def delete_user_coordinate(self, user_id: int, coord_name: str) -> bool:
         """Удалить координату пользователя"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        coord_id = config.COORDINATE_IDS.get(coord_name)
+        
+        def operation(cursor):
             cursor.execute(
-                'DELETE FROM coordinates WHERE user_id = ? AND coord_name = ?',
-                (user_id, coord_name)
+                'DELETE FROM coordinates WHERE user_id = ? AND coord_id = ?',
+                (user_id, coord_id)
             )
+            deleted = cursor.rowcount > 0
             
             cursor.execute(
                 'UPDATE script_settings SET config_version = config_version + 1 WHERE user_id = ?',
                 (user_id,)
             )
             
-            self.cache.invalidate(f"coords_{user_id}")
-            return cursor.rowcount > 0
-    
-    def get_coordinate_status(self, user_id: int) -> Dict:
-        """Получить статус настройки координат"""
-        coords = self.get_user_coordinates(user_id)
-        total = len(coords)
-        configured = sum(1 for c in coords.values() if c['x'] > 0 and c['y'] > 0)
+            self._rebuild_script_config(cursor, user_id)
+            self._invalidate(cursor, f"coords_{user_id}")
+            self._invalidate(cursor, f"config_version_{user_id}")
+            return deleted
         
-        return {
-            'total': total,
-            'configured': configured,
-            'percentage': (configured / total * 100) if total > 0 else 0
-        }
+        return self._write(operation)
     
     # ===== КОМАНДЫ =====
     
-    def create_command(self, user_id: int, command_type: str, params: Dict = None) -> int:
+    def create_command(self, user_id: int, command_type: str, params: Dict = None,
+                       wait: bool = True) -> int:
         """Создать команду в очереди"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            params_json = json.dumps(params) if params else None
+        params_json = json.dumps(params) if params else None
+        
+        def operation(cursor):
             cursor.execute(
                 'INSERT INTO commands (user_id, command_type, params) VALUES (?, ?, ?)',
                 (user_id, command_type, params_json)
             )
             return cursor.lastrowid
+        
+        return self._write(operation, wait)
     
     def get_pending_commands(self, user_id: int) -> List[Dict]:
         """Получить ожидающие команды пользователя"""
@@ -551,52 +1358,142 @@ class Database:
             )
             return [dict(row) for row in cursor.fetchall()]
     
-    def complete_command(self, command_id: int, result: str = None) -> bool:
+    def complete_command(self, command_id: int, result: str = None, wait: bool = True) -> bool:
         """Отметить команду как выполненную"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
             cursor.execute(
                 '''UPDATE commands 
-                   SET status = 'completed', result = ?, executed_at = CURRENT_TIMESTAMP 
+                   SET status = 'completed', result = ?, executed_at = ? 
                    WHERE id = ?''',
-                (result, command_id)
+                (result, now_ms(), command_id)
             )
             return cursor.rowcount > 0
+        
+        return self._write(operation, wait)
     
-    def cleanup_old_commands(self, days: int = 7):
-        """Очистить старые команды"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                '''DELETE FROM commands 
-                   WHERE created_at < datetime('now', '-' || ? || ' days')''',
-                (days,)
-            )
+    def cleanup_old_commands(self, days: int = config.COMMANDS_RETENTION_DAYS,
+                             batch_size: int = config.COMMANDS_CLEANUP_BATCH_SIZE) -> int:
+        """
+        Очистить старые команды небольшими пачками
+        
+        Удаляет выполненные команды старше days дней и ожидающие команды, которые
+        скрипт не забрал за COMMAND_TIMEOUT_SECONDS. Каждая пачка - отдельная короткая
+        транзакция, между пачками блокировка записи отпускается.
+        
+        Returns:
+            Количество удалённых команд
+        """
+        now = now_ms()
+        conditions = [
+            ("status != 'pending' AND created_at < ?", now - days * 86_400_000),
+            ("status = 'pending' AND created_at < ?", now - config.COMMAND_TIMEOUT_SECONDS * 1000),
+        ]
+        
+        total = 0
+        for condition, cutoff in conditions:
+            while True:
+                def operation(cursor):
+                    cursor.execute(
+                        f'''DELETE FROM commands WHERE id IN (
+                               SELECT id FROM commands WHERE {condition} LIMIT ?
+                           )''',
+                        (cutoff, batch_size)
+                    )
+                    return cursor.rowcount
+                
+                deleted = self._write(operation)
+                total += deleted
+                if deleted < batch_size:
+                    break
+                time.sleep(config.COMMANDS_CLEANUP_PAUSE_SECONDS)
+        
+        return total
     
     # ===== СТАТУС СКРИПТА =====
     
-    def update_script_status(self, user_id: int, is_running: bool, is_paused: bool = False):
+    def update_script_status(self, user_id: int, is_running: bool, is_paused: bool = False,
+                             wait: bool = True):
         """Обновить статус скрипта"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
             cursor.execute(
-                '''INSERT OR REPLACE INTO script_status (user_id, is_running, is_paused, last_heartbeat)
-                   VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
-                (user_id, is_running, is_paused)
+                'SELECT is_running, is_paused, pause_until FROM script_status WHERE user_id = ?',
+                (user_id,)
             )
+            before = cursor.fetchone()
+            
+            # UPSERT вместо INSERT OR REPLACE: REPLACE удаляет строку без срабатывания
+            # DELETE-триггеров, и счётчики статистики разъезжались бы
+            cursor.execute(
+                '''INSERT INTO script_status (user_id, is_running, is_paused, last_heartbeat)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                       is_running = excluded.is_running,
+                       is_paused = excluded.is_paused,
+                       pause_until = NULL,
+                       last_heartbeat = excluded.last_heartbeat''',
+                (user_id, is_running, is_paused, now_ms())
+            )
+            
+            # Скрипт сообщает статус с каждым heartbeat: без изменения статуса
+            # кэш и журнал инвалидаций не трогаем (last_heartbeat из кэша не читается)
+            if before is None or tuple(before) != (int(bool(is_running)), int(bool(is_paused)), None):
+                self._invalidate(cursor, f"status_{user_id}")
         
-        self.cache.invalidate(f"status_{user_id}")
+        return self._write(operation, wait)
     
-    def update_heartbeat(self, user_id: int):
+    def update_heartbeat(self, user_id: int, wait: bool = True):
         """Обновить heartbeat"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
             cursor.execute(
-                'UPDATE script_status SET last_heartbeat = CURRENT_TIMESTAMP WHERE user_id = ?',
-                (user_id,)
+                'UPDATE script_status SET last_heartbeat = ? WHERE user_id = ?',
+                (now_ms(), user_id)
             )
+            # Кэш статуса не инвалидируем: статус не изменился, а last_heartbeat
+            # нужен только expire_script_statuses, который читает его из таблицы
         
-        self.cache.invalidate(f"status_{user_id}")
+        return self._write(operation, wait)
+    
+    def expire_script_statuses(self) -> Dict[str, int]:
+        """
+        Снять истёкшие паузы и пометить остановленными скрипты без heartbeat дольше HEARTBEAT_TIMEOUT_SECONDS
+        
+        Оба отбора - диапазоны по индексам (is_running, last_heartbeat) и pause_until.
+        
+        Returns:
+            {'resumed': ..., 'stale': ...}
+        """
+        now = now_ms()
+        
+        def operation(cursor):
+            cursor.execute(
+                'SELECT user_id FROM script_status WHERE is_paused = 1 AND pause_until <= ?',
+                (now,)
+            )
+            resumed = [row['user_id'] for row in cursor.fetchall()]
+            cursor.execute(
+                'SELECT user_id FROM script_status WHERE is_running = 1 AND last_heartbeat < ?',
+                (now - config.HEARTBEAT_TIMEOUT_SECONDS * 1000,)
+            )
+            stale = [row['user_id'] for row in cursor.fetchall()]
+            
+            for chunk in self._chunks(resumed):
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(
+                    f'UPDATE script_status SET is_paused = 0, pause_until = NULL WHERE user_id IN ({placeholders})',
+                    chunk
+                )
+            for chunk in self._chunks(stale):
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(
+                    f'UPDATE script_status SET is_running = 0 WHERE user_id IN ({placeholders})',
+                    chunk
+                )
+            
+            for user_id in set(resumed) | set(stale):
+                self._invalidate(cursor, f"status_{user_id}")
+            return {'resumed': len(resumed), 'stale': len(stale)}
+        
+        return self._write(operation)
     
     def get_script_status(self, user_id: int) -> Dict:
         """Получить статус скрипта с кэшированием"""
@@ -624,29 +1521,132 @@ class Database:
             self.cache.set(cache_key, result)
             return result
     
+    def get_status_changes(self, cursor: Optional[int] = None,
+                           limit: int = config.BATCH_SIZE) -> Tuple[List[Dict], int]:
+        """
+        Статусы скриптов, изменившиеся после курсора (по всем пользователям, одним запросом)
+        
+        Args:
+            cursor: Курсор из предыдущего вызова; None - начать с текущего момента
+            limit: Сколько изменений вернуть за раз
+        
+        Returns:
+            (изменения от старых к новым, новый курсор)
+        """
+        with self.get_connection() as conn:
+            if cursor is None:
+                return [], conn.execute('SELECT COALESCE(MAX(status_seq), 0) FROM script_status').fetchone()[0]
+            
+            rows = conn.execute(
+                '''SELECT user_id, is_running, is_paused, pause_until, status_seq
+                   FROM script_status WHERE status_seq > ?
+                   ORDER BY status_seq LIMIT ?''',
+                (cursor, limit)
+            ).fetchall()
+        
+        changes = [dict(row) for row in rows]
+        return changes, changes[-1]['status_seq'] if changes else cursor
+    
     def set_pause(self, user_id: int, seconds: int):
         """Установить паузу скрипта"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        def operation(cursor):
             if seconds > 0:
                 cursor.execute(
                     '''UPDATE script_status 
-                       SET is_paused = 1, pause_until = datetime('now', '+' || ? || ' seconds')
+                       SET is_paused = 1, pause_until = ?
                        WHERE user_id = ?''',
-                    (seconds, user_id)
+                    (now_ms() + seconds * 1000, user_id)
                 )
             else:
                 cursor.execute(
                     'UPDATE script_status SET is_paused = 0, pause_until = NULL WHERE user_id = ?',
                     (user_id,)
                 )
+            
+            self._invalidate(cursor, f"status_{user_id}")
         
-        self.cache.invalidate(f"status_{user_id}")
+        self._write(operation)
+    
+    # ===== СОСТОЯНИЕ ДИАЛОГОВ (FSM) =====
+    
+    def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], Dict]]:
+        """Состояние и данные диалога по ключу FSM (None - записи нет)"""
+        with self.get_connection() as conn:
+            row = conn.execute('SELECT state, data FROM fsm_state WHERE key = ?', (key,)).fetchone()
+        return (row['state'], json.loads(row['data'])) if row else None
+    
+    def save_fsm_records(self, records: List[Tuple[str, int, Optional[str], Dict]], wait: bool = True) -> int:
+        """
+        Сохранить состояния диалогов одной транзакцией
+        
+        Args:
+            records: (ключ, user_id, состояние, данные); запись без состояния и данных удаляется
+        
+        Returns:
+            Количество сохранённых записей
+        """
+        now = now_ms()
+        # JSON собирается до постановки в очередь записи: ошибка сериализации - у вызывающего
+        rows = [(key, user_id, state, json.dumps(data, ensure_ascii=False), now)
+                for key, user_id, state, data in records]
+        upserts = [row for row in rows if row[2] is not None or row[3] != '{}']
+        deletes = [(row[0],) for row in rows if row[2] is None and row[3] == '{}']
+        
+        def operation(cursor):
+            cursor.executemany(
+                '''INSERT INTO fsm_state (key, user_id, state, data, updated_at) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET
+                       state = excluded.state, data = excluded.data, updated_at = excluded.updated_at''',
+                upserts
+            )
+            cursor.executemany('DELETE FROM fsm_state WHERE key = ?', deletes)
+            return len(rows)
+        
+        return self._write(operation, wait)
+    
+    def cleanup_fsm_records(self, days: int = config.FSM_RETENTION_DAYS) -> int:
+        """Удалить состояния диалогов, не менявшиеся дольше days дней"""
+        def operation(cursor):
+            cursor.execute('DELETE FROM fsm_state WHERE updated_at < ?', (now_ms() - days * 86_400_000,))
+            return cursor.rowcount
+        
+        return self._write(operation)
+    
+    # ===== ОТЛОЖЕННЫЕ УДАЛЕНИЯ СООБЩЕНИЙ =====
+    
+    def add_scheduled_deletions(self, deletions: List[Tuple[int, int, int]], wait: bool = True) -> int:
+        """Запомнить сообщения для удаления: (chat_id, message_id, когда удалить - мс Unix)"""
+        def operation(cursor):
+            cursor.executemany(
+                '''INSERT INTO scheduled_deletions (chat_id, message_id, due_at) VALUES (?, ?, ?)
+                   ON CONFLICT(chat_id, message_id) DO UPDATE SET due_at = excluded.due_at''',
+                deletions
+            )
+            return len(deletions)
+        
+        return self._write(operation, wait)
+    
+    def get_scheduled_deletions(self) -> List[Tuple[int, int, int]]:
+        """Все ожидающие удаления сообщений: (chat_id, message_id, due_at)"""
+        with self.get_connection() as conn:
+            rows = conn.execute('SELECT chat_id, message_id, due_at FROM scheduled_deletions').fetchall()
+        return [tuple(row) for row in rows]
+    
+    def remove_scheduled_deletions(self, messages: List[Tuple[int, int]], wait: bool = True) -> int:
+        """Забыть удаления сообщений (chat_id, message_id) - выполненные или отменённые"""
+        def operation(cursor):
+            removed = 0
+            for message in messages:
+                cursor.execute('DELETE FROM scheduled_deletions WHERE chat_id = ? AND message_id = ?', message)
+                removed += cursor.rowcount
+            return removed
+        
+        return self._write(operation, wait)
     
     # ===== СТАТИСТИКА =====
     
-    def get_statistics(self) -> Dict:
-        """Получить статистику системы"""
+    def get_counters(self) -> Dict[str, int]:
+        """Получить поддерживаемые триггерами счётчики статистики (имя -> значение)"""
         cache_key = "statistics"
         cached = self.cache.get(cache_key, ttl=30)
         if cached:
@@ -654,69 +1654,359 @@ class Database:
         
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute('SELECT name, value FROM stats_counters')
+            counters = {row['name']: row['value'] for row in cursor.fetchall()}
+        
+        self.cache.set(cache_key, counters)
+        return counters
+    
+    def get_statistics(self) -> Dict:
+        """Получить статистику системы (из поддерживаемых триггерами счётчиков)"""
+        return self._format_statistics(self.get_counters())
+    
+    def reconcile_statistics(self) -> Dict[str, int]:
+        """Пересчитать счётчики статистики с нуля. Возвращает расхождения (имя -> разница)"""
+        # Пересчёт идёт внутри транзакции потока записи: триггеры не изменят счётчики
+        # между чтением и записью
+        drift = self._write(self._reconcile_counters)
+        self.cache.invalidate("statistics")
+        return drift
+    
+    @staticmethod
+    def _reconcile_counters(cursor) -> Dict[str, int]:
+        """Пересчитать stats_counters внутри транзакции записи"""
+        cursor.execute('SELECT name, value FROM stats_counters')
+        current = {row['name']: row['value'] for row in cursor.fetchall()}
+        
+        drift = {}
+        for name, (table, cond) in STATS_COUNTERS.items():
+            where = cond.format(row=table)
+            cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {where}')
+            actual = cursor.fetchone()[0]
             
-            cursor.execute('SELECT COUNT(*) as total FROM users')
-            total_users = cursor.fetchone()['total']
-            
-            cursor.execute('SELECT COUNT(*) as admins FROM users WHERE is_admin = 1')
-            admin_users = cursor.fetchone()['admins']
-            
-            cursor.execute('SELECT COUNT(*) as total FROM keys')
-            total_keys = cursor.fetchone()['total']
-            
-            cursor.execute('SELECT COUNT(*) as used FROM keys WHERE activated_by IS NOT NULL')
-            used_keys = cursor.fetchone()['used']
-            
-            cursor.execute('SELECT COUNT(*) as frozen FROM keys WHERE is_frozen = 1')
-            frozen_keys = cursor.fetchone()['frozen']
-            
-            cursor.execute('SELECT COUNT(*) as running FROM script_status WHERE is_running = 1 AND is_paused = 0')
-            running_scripts = cursor.fetchone()['running']
-            
-            cursor.execute('SELECT COUNT(*) as paused FROM script_status WHERE is_paused = 1')
-            paused_scripts = cursor.fetchone()['paused']
-            
-            cursor.execute('SELECT COUNT(*) as offline FROM script_status WHERE is_running = 0')
-            offline_scripts = cursor.fetchone()['offline']
-            
-            result = {
-                'users': {
-                    'total': total_users,
-                    'admins': admin_users,
-                    'regular': total_users - admin_users
-                },
-                'keys': {
-                    'total': total_keys,
-                    'used': used_keys,
-                    'free': total_keys - used_keys,
-                    'frozen': frozen_keys
-                },
-                'scripts': {
-                    'running': running_scripts,
-                    'paused': paused_scripts,
-                    'offline': offline_scripts
-                }
-            }
-            
-            self.cache.set(cache_key, result)
-            return result
+            if current.get(name) != actual:
+                drift[name] = actual - current.get(name, 0)
+                cursor.execute(
+                    'INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)',
+                    (name, actual)
+                )
+        return drift
+
+# Таблицы с данными отдельных пользователей - в шардах; users и keys - в каталоге
+SHARDED_TABLES = ['script_settings', 'coordinates', 'commands', 'script_status', 'script_config']
+
+class ShardedDatabase(Storage):
+    """
+    SQLite, разделённый по user_id на несколько файлов
     
-    # ===== МЕТОДЫ ДЛЯ УДАЛЕНИЯ СООБЩЕНИЙ (ASYNC) =====
+    Каталог (DATABASE_PATH) хранит users и keys, шарды (SHARD_PATH_TEMPLATE) -
+    настройки, координаты, команды и статусы. У каждого файла свой поток записи,
+    поэтому heartbeat и команды разных пользователей пишутся параллельно.
+    Пользователь живёт в шарде user_id % SHARD_COUNT.
     
-    async def delete_last_bot_message(self, user_id: int, bot) -> bool:
-        """Удалить последнее сообщение бота у пользователя (async)"""
-        try:
-            last_message_id = self.get_last_message_id(user_id)
-            if last_message_id:
-                await bot.delete_message(chat_id=user_id, message_id=last_message_id)
-                self.set_last_message_id(user_id, None)
-                logger.info(f"Deleted last message {last_message_id} for user {user_id}")
-                return True
-        except Exception as e:
-            # Если сообщение уже удалено или другая ошибка
-            if "message to delete not found" in str(e).lower():
-                # Просто очищаем ID
-                self.set_last_message_id(user_id, None)
-                return True
-            logger.error(f"Error deleting last message for user {user_id}: {e}")
-        return False
+    ID команды глобальный: local_id * SHARD_COUNT + номер шарда.
+    """
+    def __init__(self, catalog_path: str = config.DATABASE_PATH, shard_count: int = config.SHARD_COUNT,
+                 shard_path_template: str = config.SHARD_PATH_TEMPLATE):
+        self.catalog = Database(catalog_path)
+        self.shards = [Database(shard_path_template.format(i)) for i in range(shard_count)]
+        self.shard_count = shard_count
+        # Пользователи, чьи строки в шарде уже созданы этим процессом
+        self._user_rows_ready = set()
+        
+        self._migrate_to_shards()
+    
+    def close(self):
+        for database in [self.catalog, *self.shards]:
+            database.close()
+    
+    @property
+    def db_paths(self) -> List[str]:
+        """Файлы каталога и всех шардов"""
+        return [self.catalog.db_path] + [shard.db_path for shard in self.shards]
+    
+    def shard(self, user_id: int) -> Database:
+        """Шард пользователя"""
+        return self.shards[int(user_id) % self.shard_count]
+    
+    def _migrate_to_shards(self):
+        """Перенести данные пользователей из каталога в шарды (первый запуск после включения шардирования)"""
+        with self.catalog.get_connection() as conn:
+            has_rows = any(
+                conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+                for table in SHARDED_TABLES
+            )
+        if not has_rows:
+            return
+        
+        logger.info(f"Перенос данных пользователей в {self.shard_count} шардов")
+        
+        # INSERT OR IGNORE: если прошлый перенос прервался, повтор безопасен
+        for index, shard in enumerate(self.shards):
+            conn = sqlite3.connect(shard.db_path, isolation_level=None)
+            try:
+                conn.execute('ATTACH DATABASE ? AS catalog', (self.catalog.db_path,))
+                conn.execute('BEGIN IMMEDIATE')
+                for table in SHARDED_TABLES:
+                    conn.execute(
+                        f'INSERT OR IGNORE INTO main.{table} SELECT * FROM catalog.{table} WHERE user_id % ? = ?',
+                        (self.shard_count, index)
+                    )
+                conn.execute('COMMIT')
+                conn.execute('DETACH DATABASE catalog')
+            finally:
+                conn.close()
+        
+        def operation(cursor):
+            for table in SHARDED_TABLES:
+                cursor.execute(f'DELETE FROM {table}')
+        
+        self.catalog._write(operation)
+        for database in [self.catalog, *self.shards]:
+            database.reconcile_statistics()
+            database.cache.invalidate()
+    
+    def _global_command_id(self, user_id: int, local_id: int) -> int:
+        return local_id * self.shard_count + int(user_id) % self.shard_count
+    
+    def _split_command_id(self, command_id: int) -> Tuple[Database, int]:
+        return self.shards[command_id % self.shard_count], command_id // self.shard_count
+    
+    @staticmethod
+    def _map_future(future: Future, func: Callable[[Any], Any]) -> Future:
+        """Future с результатом func(результат future)"""
+        mapped = Future()
+        
+        def done(source: Future):
+            if source.exception() is not None:
+                mapped.set_exception(source.exception())
+            else:
+                mapped.set_result(func(source.result()))
+        
+        future.add_done_callback(done)
+        return mapped
+    
+    # ===== ПОЛЬЗОВАТЕЛИ =====
+    
+    def get_or_create_user(self, user_id: int, username: str = None) -> Dict:
+        user = self.catalog.get_or_create_user(user_id, username, create_user_rows=False)
+        if user_id not in self._user_rows_ready:
+            self.shard(user_id).create_user_rows(user_id)
+            self._user_rows_ready.add(user_id)
+        return user
+    
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        return self.catalog.get_user(user_id)
+    
+    def get_last_message_id(self, user_id: int) -> Optional[int]:
+        return self.catalog.get_last_message_id(user_id)
+    
+    def set_last_message_id(self, user_id: int, message_id: int, wait: bool = True) -> bool:
+        return self.catalog.set_last_message_id(user_id, message_id, wait)
+    
+    # ===== КЛЮЧИ =====
+    
+    def create_key(self, created_by: int) -> Dict:
+        return self.catalog.create_key(created_by)
+    
+    def create_keys(self, created_by: int, count: int) -> List[Dict]:
+        return self.catalog.create_keys(created_by, count)
+    
+    def activate_key(self, key_value: str, user_id: int) -> bool:
+        return self.catalog.activate_key(key_value, user_id)
+    
+    def get_user_key_info(self, user_id: int) -> Optional[Dict]:
+        return self.catalog.get_user_key_info(user_id)
+    
+    def freeze_key(self, key_id: int) -> bool:
+        return self.catalog.freeze_key(key_id)
+    
+    def unfreeze_key(self, key_id: int) -> bool:
+        return self.catalog.unfreeze_key(key_id)
+    
+    def unbind_key(self, key_id: int) -> bool:
+        return self.catalog.unbind_key(key_id)
+    
+    def delete_key(self, key_id: int) -> bool:
+        return self.catalog.delete_key(key_id)
+    
+    def freeze_keys(self, key_ids: List[int]) -> int:
+        return self.catalog.freeze_keys(key_ids)
+    
+    def unfreeze_keys(self, key_ids: List[int]) -> int:
+        return self.catalog.unfreeze_keys(key_ids)
+    
+    def unbind_keys(self, key_ids: List[int]) -> int:
+        return self.catalog.unbind_keys(key_ids)
+    
+    def delete_keys(self, key_ids: List[int]) -> int:
+        return self.catalog.delete_keys(key_ids)
+    
+    def get_all_keys(self, limit: int = None, offset: int = 0) -> List[Dict]:
+        return self.catalog.get_all_keys(limit, offset)
+    
+    def get_keys_page(self, exclude_owners: List[int] = None, after: Tuple = None,
+                      before: Tuple = None, limit: int = config.ADMIN_KEYS_PAGE_SIZE) -> Dict:
+        return self.catalog.get_keys_page(exclude_owners, after, before, limit)
+    
+    def count_keys(self, exclude_owners: List[int] = None) -> int:
+        return self.catalog.count_keys(exclude_owners)
+    
+    def get_key_by_id(self, key_id: int) -> Optional[Dict]:
+        return self.catalog.get_key_by_id(key_id)
+    
+    def get_keys_by_values(self, key_values: List[str]) -> List[Dict]:
+        return self.catalog.get_keys_by_values(key_values)
+    
+    def get_key_by_value(self, key_value: str) -> Optional[Dict]:
+        return self.catalog.get_key_by_value(key_value)
+    
+    # ===== НАСТРОЙКИ СКРИПТА =====
+    
+    def get_script_settings(self, user_id: int) -> Dict:
+        return self.shard(user_id).get_script_settings(user_id)
+    
+    def save_script_settings(self, user_id: int, settings: Dict, wait: bool = True) -> bool:
+        return self.shard(user_id).save_script_settings(user_id, settings, wait)
+    
+    def get_config_version(self, user_id: int) -> int:
+        return self.shard(user_id).get_config_version(user_id)
+    
+    def get_script_config(self, user_id: int) -> bytes:
+        return self.shard(user_id).get_script_config(user_id)
+    
+    # ===== КООРДИНАТЫ =====
+    
+    def get_user_coordinates(self, user_id: int) -> Dict:
+        return self.shard(user_id).get_user_coordinates(user_id)
+    
+    def save_user_coordinate(self, user_id: int, coord_name: str, x: int, y: int) -> bool:
+        return self.shard(user_id).save_user_coordinate(user_id, coord_name, x, y)
+    
+    def delete_user_coordinate(self, user_id: int, coord_name: str) -> bool:
+        return self.shard(user_id).delete_user_coordinate(user_id, coord_name)
+    
+    # ===== КОМАНДЫ =====
+    
+    def create_command(self, user_id: int, command_type: str, params: Dict = None,
+                       wait: bool = True) -> int:
+        result = self.shard(user_id).create_command(user_id, command_type, params, wait)
+        if wait:
+            return self._global_command_id(user_id, result)
+        return self._map_future(result, lambda local_id: self._global_command_id(user_id, local_id))
+    
+    def get_pending_commands(self, user_id: int) -> List[Dict]:
+        commands = self.shard(user_id).get_pending_commands(user_id)
+        for command in commands:
+            command['id'] = self._global_command_id(user_id, command['id'])
+        return commands
+    
+    def complete_command(self, command_id: int, result: str = None, wait: bool = True) -> bool:
+        shard, local_id = self._split_command_id(command_id)
+        return shard.complete_command(local_id, result, wait)
+    
+    def cleanup_old_commands(self, days: int = config.COMMANDS_RETENTION_DAYS,
+                             batch_size: int = config.COMMANDS_CLEANUP_BATCH_SIZE) -> int:
+        return sum(shard.cleanup_old_commands(days, batch_size) for shard in self.shards)
+    
+    # ===== СТАТУС СКРИПТА =====
+    
+    def update_script_status(self, user_id: int, is_running: bool, is_paused: bool = False,
+                             wait: bool = True):
+        return self.shard(user_id).update_script_status(user_id, is_running, is_paused, wait)
+    
+    def update_heartbeat(self, user_id: int, wait: bool = True):
+        return self.shard(user_id).update_heartbeat(user_id, wait)
+    
+    def get_script_status(self, user_id: int) -> Dict:
+        return self.shard(user_id).get_script_status(user_id)
+    
+    def expire_script_statuses(self) -> Dict[str, int]:
+        result = {'resumed': 0, 'stale': 0}
+        for shard in self.shards:
+            for name, count in shard.expire_script_statuses().items():
+                result[name] += count
+        return result
+    
+    def get_status_changes(self, cursor: Optional[Tuple[int, ...]] = None,
+                           limit: int = config.BATCH_SIZE) -> Tuple[List[Dict], Tuple[int, ...]]:
+        # У каждого шарда свои номера изменений: курсор - номер на шард
+        if cursor is None:
+            return [], tuple(shard.get_status_changes(None)[1] for shard in self.shards)
+        
+        pending = [shard.get_status_changes(cursor[index], limit)[0] for index, shard in enumerate(self.shards)]
+        
+        # Всего не больше limit: берём по одному из каждого шарда по очереди,
+        # чтобы шард с потоком изменений не задерживал остальные
+        changes = []
+        taken = [0] * len(self.shards)
+        while len(changes) < limit:
+            progressed = False
+            for index, shard_changes in enumerate(pending):
+                if taken[index] < len(shard_changes) and len(changes) < limit:
+                    changes.append(shard_changes[taken[index]])
+                    taken[index] += 1
+                    progressed = True
+            if not progressed:
+                break
+        
+        # Курсор шарда сдвигается только на отданные изменения: остальные придут в следующий раз
+        next_cursor = tuple(
+            pending[index][taken[index] - 1]['status_seq'] if taken[index] else cursor[index]
+            for index in range(len(self.shards))
+        )
+        return changes, next_cursor
+    
+    def set_pause(self, user_id: int, seconds: int):
+        return self.shard(user_id).set_pause(user_id, seconds)
+    
+    # ===== СОСТОЯНИЕ ДИАЛОГОВ (FSM) =====
+    # Пишет только бот, и немного: хранится в каталоге, рядом с пользователями
+    
+    def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], Dict]]:
+        return self.catalog.get_fsm_record(key)
+    
+    def save_fsm_records(self, records: List[Tuple[str, int, Optional[str], Dict]], wait: bool = True) -> int:
+        return self.catalog.save_fsm_records(records, wait)
+    
+    def cleanup_fsm_records(self, days: int = config.FSM_RETENTION_DAYS) -> int:
+        return self.catalog.cleanup_fsm_records(days)
+    
+    # ===== ОТЛОЖЕННЫЕ УДАЛЕНИЯ СООБЩЕНИЙ =====
+    # Тоже только бот: в каталоге
+    
+    def add_scheduled_deletions(self, deletions: List[Tuple[int, int, int]], wait: bool = True) -> int:
+        return self.catalog.add_scheduled_deletions(deletions, wait)
+    
+    def get_scheduled_deletions(self) -> List[Tuple[int, int, int]]:
+        return self.catalog.get_scheduled_deletions()
+    
+    def remove_scheduled_deletions(self, messages: List[Tuple[int, int]], wait: bool = True) -> int:
+        return self.catalog.remove_scheduled_deletions(messages, wait)
+    
+    # ===== СТАТИСТИКА =====
+    
+    def get_statistics(self) -> Dict:
+        # Счётчики пользователей и ключей - в каталоге, скриптов - в шардах: просто складываем
+        counters = {}
+        for database in [self.catalog, *self.shards]:
+            for name, value in database.get_counters().items():
+                counters[name] = counters.get(name, 0) + value
+        return self._format_statistics(counters)
+    
+    def reconcile_statistics(self) -> Dict[str, int]:
+        drift = {}
+        for database in [self.catalog, *self.shards]:
+            for name, delta in database.reconcile_statistics().items():
+                drift[name] = drift.get(name, 0) + delta
+        return drift
+
+def create_database() -> Storage:
+    """Создать хранилище по config.STORAGE_BACKEND"""
+    if config.STORAGE_BACKEND == 'sqlite':
+        if config.SHARD_COUNT > 1:
+            return ShardedDatabase()
+        return Database()
+    if config.STORAGE_BACKEND == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {config.STORAGE_BACKEND}")
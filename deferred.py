@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | DEFERRED
+
+Отложенные действия бота: "удалить сообщение X в момент T" и подобные.
+
+Все действия - в одной куче по времени, их выполняет одна фоновая задача: обработчик
+только ставит действие и сразу освобождается, а не ждёт в asyncio.sleep.
+Удаления сообщений сохраняются в БД (scheduled_deletions) и после перезапуска
+выполняются; удаления одного чата, наступающие почти одновременно
+(DEFERRED_BATCH_WINDOW_SECONDS), уходят одним запросом deleteMessages.
+Произвольные отложенные вызовы (call_later) живут только в памяти.
+"""
+
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+
+import config
+from outbound import OutboundDropped, OutboundScheduler, Priority
+from storage import Storage
+from timeutil import now_ms
+
+logger = logging.getLogger(__name__)
+
+DELETE_MESSAGES_MAX = 100  # лимит Telegram на сообщения в одном deleteMessages
+
+class DeferredActions:
+    """Отложенные действия бота: куча (когда, порядковый номер, действие) и одна задача-таймер"""
+    def __init__(self, bot: Bot, outbound: OutboundScheduler, db: Storage,
+                 batch_window: float = config.DEFERRED_BATCH_WINDOW_SECONDS,
+                 retry_delay: float = config.DEFERRED_RETRY_SECONDS):
+        self.bot = bot
+        self.outbound = outbound
+        self.db = db
+        self.batch_window_ms = int(batch_window * 1000)
+        self.retry_delay_ms = int(retry_delay * 1000)
+        
+        # Действие - (chat_id, message_id) для удаления или функция без аргументов, возвращающая корутину
+        self.heap: List[Tuple[int, int, Any]] = []
+        self._order = itertools.count()  # при равном времени - в порядке постановки
+        self.running: Set[asyncio.Task] = set()
+        
+        self.stats = {'deleted': 0, 'delete_requests': 0, 'delete_retries': 0, 'called': 0}
+        
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Загрузить сохранённые удаления и запустить таймер (в работающем event loop)"""
+        if self._worker is not None:
+            return
+        # Просроченные за время простоя удалятся сразу
+        pending = self.db.get_scheduled_deletions()
+        for chat_id, message_id, due_at in pending:
+            self._push(due_at, (chat_id, message_id))
+        if pending:
+            logger.info(f"Загружено отложенных удалений сообщений: {len(pending)}")
+        self._worker = asyncio.create_task(self._run(), name="deferred")
+    
+    async def stop(self):
+        """Остановить таймер; сохранённые удаления выполнятся после запуска"""
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, *self.running, return_exceptions=True)
+            self._worker = None
+    
+    def delete_message_later(self, chat_id: int, message_id: int, delay: float):
+        """Удалить сообщение через delay секунд (переживает перезапуск)"""
+        due_at = now_ms() + int(delay * 1000)
+        self._push(due_at, (chat_id, message_id))
+        
+        def saved(future):
+            if future.exception() is not None:
+                logger.warning(f"Не удалось сохранить отложенное удаление {chat_id}/{message_id}: {future.exception()}")
+        
+        self.db.add_scheduled_deletions([(chat_id, message_id, due_at)], wait=False).add_done_callback(saved)
+    
+    def call_later(self, delay: float, call: Callable[[], Awaitable[Any]]):
+        """Выполнить call() через delay секунд (только в памяти: после перезапуска не выполнится)"""
+        self._push(now_ms() + int(delay * 1000), call)
+    
+    def pending(self) -> int:
+        """Сколько действий ждёт своего времени"""
+        return len(self.heap)
+    
+    def _push(self, due_at: int, action: Any):
+        heapq.heappush(self.heap, (due_at, next(self._order), action))
+        self._wakeup.set()
+    
+    async def _run(self):
+        while True:
+            now = now_ms()
+            if not self.heap or self.heap[0][0] > now:
+                timeout = (self.heap[0][0] - now) / 1000 if self.heap else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            deletions: Dict[int, List[int]] = {}
+            while self.heap and self.heap[0][0] <= now:
+                _, _, action = heapq.heappop(self.heap)
+                if callable(action):
+                    self._spawn(self._call(action))
+                else:
+                    chat_id, message_id = action
+                    deletions.setdefault(chat_id, []).append(message_id)
+            
+            # Удаления тех же чатов, наступающие в пределах окна, забираем сейчас же:
+            # они уйдут тем же запросом. Куча невелика (сообщения живут секунды) - просмотр целиком
+            horizon = now + self.batch_window_ms
+            early = [item for item in self.heap
+                     if item[0] <= horizon and not callable(item[2]) and item[2][0] in deletions]
+            if early:
+                for _, _, (chat_id, message_id) in early:
+                    deletions[chat_id].append(message_id)
+                taken = {item[1] for item in early}
+                self.heap = [item for item in self.heap if item[1] not in taken]
+                heapq.heapify(self.heap)
+            
+            for chat_id, message_ids in deletions.items():
+                for start in range(0, len(message_ids), DELETE_MESSAGES_MAX):
+                    self._delete(chat_id, message_ids[start:start + DELETE_MESSAGES_MAX])
+    
+    def _spawn(self, coroutine: Awaitable[Any]):
+        task = asyncio.create_task(coroutine)
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+    
+    async def _call(self, call: Callable[[], Awaitable[Any]]):
+        try:
+            await call()
+            self.stats['called'] += 1
+        except Exception as e:
+            logger.error(f"Ошибка отложенного действия: {e}")
+    
+    def _delete(self, chat_id: int, message_ids: List[int]):
+        """Удалить сообщения чата одним запросом через очередь отправки"""
+        def done(future):
+            if future.cancelled():
+                # Бот останавливается: запись в БД остаётся, удалим после запуска
+                return
+            if isinstance(future.exception(), OutboundDropped):
+                # Запрос не ушёл (очередь отправки переполнена): запись в БД остаётся, повторим позже
+                self.stats['delete_retries'] += 1
+                due_at = now_ms() + self.retry_delay_ms
+                for message_id in message_ids:
+                    self._push(due_at, (chat_id, message_id))
+                return
+            if future.exception() is not None:
+                # Сообщение уже удалено или старше 48 часов - повтор не поможет
+                logger.debug(f"Не удалось удалить сообщения {message_ids} в чате {chat_id}: {future.exception()}")
+            else:
+                self.stats['deleted'] += len(message_ids)
+            self.db.remove_scheduled_deletions([(chat_id, message_id) for message_id in message_ids], wait=False)
+        
+        self.stats['delete_requests'] += 1
+        self.outbound.submit(
+            chat_id,
+            functools.partial(self.bot.delete_messages, chat_id=chat_id, message_ids=message_ids),
+            Priority.BACKGROUND,
+            paced=False
+        ).add_done_callback(done)
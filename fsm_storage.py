@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | FSM STORAGE
+
+Хранилище состояний диалогов бота (aiogram FSM), переживающее перезапуск.
+
+Состояния и данные живут в памяти: чтение и запись в обработчиках не ходят в БД,
+кроме первого обращения к пользователю после запуска. Изменённые записи раз в
+FSM_FLUSH_INTERVAL_SECONDS уходят в БД одной транзакцией (таблица fsm_state).
+Записи без обращений дольше FSM_IDLE_SECONDS выгружаются из памяти: в БД они
+остаются и загрузятся снова при следующем обращении.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional, Set
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import config
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+class FSMRecord:
+    """Состояние диалога в памяти"""
+    __slots__ = ('state', 'data', 'used_at')
+    
+    def __init__(self, state: Optional[str] = None, data: Dict[str, Any] = None):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.used_at = time.monotonic()
+
+class PersistentFSMStorage(BaseStorage):
+    """Хранилище FSM: горячие записи в памяти, в БД - пачками в фоне"""
+    def __init__(self, db: Storage, flush_interval: float = config.FSM_FLUSH_INTERVAL_SECONDS,
+                 idle_seconds: float = config.FSM_IDLE_SECONDS):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.idle_seconds = idle_seconds
+        # Ключ в БД - как у RedisStorage: бот, чат, пользователь, ветка, назначение
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        
+        self.records: Dict[StorageKey, FSMRecord] = {}
+        self.dirty: Set[StorageKey] = set()  # изменены и ещё не сохранены в БД
+        
+        self.stats = {'loaded': 0, 'flushed': 0, 'evicted': 0}
+        
+        self._flusher: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Запустить фоновое сохранение (в работающем event loop)"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run(), name="fsm_flush")
+    
+    async def close(self):
+        """Остановить фоновое сохранение и сохранить всё несохранённое (вызывает Dispatcher при остановке)"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+    
+    def _record(self, key: StorageKey) -> FSMRecord:
+        record = self.records.get(key)
+        if record is None:
+            # Первое обращение после запуска или выгрузки: одно чтение по первичному ключу
+            loaded = self.db.get_fsm_record(self.key_builder.build(key))
+            record = FSMRecord(*loaded) if loaded else FSMRecord()
+            self.records[key] = record
+            self.stats['loaded'] += 1
+        record.used_at = time.monotonic()
+        return record
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._record(key).state = state.state if isinstance(state, State) else state
+        self.dirty.add(key)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._record(key).state
+    
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        self._record(key).data = data.copy()
+        self.dirty.add(key)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._record(key).data.copy()
+    
+    async def flush(self):
+        """Сохранить изменённые записи в БД одной транзакцией"""
+        if not self.dirty:
+            return
+        
+        keys, self.dirty = self.dirty, set()
+        # Данные записи только заменяются целиком (set_data), не меняются на месте - копировать не нужно
+        records = [
+            (self.key_builder.build(key), key.user_id, self.records[key].state, self.records[key].data)
+            for key in keys
+        ]
+        try:
+            await asyncio.wrap_future(self.db.save_fsm_records(records, wait=False))
+        except (TypeError, ValueError) as e:
+            # Данные не сериализуются в JSON: повтор не поможет
+            logger.error(f"Не удалось сохранить состояния диалогов ({len(records)}): {e}")
+        except Exception as e:
+            # БД недоступна - попробуем в следующий раз; новые изменения тех же записей важнее
+            logger.error(f"Ошибка сохранения состояний диалогов: {e}")
+            self.dirty |= keys
+        else:
+            self.stats['flushed'] += len(records)
+    
+    def _evict_idle(self):
+        """Выгрузить из памяти сохранённые записи без обращений дольше idle_seconds"""
+        cutoff = time.monotonic() - self.idle_seconds
+        idle = [key for key, record in self.records.items() if record.used_at < cutoff and key not in self.dirty]
+        for key in idle:
+            del self.records[key]
+        self.stats['evicted'] += len(idle)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                self._evict_idle()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сохранения состояний диалогов: {e}")
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | LAUNCHER
+
+Совместный запуск бота и API в одном процессе и одном event loop: общая база
+с кэшем и общая очередь уведомлений (уведомления скриптов доходят до бота).
+Бот и API по-прежнему можно запускать по отдельности: python bot.py / python api_server.py.
+
+Использование:
+    python launcher.py
+"""
+
+import asyncio
+import logging
+
+import uvicorn
+
+import api_server
+import bot
+import config
+
+logger = logging.getLogger(__name__)
+
+async def main():
+    """Запустить бота и API; остановка одного останавливает и другой"""
+    server = uvicorn.Server(uvicorn.Config(
+        api_server.app,
+        host=config.API_HOST,
+        port=config.API_PORT,
+        log_level=config.LOG_LEVEL.lower()
+    ))
+    
+    api_task = asyncio.create_task(server.serve(), name="api")
+    bot_task = asyncio.create_task(bot.main(), name="bot")
+    
+    done, pending = await asyncio.wait({api_task, bot_task}, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        logger.info(f"Остановлен {task.get_name()}, останавливаем остальное")
+    
+    server.should_exit = True
+    bot_task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | OUTBOUND
+
+Планировщик исходящих запросов к Telegram: весь вывод бота идёт через одну очередь.
+
+- общий token bucket на бота (OUTBOUND_GLOBAL_RATE в секунду) и пауза между
+  сообщениями в одном чате (OUTBOUND_CHAT_INTERVAL_SECONDS);
+- полосы приоритетов: ответ на действие пользователя > уведомления > фоновые обновления;
+- RetryAfter (429): чат ждёт указанное Telegram время, запрос повторяется;
+- правки одного сообщения, ещё стоящие в очереди, схлопываются - уходит только последняя.
+
+RenderedScreens - отпечатки отрисованных экранов: правка, которая ничего не меняет,
+не уходит в Telegram вовсе.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    """Полосы очереди: меньше - важнее"""
+    INTERACTIVE = 0  # ответ на нажатие/сообщение пользователя
+    NOTIFICATION = 1  # уведомления от скриптов
+    BACKGROUND = 2  # фоновые обновления панелей
+
+class OutboundDropped(Exception):
+    """Запрос вытеснен из переполненной полосы очереди и не отправлен"""
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше burst в запасе"""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self) -> float:
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        """Забрать токен (вызывать после wait_time() == 0)"""
+        self._refill()
+        self.tokens -= 1
+
+class OutboundJob:
+    """Запрос в очереди: вызов и Future всех, кто ждёт его результата"""
+    __slots__ = ('chat_id', 'call', 'priority', 'coalesce_key', 'paced', 'futures', 'taken', 'attempts')
+    
+    def __init__(self, chat_id: int, call: Callable[[], Awaitable[Any]], priority: Priority,
+                 coalesce_key: Optional[Hashable], paced: bool):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.paced = paced
+        self.futures: List[asyncio.Future] = []
+        self.taken = False
+        self.attempts = 0
+    
+    def resolve(self, result: Any = None, error: BaseException = None):
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class OutboundScheduler:
+    """Очередь исходящих запросов к Telegram с приоритетами и ограничением скорости"""
+    def __init__(self, rate: float = config.OUTBOUND_GLOBAL_RATE, burst: float = config.OUTBOUND_GLOBAL_BURST,
+                 chat_interval: float = config.OUTBOUND_CHAT_INTERVAL_SECONDS,
+                 max_retries: int = config.OUTBOUND_MAX_RETRIES, lane_limit: int = config.OUTBOUND_LANE_LIMIT):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.lane_limit = lane_limit
+        
+        self.lanes: List[deque] = [deque() for _ in Priority]
+        self.edits: Dict[Hashable, OutboundJob] = {}  # ключ правки -> ещё не отправленный запрос
+        self.chat_ready_at: Dict[int, float] = {}  # чат -> когда можно следующее сообщение (пауза в чате)
+        self.chat_blocked_until: Dict[int, float] = {}  # чат -> конец ожидания по RetryAfter
+        self.busy_chats: Set[int] = set()  # чаты с запросом в полёте: порядок внутри чата сохраняется
+        self.in_flight: Set[asyncio.Task] = set()
+        
+        self.stats = {'sent': 0, 'coalesced': 0, 'retried': 0, 'dropped': 0, 'failed': 0}
+        
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Запустить отправку (в работающем event loop)"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run(), name="outbound")
+    
+    async def stop(self):
+        """Остановить отправку; запросы в полёте дожидаются завершения"""
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, *self.in_flight, return_exceptions=True)
+            self._worker = None
+    
+    def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]], priority: Priority = Priority.INTERACTIVE,
+               coalesce_key: Optional[Hashable] = None, paced: bool = True) -> asyncio.Future:
+        """
+        Поставить запрос в очередь
+        
+        Args:
+            chat_id: Чат, в который идёт запрос
+            call: Функция без аргументов, выполняющая запрос (например, lambda: bot.send_message(...))
+            priority: Полоса очереди
+            coalesce_key: Ключ правки (обычно (chat_id, message_id)); ещё не отправленная правка
+                с тем же ключом заменяется новой
+            paced: Соблюдать паузу между сообщениями в чате (удаления её не требуют)
+        
+        Returns:
+            Future с результатом запроса; ждать его не обязательно
+        """
+        future = asyncio.get_running_loop().create_future()
+        
+        job = self.edits.get(coalesce_key) if coalesce_key is not None else None
+        if job is not None and not job.taken:
+            # Правка ещё в очереди: отправим новую версию, дождавшиеся старой получат её результат
+            job.call = call
+            job.futures.append(future)
+            self.stats['coalesced'] += 1
+            if priority < job.priority:
+                # Переносим в более важную полосу
+                self.lanes[job.priority].remove(job)
+                job.priority = priority
+                self.lanes[priority].append(job)
+            self._wakeup.set()
+            return future
+        
+        job = OutboundJob(chat_id, call, priority, coalesce_key, paced)
+        job.futures.append(future)
+        if coalesce_key is not None:
+            self.edits[coalesce_key] = job
+        
+        lane = self.lanes[priority]
+        if priority != Priority.INTERACTIVE and len(lane) >= self.lane_limit:
+            # Фоновые полосы ограничены: при затоплении вытесняется самый старый запрос
+            self._drop(lane.popleft())
+        lane.append(job)
+        self._wakeup.set()
+        return future
+    
+    def pending(self) -> int:
+        """Сколько запросов ждёт в очереди"""
+        return sum(1 for lane in self.lanes for job in lane if not job.taken)
+    
+    def _drop(self, job: OutboundJob):
+        if job.taken:
+            return
+        job.taken = True
+        self._forget_edit(job)
+        self.stats['dropped'] += 1
+        # Не None: ждущий должен знать, что запрос не ушёл
+        job.resolve(error=OutboundDropped(f"Запрос в чат {job.chat_id} вытеснен из очереди"))
+        logger.warning(f"Очередь отправки переполнена, отброшен запрос в чат {job.chat_id}")
+    
+    def _forget_edit(self, job: OutboundJob):
+        if job.coalesce_key is not None and self.edits.get(job.coalesce_key) is job:
+            del self.edits[job.coalesce_key]
+    
+    def _next_job(self, now: float) -> Tuple[Optional[OutboundJob], Optional[float]]:
+        """Самый важный запрос, чей чат готов; иначе - через сколько секунд какой-то станет готов"""
+        wait = None
+        for lane in self.lanes:
+            index = 0
+            while index < len(lane):
+                job = lane[index]
+                ready_at = self.chat_blocked_until.get(job.chat_id, 0)
+                if job.paced and job.priority != Priority.INTERACTIVE:
+                    # Ответ пользователю не задерживаем: темп задаёт он сам
+                    ready_at = max(ready_at, self.chat_ready_at.get(job.chat_id, 0))
+                
+                if job.chat_id in self.busy_chats:
+                    index += 1
+                elif ready_at > now:
+                    wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                    index += 1
+                else:
+                    del lane[index]
+                    return job, None
+        return None, wait
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            token_wait = self.bucket.wait_time()
+            if token_wait > 0:
+                await asyncio.sleep(token_wait)
+                continue
+            
+            job, wait = self._next_job(loop.time())
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            self.bucket.take()
+            job.taken = True
+            self._forget_edit(job)
+            self.busy_chats.add(job.chat_id)
+            if job.paced:
+                self.chat_ready_at[job.chat_id] = loop.time() + self.chat_interval
+                if len(self.chat_ready_at) > 4096:
+                    now = loop.time()
+                    self.chat_ready_at = {chat: at for chat, at in self.chat_ready_at.items() if at > now}
+            
+            task = asyncio.create_task(self._execute(job))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+    
+    async def _execute(self, job: OutboundJob):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            if job.attempts >= self.max_retries:
+                self.stats['failed'] += 1
+                job.resolve(error=e)
+                return
+            
+            job.attempts += 1
+            self.stats['retried'] += 1
+            self.chat_blocked_until[job.chat_id] = loop.time() + e.retry_after
+            logger.warning(f"Telegram просит подождать {e.retry_after} с в чате {job.chat_id}")
+            
+            newer = self.edits.get(job.coalesce_key) if job.coalesce_key is not None else None
+            if newer is not None:
+                # Пока ждали, пришла более новая правка того же сообщения - старую не повторяем
+                newer.futures.extend(job.futures)
+                return
+            job.taken = False
+            if job.coalesce_key is not None:
+                self.edits[job.coalesce_key] = job
+            self.lanes[job.priority].appendleft(job)
+        except Exception as e:
+            self.stats['failed'] += 1
+            job.resolve(error=e)
+        else:
+            self.stats['sent'] += 1
+            job.resolve(result)
+        finally:
+            self.busy_chats.discard(job.chat_id)
+            if self.chat_blocked_until.get(job.chat_id, 0) <= loop.time():
+                self.chat_blocked_until.pop(job.chat_id, None)
+            self._wakeup.set()
+
+# ===== ОТПЕЧАТКИ ЭКРАНОВ =====
+
+def is_not_modified(error: BaseException) -> bool:
+    """Ошибка Telegram "message is not modified": правка совпала с сообщением, это не сбой"""
+    return isinstance(error, TelegramBadRequest) and 'message is not modified' in str(error)
+
+class RenderedScreens:
+    """
+    Отпечаток последнего запрошенного содержимого (текст + клавиатура) сообщения каждого чата
+    
+    Запоминается при постановке правки в очередь, а не после отправки: из схлопнутых
+    правок в чате окажется последняя, с ней и сравнивается следующая.
+    """
+    def __init__(self, max_chats: int = config.UI_STATE_MAX_USERS):
+        self.max_chats = max_chats
+        # чат -> (message_id, отпечаток); от давно изменённых к недавним
+        self.fingerprints: "OrderedDict[int, Tuple[int, bytes]]" = OrderedDict()
+        self.suppressed = 0  # правок, не отправленных из-за совпадения
+    
+    @staticmethod
+    def fingerprint(text: str, markup: Optional[InlineKeyboardMarkup] = None) -> bytes:
+        payload = text if markup is None else f"{text}\0{markup.model_dump_json(exclude_none=True)}"
+        return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+    
+    def is_unchanged(self, chat_id: int, message_id: int, fingerprint: bytes) -> bool:
+        """Сообщение уже показывает это содержимое (тогда правка засчитывается как пропущенная)"""
+        if self.fingerprints.get(chat_id) == (message_id, fingerprint):
+            self.suppressed += 1
+            return True
+        return False
+    
+    def remember(self, chat_id: int, message_id: int, fingerprint: bytes):
+        self.fingerprints[chat_id] = (message_id, fingerprint)
+        self.fingerprints.move_to_end(chat_id)
+        if len(self.fingerprints) > self.max_chats:
+            # Забытый отпечаток стоит лишь одной правки без изменений
+            self.fingerprints.popitem(last=False)
+    
+    def forget(self, chat_id: int, message_id: int = None):
+        """Забыть отпечаток чата (или только если он относится к message_id)"""
+        current = self.fingerprints.get(chat_id)
+        if current is not None and (message_id is None or current[0] == message_id):
+            del self.fingerprints[chat_id]
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | QUERY PLANS
+
+Проверка планов запросов: на временной заполненной базе прогоняются все методы
+Database, каждый выполненный SQL-запрос проверяется через EXPLAIN QUERY PLAN.
+Полный просмотр таблицы (SCAN) и временное B-дерево для ORDER BY/GROUP BY/DISTINCT
+(USE TEMP B-TREE) на горячих путях считаются регрессией.
+
+Использование:
+    python query_plans.py            - проверить, код возврата 1 при нарушениях
+    python query_plans.py --verbose  - показать планы всех запросов
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from typing import Dict, List, Tuple
+
+import config
+
+# Шаги, которым полный просмотр разрешён: обслуживание, а не горячий путь
+ALLOWED_SCANS = {
+    'reconcile_statistics': "сверка счётчиков - намеренно полный пересчёт раз в час",
+}
+
+# Маленькие таблицы, которые читаются целиком по замыслу
+SMALL_TABLES = {
+    'stats_counters': "по строке на счётчик статистики",
+    'scheduled_deletions': "сообщения, ждущие удаления секунды; читаются целиком один раз при запуске бота",
+}
+
+# Служебные команды без плана
+SKIPPED_STATEMENTS = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|PRAGMA|--)', re.IGNORECASE)
+
+FIXTURE_USERS = 300
+FIXTURE_KEYS_PER_ADMIN = 400
+
+class StatementRecorder:
+    """Запоминает SQL всех соединений вместе с названием шага, который его выполнил"""
+    def __init__(self):
+        self.step = None
+        self.statements: Dict[str, str] = {}  # SQL -> шаг
+        self.lock = threading.Lock()
+        self._connect = sqlite3.connect
+    
+    def install(self):
+        recorder = self
+        
+        def connect(*args, **kwargs):
+            conn = recorder._connect(*args, **kwargs)
+            conn.set_trace_callback(recorder.record)
+            return conn
+        
+        sqlite3.connect = connect
+    
+    def uninstall(self):
+        sqlite3.connect = self._connect
+    
+    def record(self, sql: str):
+        if self.step is None or SKIPPED_STATEMENTS.match(sql):
+            return
+        with self.lock:
+            self.statements.setdefault(' '.join(sql.split()), self.step)
+
+def populate(db):
+    """Заполнить базу данными, похожими на рабочие"""
+    admin_id = config.ADMIN_IDS[0]
+    db.get_or_create_user(admin_id, "admin")
+    keys = db.create_keys(admin_id, FIXTURE_KEYS_PER_ADMIN)
+    
+    coord_names = list(config.DEFAULT_COORDINATES)
+    for user_id in range(1, FIXTURE_USERS + 1):
+        db.get_or_create_user(user_id, f"user{user_id}")
+        if user_id % 3:
+            db.activate_key(keys[user_id]['key_value'], user_id)
+        for i in range(user_id % 5):
+            db.save_user_coordinate(user_id, coord_names[i], i, i)
+        db.update_script_status(user_id, user_id % 2 == 0, user_id % 6 == 0, wait=False)
+        command_id = db.create_command(user_id, 'stop', {'n': user_id})
+        if user_id % 4:
+            db.complete_command(command_id, 'ok')
+    db.freeze_keys([key['id'] for key in keys[::10]])
+    return keys
+
+def run_workload(db, recorder: StatementRecorder, keys: List[Dict]):
+    """Вызвать каждый метод Database, записывая его SQL"""
+    user_id = 7
+    key_ids = [key['id'] for key in keys[FIXTURE_USERS + 1:FIXTURE_USERS + 20]]
+    page = db.get_keys_page(exclude_owners=config.ADMIN_IDS, limit=config.ADMIN_KEYS_PAGE_SIZE)
+    cursor = (page['keys'][-1]['created_at'], page['keys'][-1]['id'])
+    
+    steps = [
+        ('get_or_create_user', lambda: db.get_or_create_user(user_id, "renamed")),
+        ('get_or_create_user (новый)', lambda: db.get_or_create_user(FIXTURE_USERS + 1, "new")),
+        ('get_user', lambda: db.get_user(user_id)),
+        ('get_last_message_id', lambda: db.get_last_message_id(user_id)),
+        ('set_last_message_id', lambda: db.set_last_message_id(user_id, 100)),
+        ('create_key', lambda: db.create_key(user_id)),
+        ('activate_key', lambda: db.activate_key(keys[-1]['key_value'], FIXTURE_USERS + 1)),
+        ('get_user_key_info', lambda: db.get_user_key_info(user_id)),
+        ('freeze_key', lambda: db.freeze_key(key_ids[0])),
+        ('unfreeze_key', lambda: db.unfreeze_key(key_ids[0])),
+        ('unbind_key', lambda: db.unbind_key(keys[1]['id'])),
+        ('delete_key', lambda: db.delete_key(key_ids[1])),
+        ('create_keys', lambda: db.create_keys(user_id, 5)),
+        ('freeze_keys', lambda: db.freeze_keys(key_ids)),
+        ('unfreeze_keys', lambda: db.unfreeze_keys(key_ids)),
+        ('unbind_keys', lambda: db.unbind_keys(key_ids)),
+        ('delete_keys', lambda: db.delete_keys(key_ids[-3:])),
+        ('get_all_keys', lambda: db.get_all_keys(limit=20, offset=40)),
+        ('get_keys_page', lambda: db.get_keys_page(exclude_owners=config.ADMIN_IDS,
+                                                   limit=config.ADMIN_KEYS_PAGE_SIZE)),
+        ('get_keys_page (after)', lambda: db.get_keys_page(exclude_owners=config.ADMIN_IDS, after=cursor,
+                                                           limit=config.ADMIN_KEYS_PAGE_SIZE)),
+        ('get_keys_page (before)', lambda: db.get_keys_page(exclude_owners=config.ADMIN_IDS, before=cursor,
+                                                            limit=config.ADMIN_KEYS_PAGE_SIZE)),
+        ('count_keys', lambda: db.count_keys(exclude_owners=config.ADMIN_IDS)),
+        ('get_key_by_id', lambda: db.get_key_by_id(keys[5]['id'])),
+        ('get_keys_by_values', lambda: db.get_keys_by_values([key['key_value'] for key in keys[:10]])),
+        ('get_key_by_value', lambda: db.get_key_by_value(keys[5]['key_value'])),
+        ('get_script_settings', lambda: db.get_script_settings(user_id)),
+        ('save_script_settings', lambda: db.save_script_settings(user_id, {'dbclickS': 900})),
+        ('get_config_version', lambda: db.get_config_version(user_id)),
+        ('get_script_config', lambda: db.get_script_config(user_id)),
+        ('get_user_coordinates', lambda: db.get_user_coordinates(user_id)),
+        ('save_user_coordinate', lambda: db.save_user_coordinate(user_id, 'paste', 10, 20)),
+        ('delete_user_coordinate', lambda: db.delete_user_coordinate(user_id, 'paste')),
+        ('create_command', lambda: db.create_command(user_id, 'pause', {'seconds': 5})),
+        ('get_pending_commands', lambda: db.get_pending_commands(user_id)),
+        ('complete_command', lambda: db.complete_command(1, 'ok')),
+        ('cleanup_old_commands', lambda: db.cleanup_old_commands()),
+        ('update_script_status', lambda: db.update_script_status(user_id, True)),
+        ('update_heartbeat', lambda: db.update_heartbeat(user_id)),
+        ('expire_script_statuses', lambda: db.expire_script_statuses()),
+        ('get_script_status', lambda: db.get_script_status(user_id)),
+        ('get_status_changes', lambda: db.get_status_changes(0)),
+        ('get_status_changes (начало)', lambda: db.get_status_changes()),
+        ('save_fsm_records', lambda: db.save_fsm_records([(f'fsm:1:{user_id}:{user_id}:default', user_id,
+                                                            'UserStates:delay_input', {'editing_param': 'dbclickS'})])),
+        ('get_fsm_record', lambda: db.get_fsm_record(f'fsm:1:{user_id}:{user_id}:default')),
+        ('save_fsm_records (удаление)', lambda: db.save_fsm_records([(f'fsm:1:{user_id}:{user_id}:default', user_id,
+                                                                      None, {})])),
+        ('cleanup_fsm_records', lambda: db.cleanup_fsm_records()),
+        ('add_scheduled_deletions', lambda: db.add_scheduled_deletions([(user_id, 500, 0), (user_id, 501, 0)])),
+        ('get_scheduled_deletions', lambda: db.get_scheduled_deletions()),
+        ('remove_scheduled_deletions', lambda: db.remove_scheduled_deletions([(user_id, 500), (user_id, 501)])),
+        ('set_pause', lambda: db.set_pause(user_id, 30)),
+        ('set_pause (снять)', lambda: db.set_pause(user_id, 0)),
+        ('get_statistics', lambda: db.get_statistics()),
+        ('reconcile_statistics', lambda: db.reconcile_statistics()),
+    ]
+    
+    for name, step in steps:
+        # Пустой кэш: иначе чтение может не дойти до SQL
+        db.cache.invalidate()
+        recorder.step = name
+        step()
+        recorder.step = None
+
+def is_violation(plan_line: str, sql: str) -> bool:
+    """Строка плана - полный просмотр или сортировка во временном B-дереве"""
+    if 'USE TEMP B-TREE' in plan_line:
+        return True
+    match = re.match(r'SCAN (\w+)', plan_line)
+    if not match or match.group(1) == 'CONSTANT':
+        return False
+    table = match.group(1)
+    if table in SMALL_TABLES:
+        return False
+    # Обход индекса в нужном порядке, остановленный LIMIT - это не полный просмотр
+    if 'USING' in plan_line and 'INDEX' in plan_line and re.search(r'\bLIMIT\b', sql, re.IGNORECASE):
+        return False
+    return True
+
+def check_plans(db_path: str, statements: Dict[str, str], verbose: bool = False) -> List[Tuple[str, str, str]]:
+    """
+    Проверить планы запросов
+    
+    Returns:
+        Нарушения: (шаг, SQL, строка плана)
+    """
+    conn = sqlite3.connect(db_path)
+    violations = []
+    try:
+        for sql, step in statements.items():
+            plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()]
+            if verbose:
+                print(f"[{step}] {sql}")
+                for line in plan:
+                    print(f"    {line}")
+            
+            if step in ALLOWED_SCANS:
+                continue
+            for line in plan:
+                if is_violation(line, sql):
+                    violations.append((step, sql, line))
+    finally:
+        conn.close()
+    return violations
+
+def main(argv: List[str] = None) -> int:
+    """Точка входа CLI"""
+    parser = argparse.ArgumentParser(description="Проверка планов SQL-запросов DARKVEIL")
+    parser.add_argument('--verbose', action='store_true', help="показать планы всех запросов")
+    args = parser.parse_args(argv)
+    
+    from database import Database
+    
+    recorder = StatementRecorder()
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "query_plans.db")
+        recorder.install()
+        try:
+            db = Database(db_path)
+            keys = populate(db)
+            run_workload(db, recorder, keys)
+            db.close()
+        finally:
+            recorder.uninstall()
+        
+        violations = check_plans(db_path, recorder.statements, args.verbose)
+    
+    print(f"Проверено запросов: {len(recorder.statements)}")
+    for step, sql, line in violations:
+        print(f"[{step}] {line}\n    {sql}")
+    if violations:
+        print(f"Нарушений: {len(violations)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
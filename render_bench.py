@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | RENDER BENCH
+
+Микробенчмарк отрисовки экранов бота: сколько стоит собрать текст и клавиатуру
+одного экрана. Тексты берутся через скомпилированный каталог texts.get_text и,
+для сравнения, прежним обходом словарей (texts._get_text_uncompiled).
+
+Использование:
+    python render_bench.py                 - все экраны
+    python render_bench.py --number 20000  - повторов на замер
+"""
+
+import argparse
+import sys
+import timeit
+from typing import Callable, Dict, List
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import texts
+
+STATISTICS_SAMPLE = {
+    'total': 180, 'admins': 3, 'regular': 177, 'total_keys': 400, 'used': 170,
+    'free': 230, 'frozen': 12, 'running': 120, 'paused': 9, 'offline': 51,
+}
+
+def script_panel(get_text: Callable) -> tuple:
+    """Панель скрипта (скрипт запущен) - как show_script_main_panel"""
+    text = "\n".join([
+        get_text("SCRIPT_SECTION.running.title"),
+        get_text("SCRIPT_SECTION.running.status"),
+        "",
+        get_text("SCRIPT_SECTION.running.description"),
+    ])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.pause"), callback_data='script_pause'),
+            InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.stop"), callback_data='script_stop')
+        ],
+        [InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.commands"), callback_data='menu_commands')],
+        [
+            InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.delays"), callback_data='delays_main'),
+            InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.work_settings"), callback_data='work_settings')
+        ],
+        [
+            InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.modes"), callback_data='modes_main'),
+            InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.functions"), callback_data='functions_main')
+        ],
+        [InlineKeyboardButton(text=get_text("SCRIPT_SECTION.buttons.parameters"), callback_data='parameters_main')],
+        [InlineKeyboardButton(text=get_text("BUTTONS.back"), callback_data='menu_main')],
+    ])
+    return text, keyboard
+
+def commands_main(get_text: Callable) -> tuple:
+    """Меню команд - как commands_main_handler"""
+    text = get_text("COMMANDS.main_screen")
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=get_text("COMMANDS.restskin.name"), callback_data='cmd_restskin'),
+            InlineKeyboardButton(text=get_text("COMMANDS.saleskin.name"), callback_data='cmd_saleskin')
+        ],
+        [
+            InlineKeyboardButton(text=get_text("COMMANDS.compcheck.name"), callback_data='cmd_compcheck'),
+            InlineKeyboardButton(text=get_text("COMMANDS.device_info.name"), callback_data='cmd_device_info')
+        ],
+        [InlineKeyboardButton(text=get_text("COMMANDS.script_info.name"), callback_data='cmd_script_info')],
+        [InlineKeyboardButton(text=get_text("BUTTONS.back"), callback_data='script_main')]
+    ])
+    return text, keyboard
+
+def admin_statistics(get_text: Callable) -> tuple:
+    """Статистика системы - как admin_statistics_handler"""
+    text = get_text("STATISTICS.main_screen", **STATISTICS_SAMPLE)
+    text += get_text("STATISTICS.outbound", sent=1000, retried=2, coalesced=40, suppressed=85)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=get_text("BUTTONS.back"), callback_data='admin_main')]
+    ])
+    return text, keyboard
+
+def main_menu(get_text: Callable) -> tuple:
+    """Главное меню администратора - как show_main_menu"""
+    text = get_text("MAIN_MENU.admin.text")
+    buttons = get_text("MAIN_MENU.admin.buttons")
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=buttons['script'], callback_data='menu_script')],
+        [
+            InlineKeyboardButton(text=buttons['settings'], callback_data='user_settings'),
+            InlineKeyboardButton(text=buttons['admin'], callback_data='admin_main')
+        ]
+    ])
+    return text, keyboard
+
+SCREENS: Dict[str, Callable] = {
+    'script_panel': script_panel,
+    'commands_main': commands_main,
+    'admin_statistics': admin_statistics,
+    'main_menu': main_menu,
+}
+
+class TextCalls:
+    """get_text, запоминающий пути и параметры вызовов экрана (для замера только текстов)"""
+    def __init__(self, get_text: Callable):
+        self.get_text = get_text
+        self.paths: List[tuple] = []
+    
+    def __call__(self, path: str, **kwargs):
+        self.paths.append((path, kwargs))
+        return self.get_text(path, **kwargs)
+
+def measure(func: Callable, number: int) -> float:
+    """Микросекунд на вызов (лучший из трёх замеров)"""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+def main(argv: List[str] = None) -> int:
+    """Точка входа CLI"""
+    parser = argparse.ArgumentParser(description="Стоимость отрисовки экранов бота DARKVEIL")
+    parser.add_argument('--number', type=int, default=5000, help="повторов на замер")
+    args = parser.parse_args(argv)
+    
+    print(f"{'экран':<18} {'вызовов':>8} {'тексты, мкс':>22} {'экран целиком, мкс':>24}")
+    print(f"{'':<18} {'':>8} {'каталог':>10} {'обход':>11} {'каталог':>11} {'обход':>12}")
+    for name, screen in SCREENS.items():
+        calls = TextCalls(texts.get_text)
+        screen(calls)
+        
+        text_compiled = measure(lambda: [texts.get_text(p, **k) for p, k in calls.paths], args.number)
+        text_uncompiled = measure(lambda: [texts._get_text_uncompiled(p, **k) for p, k in calls.paths], args.number)
+        full_compiled = measure(lambda: screen(texts.get_text), args.number)
+        full_uncompiled = measure(lambda: screen(texts._get_text_uncompiled), args.number)
+        
+        print(f"{name:<18} {len(calls.paths):>8} {text_compiled:>10.2f} {text_uncompiled:>11.2f} "
+              f"{full_compiled:>11.2f} {full_uncompiled:>12.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
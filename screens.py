@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | SCREENS
+
+Кэш отрисованных экранов бота и клавиатуры, которые не меняются.
+
+Экран, зависящий от настроек пользователя, кэшируется по ключу
+(экран, user_id, config_version, статус скрипта): любое сохранение настроек или
+координат увеличивает config_version, и старая запись просто перестаёт находиться.
+Размер кэша ограничен, вытесняются давно не использованные экраны (LRU).
+"""
+
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import texts
+
+Rendered = Tuple[str, InlineKeyboardMarkup]
+
+class RenderCache:
+    """LRU-кэш отрисованных экранов: ключ -> (текст, клавиатура)"""
+    def __init__(self, max_size: int = config.RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries: "OrderedDict[Hashable, Rendered]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Hashable) -> Optional[Rendered]:
+        rendered = self.entries.get(key)
+        if rendered is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return rendered
+    
+    def put(self, key: Hashable, rendered: Rendered):
+        self.entries[key] = rendered
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def get_or_render(self, key: Hashable, render: Callable[[], Rendered]) -> Rendered:
+        """Готовый экран из кэша или отрисованный render()"""
+        rendered = self.get(key)
+        if rendered is None:
+            rendered = render()
+            self.put(key, rendered)
+        return rendered
+
+# ===== СТАТИЧЕСКИЕ КЛАВИАТУРЫ =====
+# Не зависят ни от пользователя, ни от настроек: собираются один раз при запуске
+
+COMMANDS_MAIN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text=texts.get_text("COMMANDS.restskin.name"), callback_data='cmd_restskin'),
+        InlineKeyboardButton(text=texts.get_text("COMMANDS.saleskin.name"), callback_data='cmd_saleskin')
+    ],
+    [
+        InlineKeyboardButton(text=texts.get_text("COMMANDS.compcheck.name"), callback_data='cmd_compcheck'),
+        InlineKeyboardButton(text=texts.get_text("COMMANDS.device_info.name"), callback_data='cmd_device_info')
+    ],
+    [InlineKeyboardButton(text=texts.get_text("COMMANDS.script_info.name"), callback_data='cmd_script_info')],
+    [InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='script_main')]
+])
+
+ADMIN_MAIN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=texts.get_text("ADMIN.buttons.keys"), callback_data='admin_keys')],
+    [
+        InlineKeyboardButton(text=texts.get_text("ADMIN.buttons.stats"), callback_data='admin_statistics'),
+        InlineKeyboardButton(text=texts.get_text("ADMIN.buttons.loot"), callback_data='admin_loot')
+    ],
+    [InlineKeyboardButton(text=texts.get_text("BUTTONS.back"), callback_data='menu_main')]
+])
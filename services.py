@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | SERVICES
+
+Общие операции бота и API над скриптом пользователя: статус, пауза, остановка,
+команды и уведомления. Бот и API вызывают их напрямую, без HTTP между собой.
+При запуске через launcher.py оба работают в одном процессе и делят одну базу
+(и её кэш) и одну очередь уведомлений.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from database import create_database
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+_db: Optional[Storage] = None
+_notifications: Optional[asyncio.Queue] = None
+_unconsumed_logged = False
+
+def get_database() -> Storage:
+    """Общий экземпляр хранилища процесса (создаётся при первом обращении)"""
+    global _db
+    if _db is None:
+        _db = create_database()
+    return _db
+
+# ===== СТАТУС СКРИПТА =====
+
+def get_script_status(user_id: int) -> Dict[str, Any]:
+    """Статус скрипта: is_running, is_paused, pause_until (мс Unix или None)"""
+    status = get_database().get_script_status(user_id)
+    return {
+        'is_running': status.get('is_running', False),
+        'is_paused': status.get('is_paused', False),
+        'pause_until': status.get('pause_until')
+    }
+
+def get_script_state(user_id: int) -> Dict[str, Any]:
+    """Статус скрипта и наличие ожидающих команд"""
+    state = get_script_status(user_id)
+    state['has_commands'] = bool(get_database().get_pending_commands(user_id))
+    return state
+
+def get_status_changes(cursor: Any = None, limit: int = config.BATCH_SIZE) -> Tuple[List[Dict], Any]:
+    """Статусы всех скриптов, изменившиеся после курсора: (изменения, новый курсор)"""
+    return get_database().get_status_changes(cursor, limit)
+
+def pause_script(user_id: int, seconds: int):
+    """Поставить скрипт на паузу на seconds секунд (0 - снять паузу)"""
+    get_database().set_pause(user_id, seconds)
+
+def stop_script(user_id: int):
+    """Отметить скрипт остановленным"""
+    get_database().update_script_status(user_id, False, False)
+
+# ===== КОМАНДЫ =====
+
+def send_command(user_id: int, command_type: str, params: Optional[Dict] = None) -> int:
+    """Поставить команду скрипту. Возвращает id команды"""
+    return get_database().create_command(user_id, command_type, params)
+
+def complete_commands(user_id: int, command_type: str) -> int:
+    """Завершить все ожидающие команды типа command_type. Возвращает их количество"""
+    db = get_database()
+    completed = 0
+    for command in db.get_pending_commands(user_id):
+        if command['command_type'] == command_type:
+            db.complete_command(command['id'])
+            completed += 1
+    return completed
+
+# ===== УВЕДОМЛЕНИЯ =====
+
+def register_notification_consumer() -> asyncio.Queue:
+    """
+    Зарегистрировать получателя уведомлений (бот в общем процессе launcher.py)
+    
+    Без получателя notify() ничего не копит: отдельно запущенному API
+    уведомления отдавать некому.
+    """
+    global _notifications
+    if _notifications is None:
+        _notifications = asyncio.Queue(maxsize=config.NOTIFICATION_QUEUE_SIZE)
+    return _notifications
+
+def notify(user_id: int, message: str, message_type: str = "notification"):
+    """Поставить уведомление пользователю в очередь бота; при переполнении вытесняется самое старое"""
+    global _unconsumed_logged
+    queue = _notifications
+    if queue is None:
+        if not _unconsumed_logged:
+            logger.debug("Бот в этом процессе не запущен, уведомления скриптов не доставляются")
+            _unconsumed_logged = True
+        return
+    
+    if queue.full():
+        dropped = queue.get_nowait()
+        logger.warning(f"Очередь уведомлений переполнена, отброшено для user_id={dropped['user_id']}")
+    queue.put_nowait({
+        'user_id': user_id,
+        'message': message,
+        'type': message_type
+    })
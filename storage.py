@@ -0,0 +1,948 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | STORAGE
+
+Интерфейс хранилища (Storage) и движок в памяти (MemoryStorage).
+SQLite-движок - database.Database; выбор движка - database.create_database().
+"""
+
+import bisect
+import hashlib
+import heapq
+import json
+import logging
+import secrets
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, List, Tuple
+
+import config
+from timeutil import now_ms
+
+logger = logging.getLogger(__name__)
+
+# Отпечаток значений по умолчанию: готовые конфиги, собранные при других значениях, пересобираются
+CONFIG_DEFAULTS_HASH = hashlib.sha1(
+    json.dumps([config.DEFAULT_SETTINGS, config.DEFAULT_COORDINATES], sort_keys=True).encode()
+).hexdigest()
+
+class Storage(ABC):
+    """
+    Интерфейс хранилища данных бота и API
+    
+    Методы записи с параметром wait при wait=False возвращают Future
+    (для asyncio - asyncio.wrap_future), иначе сразу результат.
+    """
+    
+    def close(self):
+        """Освободить ресурсы хранилища"""
+    
+    @property
+    def db_paths(self) -> List[str]:
+        """Файлы БД хранилища (для резервного копирования)"""
+        return []
+    
+    # ===== ПОЛЬЗОВАТЕЛИ =====
+    
+    @abstractmethod
+    def get_or_create_user(self, user_id: int, username: str = None) -> Dict:
+        """Получить или создать пользователя"""
+    
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """Получить информацию о пользователе"""
+    
+    @abstractmethod
+    def get_last_message_id(self, user_id: int) -> Optional[int]:
+        """Получить последний message_id пользователя"""
+    
+    @abstractmethod
+    def set_last_message_id(self, user_id: int, message_id: int, wait: bool = True) -> bool:
+        """Установить последний message_id пользователя"""
+    
+    # ===== КЛЮЧИ =====
+    
+    @abstractmethod
+    def create_key(self, created_by: int) -> Dict:
+        """Создать новый ключ"""
+    
+    @abstractmethod
+    def create_keys(self, created_by: int, count: int) -> List[Dict]:
+        """Создать count новых ключей одной операцией"""
+    
+    @abstractmethod
+    def activate_key(self, key_value: str, user_id: int) -> bool:
+        """Активировать ключ"""
+    
+    @abstractmethod
+    def get_user_key_info(self, user_id: int) -> Optional[Dict]:
+        """Получить ключ, привязанный к пользователю"""
+    
+    @abstractmethod
+    def freeze_key(self, key_id: int) -> bool:
+        """Заморозить ключ"""
+    
+    @abstractmethod
+    def unfreeze_key(self, key_id: int) -> bool:
+        """Разморозить ключ"""
+    
+    @abstractmethod
+    def unbind_key(self, key_id: int) -> bool:
+        """Отвязать ключ от пользователя"""
+    
+    @abstractmethod
+    def delete_key(self, key_id: int) -> bool:
+        """Удалить ключ"""
+    
+    @abstractmethod
+    def freeze_keys(self, key_ids: List[int]) -> int:
+        """Заморозить несколько ключей"""
+    
+    @abstractmethod
+    def unfreeze_keys(self, key_ids: List[int]) -> int:
+        """Разморозить несколько ключей"""
+    
+    @abstractmethod
+    def unbind_keys(self, key_ids: List[int]) -> int:
+        """Отвязать несколько ключей"""
+    
+    @abstractmethod
+    def delete_keys(self, key_ids: List[int]) -> int:
+        """Удалить несколько ключей"""
+    
+    @abstractmethod
+    def get_all_keys(self, limit: int = None, offset: int = 0) -> List[Dict]:
+        """Получить все ключи (от новых к старым)"""
+    
+    @abstractmethod
+    def get_keys_page(self, exclude_owners: List[int] = None, after: Tuple = None,
+                      before: Tuple = None, limit: int = config.ADMIN_KEYS_PAGE_SIZE) -> Dict:
+        """Страница ключей по курсору (created_at, id): {'keys', 'has_prev', 'has_next'}"""
+    
+    @abstractmethod
+    def count_keys(self, exclude_owners: List[int] = None) -> int:
+        """Количество ключей без привязанных к exclude_owners"""
+    
+    @abstractmethod
+    def get_key_by_id(self, key_id: int) -> Optional[Dict]:
+        """Получить ключ по ID"""
+    
+    @abstractmethod
+    def get_keys_by_values(self, key_values: List[str]) -> List[Dict]:
+        """Получить ключи по списку значений в порядке списка (отсутствующие пропускаются)"""
+    
+    @abstractmethod
+    def get_key_by_value(self, key_value: str) -> Optional[Dict]:
+        """Получить ключ по значению"""
+    
+    # ===== НАСТРОЙКИ СКРИПТА =====
+    
+    @abstractmethod
+    def get_script_settings(self, user_id: int) -> Dict:
+        """Получить настройки скрипта (DEFAULT_SETTINGS + переопределения)"""
+    
+    @abstractmethod
+    def save_script_settings(self, user_id: int, settings: Dict, wait: bool = True) -> bool:
+        """Сохранить настройки скрипта"""
+    
+    @abstractmethod
+    def get_config_version(self, user_id: int) -> int:
+        """Получить версию конфигурации"""
+    
+    @abstractmethod
+    def get_script_config(self, user_id: int) -> bytes:
+        """Получить готовый плоский конфиг скрипта (JSON в байтах)"""
+    
+    # ===== КООРДИНАТЫ =====
+    
+    @abstractmethod
+    def get_user_coordinates(self, user_id: int) -> Dict:
+        """Получить все координаты пользователя (с координатами по умолчанию)"""
+    
+    @abstractmethod
+    def save_user_coordinate(self, user_id: int, coord_name: str, x: int, y: int) -> bool:
+        """Сохранить координату пользователя"""
+    
+    @abstractmethod
+    def delete_user_coordinate(self, user_id: int, coord_name: str) -> bool:
+        """Удалить координату пользователя"""
+    
+    # ===== КОМАНДЫ =====
+    
+    @abstractmethod
+    def create_command(self, user_id: int, command_type: str, params: Dict = None,
+                       wait: bool = True) -> int:
+        """Создать команду в очереди"""
+    
+    @abstractmethod
+    def get_pending_commands(self, user_id: int) -> List[Dict]:
+        """Получить ожидающие команды пользователя (от старых к новым)"""
+    
+    @abstractmethod
+    def complete_command(self, command_id: int, result: str = None, wait: bool = True) -> bool:
+        """Отметить команду как выполненную"""
+    
+    @abstractmethod
+    def cleanup_old_commands(self, days: int = config.COMMANDS_RETENTION_DAYS,
+                             batch_size: int = config.COMMANDS_CLEANUP_BATCH_SIZE) -> int:
+        """Удалить старые выполненные и просроченные ожидающие команды"""
+    
+    # ===== СТАТУС СКРИПТА =====
+    
+    @abstractmethod
+    def update_script_status(self, user_id: int, is_running: bool, is_paused: bool = False,
+                             wait: bool = True):
+        """Обновить статус скрипта"""
+    
+    @abstractmethod
+    def update_heartbeat(self, user_id: int, wait: bool = True):
+        """Обновить heartbeat"""
+    
+    @abstractmethod
+    def get_script_status(self, user_id: int) -> Dict:
+        """Получить статус скрипта"""
+    
+    @abstractmethod
+    def expire_script_statuses(self) -> Dict[str, int]:
+        """Снять истёкшие паузы и остановить скрипты без heartbeat: {'resumed', 'stale'}"""
+    
+    @abstractmethod
+    def get_status_changes(self, cursor: Any = None, limit: int = config.BATCH_SIZE) -> Tuple[List[Dict], Any]:
+        """Статусы, изменившиеся после курсора: (изменения, новый курсор); cursor=None - начать с текущего момента"""
+    
+    @abstractmethod
+    def set_pause(self, user_id: int, seconds: int):
+        """Установить паузу скрипта (0 - снять)"""
+    
+    # ===== СОСТОЯНИЕ ДИАЛОГОВ (FSM) =====
+    
+    @abstractmethod
+    def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], Dict]]:
+        """Состояние и данные диалога по ключу FSM (None - записи нет)"""
+    
+    @abstractmethod
+    def save_fsm_records(self, records: List[Tuple[str, int, Optional[str], Dict]], wait: bool = True) -> int:
+        """Сохранить состояния диалогов (ключ, user_id, состояние, данные); пустые записи удаляются"""
+    
+    @abstractmethod
+    def cleanup_fsm_records(self, days: int = config.FSM_RETENTION_DAYS) -> int:
+        """Удалить состояния диалогов, не менявшиеся дольше days дней"""
+    
+    # ===== ОТЛОЖЕННЫЕ УДАЛЕНИЯ СООБЩЕНИЙ =====
+    
+    @abstractmethod
+    def add_scheduled_deletions(self, deletions: List[Tuple[int, int, int]], wait: bool = True) -> int:
+        """Запомнить сообщения для удаления: (chat_id, message_id, когда удалить - мс Unix)"""
+    
+    @abstractmethod
+    def get_scheduled_deletions(self) -> List[Tuple[int, int, int]]:
+        """Все ожидающие удаления сообщений: (chat_id, message_id, due_at)"""
+    
+    @abstractmethod
+    def remove_scheduled_deletions(self, messages: List[Tuple[int, int]], wait: bool = True) -> int:
+        """Забыть удаления сообщений (chat_id, message_id) - выполненные или отменённые"""
+    
+    # ===== СТАТИСТИКА =====
+    
+    @abstractmethod
+    def get_statistics(self) -> Dict:
+        """Получить статистику системы"""
+    
+    @abstractmethod
+    def reconcile_statistics(self) -> Dict[str, int]:
+        """Сверить счётчики статистики с данными. Возвращает расхождения"""
+    
+    # ===== ОБЩИЕ МЕТОДЫ =====
+    
+    def get_coordinate_status(self, user_id: int) -> Dict:
+        """Получить статус настройки координат"""
+        coords = self.get_user_coordinates(user_id)
+        total = len(coords)
+        configured = sum(1 for c in coords.values() if c['x'] > 0 and c['y'] > 0)
+        
+        return {
+            'total': total,
+            'configured': configured,
+            'percentage': (configured / total * 100) if total > 0 else 0
+        }
+    
+    @staticmethod
+    def _generate_key_value() -> str:
+        """Сгенерировать значение ключа"""
+        return f"{config.KEY_PREFIX}{secrets.token_hex(4).upper()}"
+    
+    @staticmethod
+    def _compose_settings(overrides: Dict) -> Dict:
+        """Наложить переопределения пользователя на DEFAULT_SETTINGS"""
+        result = config.DEFAULT_SETTINGS.copy()
+        result.update(overrides)
+        return result
+    
+    @staticmethod
+    def _settings_overrides(settings: Dict) -> Dict:
+        """Оставить только значения, отличающиеся от DEFAULT_SETTINGS"""
+        defaults = config.DEFAULT_SETTINGS
+        overrides = {}
+        for key, value in settings.items():
+            if key in defaults:
+                default = defaults[key]
+                # Сравниваем и тип: True == 1 и 10 == 10.0, но для скрипта это разные значения
+                if type(value) is type(default) and value == default:
+                    continue
+            overrides[key] = value
+        return overrides
+    
+    @staticmethod
+    def _compose_coordinates(rows) -> Dict:
+        """Координаты пользователя (строки coord_id, x, y) поверх DEFAULT_COORDINATES"""
+        saved = {row['coord_id']: row for row in rows}
+        
+        coords = {}
+        for name, default in config.DEFAULT_COORDINATES.items():
+            row = saved.get(config.COORDINATE_IDS[name])
+            if row is None:
+                coords[name] = default.copy()
+            else:
+                coords[name] = {'x': row['x'], 'y': row['y'], 'description': default.get('description', '')}
+        return coords
+    
+    @staticmethod
+    def _build_script_config(settings: Dict, coordinates: Dict) -> bytes:
+        """Собрать плоский конфиг скрипта и сериализовать так же, как JSONResponse"""
+        config_data = dict(settings)
+        for coord_name, coord_data in coordinates.items():
+            config_data[f"{coord_name}_x"] = coord_data['x']
+            config_data[f"{coord_name}_y"] = coord_data['y']
+        
+        return json.dumps(
+            config_data, ensure_ascii=False, allow_nan=False, separators=(',', ':')
+        ).encode('utf-8')
+    
+    @staticmethod
+    def _format_statistics(counters: Dict[str, int]) -> Dict:
+        """Собрать ответ get_statistics из плоских счётчиков"""
+        total_users = counters.get('users_total', 0)
+        admin_users = counters.get('users_admins', 0)
+        total_keys = counters.get('keys_total', 0)
+        used_keys = counters.get('keys_used', 0)
+        
+        return {
+            'users': {
+                'total': total_users,
+                'admins': admin_users,
+                'regular': total_users - admin_users
+            },
+            'keys': {
+                'total': total_keys,
+                'used': used_keys,
+                'free': total_keys - used_keys,
+                'frozen': counters.get('keys_frozen', 0)
+            },
+            'scripts': {
+                'running': counters.get('scripts_running', 0),
+                'paused': counters.get('scripts_paused', 0),
+                'offline': counters.get('scripts_offline', 0)
+            }
+        }
+    
+    # ===== МЕТОДЫ ДЛЯ УДАЛЕНИЯ СООБЩЕНИЙ (ASYNC) =====
+    
+    async def delete_last_bot_message(self, user_id: int, bot) -> bool:
+        """Удалить последнее сообщение бота у пользователя (async)"""
+        try:
+            last_message_id = self.get_last_message_id(user_id)
+            if last_message_id:
+                await bot.delete_message(chat_id=user_id, message_id=last_message_id)
+                self.set_last_message_id(user_id, None)
+                logger.info(f"Deleted last message {last_message_id} for user {user_id}")
+                return True
+        except Exception as e:
+            # Если сообщение уже удалено или другая ошибка
+            if "message to delete not found" in str(e).lower():
+                # Просто очищаем ID
+                self.set_last_message_id(user_id, None)
+                return True
+            logger.error(f"Error deleting last message for user {user_id}: {e}")
+        return False
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти процесса: словари и кучи с той же семантикой, что и у Database
+    
+    Данные не переживают перезапуск и не разделяются между процессами -
+    для симуляций и тестов.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        
+        self.users: Dict[int, Dict] = {}
+        
+        self.keys: Dict[int, Dict] = {}
+        self.key_ids_by_value: Dict[str, int] = {}
+        self.key_ids_by_owner: Dict[int, set] = {}
+        self.keys_order: List[Tuple[int, int]] = []  # отсортированные (created_at, id)
+        self.next_key_id = 1
+        
+        self.settings: Dict[int, Dict] = {}
+        self.script_configs: Dict[int, Tuple[int, bytes]] = {}  # user_id -> (config_version, payload)
+        self.coordinates: Dict[int, Dict[int, Dict]] = {}  # user_id -> coord_id -> координата
+        
+        self.commands: Dict[int, Dict] = {}
+        self.pending_by_user: Dict[int, Dict[int, None]] = {}  # упорядочены по созданию
+        # Кучи (created_at, id) для очистки; записи удалённых/выполненных команд пропускаются лениво
+        self.pending_heap: List[Tuple[int, int]] = []
+        self.completed_heap: List[Tuple[int, int]] = []
+        self.next_command_id = 1
+        
+        self.status: Dict[int, Dict] = {}
+        self.status_seq = 0  # номер последнего изменения статуса (как status_seq в Database)
+        
+        self.fsm: Dict[str, Dict] = {}  # ключ FSM -> состояние диалога (data - JSON, как в Database)
+        self.scheduled_deletions: Dict[Tuple[int, int], int] = {}  # (chat_id, message_id) -> due_at
+    
+    @staticmethod
+    def _now(offset_seconds: float = 0) -> int:
+        """Текущее время в миллисекундах Unix со сдвигом"""
+        return now_ms() + int(offset_seconds * 1000)
+    
+    @staticmethod
+    def _result(value: Any, wait: bool):
+        """Вернуть значение или (при wait=False) уже выполненный Future"""
+        if wait:
+            return value
+        future = Future()
+        future.set_result(value)
+        return future
+    
+    # ===== ПОЛЬЗОВАТЕЛИ =====
+    
+    def get_or_create_user(self, user_id: int, username: str = None) -> Dict:
+        is_admin = user_id in config.ADMIN_IDS
+        
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                user.update(username=username, is_admin=int(is_admin), last_seen=self._now())
+                result = dict(user)
+                result['is_admin'] = is_admin
+                return result
+            
+            now = self._now()
+            self.users[user_id] = {
+                'user_id': user_id,
+                'username': username,
+                'is_admin': int(is_admin),
+                'last_message_id': None,
+                'created_at': now,
+                'last_seen': now
+            }
+            self.settings.setdefault(user_id, {'settings': {}, 'config_version': 1, 'updated_at': now})
+            self.status[user_id] = {
+                'user_id': user_id,
+                'is_running': 0,
+                'is_paused': 0,
+                'pause_until': None,
+                'last_heartbeat': None
+            }
+            self._touch_status(self.status[user_id])
+            return dict(self.users[user_id])
+    
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        with self.lock:
+            user = self.users.get(user_id)
+            return dict(user) if user else None
+    
+    def get_last_message_id(self, user_id: int) -> Optional[int]:
+        with self.lock:
+            user = self.users.get(user_id)
+            return user['last_message_id'] if user else None
+    
+    def set_last_message_id(self, user_id: int, message_id: int, wait: bool = True) -> bool:
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                user['last_message_id'] = message_id
+            return self._result(user is not None, wait)
+    
+    # ===== КЛЮЧИ =====
+    
+    def _insert_key(self, key_value: str, created_by: int) -> Dict:
+        key = {
+            'id': self.next_key_id,
+            'key_value': key_value,
+            'created_by': created_by,
+            'created_at': self._now(),
+            'activated_by': None,
+            'activated_at': None,
+            'is_frozen': 0
+        }
+        self.next_key_id += 1
+        self.keys[key['id']] = key
+        self.key_ids_by_value[key_value] = key['id']
+        bisect.insort(self.keys_order, (key['created_at'], key['id']))
+        return key
+    
+    def _set_key_owner(self, key: Dict, owner: Optional[int]):
+        if key['activated_by'] is not None:
+            owned = self.key_ids_by_owner.get(key['activated_by'])
+            if owned:
+                owned.discard(key['id'])
+                if not owned:
+                    del self.key_ids_by_owner[key['activated_by']]
+        
+        key['activated_by'] = owner
+        key['activated_at'] = self._now() if owner is not None else None
+        if owner is not None:
+            self.key_ids_by_owner.setdefault(owner, set()).add(key['id'])
+    
+    def _remove_key(self, key: Dict):
+        self._set_key_owner(key, None)
+        del self.keys[key['id']]
+        del self.key_ids_by_value[key['key_value']]
+        order_key = (key['created_at'], key['id'])
+        index = bisect.bisect_left(self.keys_order, order_key)
+        if index < len(self.keys_order) and self.keys_order[index] == order_key:
+            del self.keys_order[index]
+    
+    def create_key(self, created_by: int) -> Dict:
+        with self.lock:
+            for _ in range(config.KEY_GENERATION_ATTEMPTS):
+                key_value = self._generate_key_value()
+                if key_value not in self.key_ids_by_value:
+                    return dict(self._insert_key(key_value, created_by))
+            raise RuntimeError("Не удалось сгенерировать уникальный ключ")
+    
+    def create_keys(self, created_by: int, count: int) -> List[Dict]:
+        count = min(count, config.KEYS_BULK_MAX)
+        
+        with self.lock:
+            # Список, а не множество: ключи возвращаются в порядке id, как у Database
+            values: List[str] = []
+            chosen = set()
+            for _ in range(config.KEY_GENERATION_ATTEMPTS):
+                for _ in range(count - len(values)):
+                    value = self._generate_key_value()
+                    if value not in chosen and value not in self.key_ids_by_value:
+                        chosen.add(value)
+                        values.append(value)
+                if len(values) >= count:
+                    break
+            else:
+                raise RuntimeError("Не удалось сгенерировать уникальные ключи")
+            
+            return [dict(self._insert_key(value, created_by)) for value in values]
+    
+    def activate_key(self, key_value: str, user_id: int) -> bool:
+        with self.lock:
+            key = self.keys.get(self.key_ids_by_value.get(key_value))
+            if not key or key['activated_by'] is not None or key['is_frozen']:
+                return False
+            
+            self._set_key_owner(key, user_id)
+            return True
+    
+    def get_user_key_info(self, user_id: int) -> Optional[Dict]:
+        with self.lock:
+            owned = self.key_ids_by_owner.get(user_id)
+            return dict(self.keys[min(owned)]) if owned else None
+    
+    def _apply_to_keys(self, key_ids: List[int], action: str) -> int:
+        """Применить действие к ключам; возвращает количество изменённых"""
+        affected = 0
+        with self.lock:
+            for key_id in dict.fromkeys(key_ids):
+                key = self.keys.get(key_id)
+                if not key:
+                    continue
+                
+                if action == 'freeze' and not key['is_frozen']:
+                    key['is_frozen'] = 1
+                elif action == 'unfreeze' and key['is_frozen']:
+                    key['is_frozen'] = 0
+                elif action == 'unbind' and key['activated_by'] is not None:
+                    self._set_key_owner(key, None)
+                elif action == 'delete':
+                    self._remove_key(key)
+                else:
+                    continue
+                affected += 1
+        return affected
+    
+    def freeze_key(self, key_id: int) -> bool:
+        with self.lock:
+            key = self.keys.get(key_id)
+            if key:
+                key['is_frozen'] = 1
+            return key is not None
+    
+    def unfreeze_key(self, key_id: int) -> bool:
+        with self.lock:
+            key = self.keys.get(key_id)
+            if key:
+                key['is_frozen'] = 0
+            return key is not None
+    
+    def unbind_key(self, key_id: int) -> bool:
+        with self.lock:
+            key = self.keys.get(key_id)
+            if key:
+                self._set_key_owner(key, None)
+            return key is not None
+    
+    def delete_key(self, key_id: int) -> bool:
+        return self._apply_to_keys([key_id], 'delete') > 0
+    
+    def freeze_keys(self, key_ids: List[int]) -> int:
+        return self._apply_to_keys(key_ids, 'freeze')
+    
+    def unfreeze_keys(self, key_ids: List[int]) -> int:
+        return self._apply_to_keys(key_ids, 'unfreeze')
+    
+    def unbind_keys(self, key_ids: List[int]) -> int:
+        return self._apply_to_keys(key_ids, 'unbind')
+    
+    def delete_keys(self, key_ids: List[int]) -> int:
+        return self._apply_to_keys(key_ids, 'delete')
+    
+    def get_all_keys(self, limit: int = None, offset: int = 0) -> List[Dict]:
+        with self.lock:
+            order = self.keys_order[::-1]
+            if limit:
+                order = order[offset:offset + limit]
+            return [dict(self.keys[key_id]) for _, key_id in order]
+    
+    def get_keys_page(self, exclude_owners: List[int] = None, after: Tuple = None,
+                      before: Tuple = None, limit: int = config.ADMIN_KEYS_PAGE_SIZE) -> Dict:
+        excluded = set(exclude_owners or [])
+        
+        with self.lock:
+            if before is not None:
+                start = bisect.bisect_right(self.keys_order, tuple(before))
+                candidates = iter(self.keys_order[start:])
+            else:
+                end = bisect.bisect_left(self.keys_order, tuple(after)) if after is not None else len(self.keys_order)
+                candidates = reversed(self.keys_order[:end])
+            
+            # Берём на один ключ больше, чтобы узнать, есть ли ещё страница в этом направлении
+            rows = []
+            for _, key_id in candidates:
+                key = self.keys[key_id]
+                if key['activated_by'] is not None and key['activated_by'] in excluded:
+                    continue
+                row = dict(key)
+                owner = self.users.get(key['activated_by'])
+                row['owner_username'] = owner['username'] if owner else None
+                rows.append(row)
+                if len(rows) > limit:
+                    break
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        if before is not None:
+            rows.reverse()
+            return {'keys': rows, 'has_prev': has_more, 'has_next': True}
+        return {'keys': rows, 'has_prev': after is not None, 'has_next': has_more}
+    
+    def count_keys(self, exclude_owners: List[int] = None) -> int:
+        with self.lock:
+            excluded = sum(len(self.key_ids_by_owner.get(owner, ())) for owner in set(exclude_owners or []))
+            return len(self.keys) - excluded
+    
+    def get_key_by_id(self, key_id: int) -> Optional[Dict]:
+        with self.lock:
+            key = self.keys.get(key_id)
+            return dict(key) if key else None
+    
+    def get_keys_by_values(self, key_values: List[str]) -> List[Dict]:
+        with self.lock:
+            return [
+                dict(self.keys[self.key_ids_by_value[value]])
+                for value in dict.fromkeys(key_values)
+                if value in self.key_ids_by_value
+            ]
+    
+    def get_key_by_value(self, key_value: str) -> Optional[Dict]:
+        with self.lock:
+            key = self.keys.get(self.key_ids_by_value.get(key_value))
+            return dict(key) if key else None
+    
+    # ===== НАСТРОЙКИ СКРИПТА =====
+    
+    def get_script_settings(self, user_id: int) -> Dict:
+        with self.lock:
+            row = self.settings.setdefault(
+                user_id, {'settings': {}, 'config_version': 1, 'updated_at': self._now()}
+            )
+            # Копия через JSON - как и из БД, вложенные значения не разделяются с хранилищем
+            return self._compose_settings(json.loads(json.dumps(row['settings'])))
+    
+    def save_script_settings(self, user_id: int, settings: Dict, wait: bool = True) -> bool:
+        overrides = json.loads(json.dumps(self._settings_overrides(settings)))
+        
+        with self.lock:
+            row = self.settings.get(user_id)
+            if row:
+                row.update(settings=overrides, config_version=row['config_version'] + 1, updated_at=self._now())
+            return self._result(row is not None, wait)
+    
+    def get_config_version(self, user_id: int) -> int:
+        with self.lock:
+            row = self.settings.get(user_id)
+            return row['config_version'] if row else 1
+    
+    def get_script_config(self, user_id: int) -> bytes:
+        with self.lock:
+            cached = self.script_configs.get(user_id)
+            if cached and cached[0] == self.get_config_version(user_id):
+                return cached[1]
+            
+            payload = self._build_script_config(self.get_script_settings(user_id), self.get_user_coordinates(user_id))
+            self.script_configs[user_id] = (self.get_config_version(user_id), payload)
+            return payload
+    
+    def _bump_config_version(self, user_id: int):
+        row = self.settings.get(user_id)
+        if row:
+            row['config_version'] += 1
+    
+    # ===== КООРДИНАТЫ =====
+    
+    def get_user_coordinates(self, user_id: int) -> Dict:
+        with self.lock:
+            rows = [dict(row, coord_id=coord_id) for coord_id, row in self.coordinates.get(user_id, {}).items()]
+        return self._compose_coordinates(rows)
+    
+    def save_user_coordinate(self, user_id: int, coord_name: str, x: int, y: int) -> bool:
+        if coord_name not in config.DEFAULT_COORDINATES:
+            return False
+        
+        with self.lock:
+            self.coordinates.setdefault(user_id, {})[config.COORDINATE_IDS[coord_name]] = {
+                'x': x, 'y': y, 'updated_at': self._now()
+            }
+            self._bump_config_version(user_id)
+            return True
+    
+    def delete_user_coordinate(self, user_id: int, coord_name: str) -> bool:
+        with self.lock:
+            deleted = self.coordinates.get(user_id, {}).pop(config.COORDINATE_IDS.get(coord_name), None) is not None
+            self._bump_config_version(user_id)
+            return deleted
+    
+    # ===== КОМАНДЫ =====
+    
+    def create_command(self, user_id: int, command_type: str, params: Dict = None,
+                       wait: bool = True) -> int:
+        with self.lock:
+            command = {
+                'id': self.next_command_id,
+                'user_id': user_id,
+                'command_type': command_type,
+                'params': json.dumps(params) if params else None,
+                'status': 'pending',
+                'result': None,
+                'created_at': self._now(),
+                'executed_at': None
+            }
+            self.next_command_id += 1
+            self.commands[command['id']] = command
+            self.pending_by_user.setdefault(user_id, {})[command['id']] = None
+            heapq.heappush(self.pending_heap, (command['created_at'], command['id']))
+            return self._result(command['id'], wait)
+    
+    def get_pending_commands(self, user_id: int) -> List[Dict]:
+        with self.lock:
+            return [dict(self.commands[command_id]) for command_id in self.pending_by_user.get(user_id, {})]
+    
+    def complete_command(self, command_id: int, result: str = None, wait: bool = True) -> bool:
+        with self.lock:
+            command = self.commands.get(command_id)
+            if command:
+                if command['status'] == 'pending':
+                    self.pending_by_user[command['user_id']].pop(command_id, None)
+                    heapq.heappush(self.completed_heap, (command['created_at'], command_id))
+                command.update(status='completed', result=result, executed_at=self._now())
+            return self._result(command is not None, wait)
+    
+    def _remove_command(self, command_id: int):
+        command = self.commands.pop(command_id)
+        pending = self.pending_by_user.get(command['user_id'])
+        if pending is not None:
+            pending.pop(command_id, None)
+            if not pending:
+                del self.pending_by_user[command['user_id']]
+    
+    def cleanup_old_commands(self, days: int = config.COMMANDS_RETENTION_DAYS,
+                             batch_size: int = config.COMMANDS_CLEANUP_BATCH_SIZE) -> int:
+        sweeps = [
+            (self.completed_heap, self._now(-days * 86400), 'completed'),
+            (self.pending_heap, self._now(-config.COMMAND_TIMEOUT_SECONDS), 'pending'),
+        ]
+        
+        total = 0
+        with self.lock:
+            for heap, cutoff, status in sweeps:
+                while heap and heap[0][0] < cutoff:
+                    _, command_id = heapq.heappop(heap)
+                    command = self.commands.get(command_id)
+                    # Запись устарела: команду уже удалили или она сменила статус
+                    if command is None or (command['status'] == 'pending') != (status == 'pending'):
+                        continue
+                    self._remove_command(command_id)
+                    total += 1
+        return total
+    
+    # ===== СТАТУС СКРИПТА =====
+    
+    def _touch_status(self, status: Dict, before: Tuple = None):
+        """Присвоить статусу следующий номер изменения, если is_running/is_paused/pause_until изменились"""
+        if before != (status['is_running'], status['is_paused'], status['pause_until']):
+            self.status_seq += 1
+            status['status_seq'] = self.status_seq
+    
+    def update_script_status(self, user_id: int, is_running: bool, is_paused: bool = False,
+                             wait: bool = True):
+        with self.lock:
+            old = self.status.get(user_id)
+            status = self.status[user_id] = {
+                'user_id': user_id,
+                'is_running': int(is_running),
+                'is_paused': int(is_paused),
+                'pause_until': None,
+                'last_heartbeat': self._now(),
+                'status_seq': old['status_seq'] if old else 0
+            }
+            self._touch_status(status, (old['is_running'], old['is_paused'], old['pause_until']) if old else None)
+        return self._result(None, wait)
+    
+    def update_heartbeat(self, user_id: int, wait: bool = True):
+        with self.lock:
+            status = self.status.get(user_id)
+            if status:
+                status['last_heartbeat'] = self._now()
+        return self._result(None, wait)
+    
+    def get_script_status(self, user_id: int) -> Dict:
+        with self.lock:
+            status = self.status.get(user_id)
+            if status:
+                return dict(status)
+        
+        return {
+            'user_id': user_id,
+            'is_running': False,
+            'is_paused': False,
+            'pause_until': None,
+            'last_heartbeat': None
+        }
+    
+    def expire_script_statuses(self) -> Dict[str, int]:
+        now = self._now()
+        stale_before = self._now(-config.HEARTBEAT_TIMEOUT_SECONDS)
+        result = {'resumed': 0, 'stale': 0}
+        
+        with self.lock:
+            for status in self.status.values():
+                before = (status['is_running'], status['is_paused'], status['pause_until'])
+                if status['is_paused'] and status['pause_until'] is not None and status['pause_until'] <= now:
+                    status.update(is_paused=0, pause_until=None)
+                    result['resumed'] += 1
+                if status['is_running'] and status['last_heartbeat'] is not None and status['last_heartbeat'] < stale_before:
+                    status['is_running'] = 0
+                    result['stale'] += 1
+                self._touch_status(status, before)
+        return result
+    
+    def get_status_changes(self, cursor: Optional[int] = None,
+                           limit: int = config.BATCH_SIZE) -> Tuple[List[Dict], int]:
+        with self.lock:
+            if cursor is None:
+                return [], self.status_seq
+            changed = heapq.nsmallest(
+                limit,
+                (status for status in self.status.values() if status['status_seq'] > cursor),
+                key=lambda status: status['status_seq']
+            )
+            changes = [
+                {name: status[name] for name in ('user_id', 'is_running', 'is_paused', 'pause_until', 'status_seq')}
+                for status in changed
+            ]
+        return changes, changes[-1]['status_seq'] if changes else cursor
+    
+    def set_pause(self, user_id: int, seconds: int):
+        with self.lock:
+            status = self.status.get(user_id)
+            if not status:
+                return
+            before = (status['is_running'], status['is_paused'], status['pause_until'])
+            if seconds > 0:
+                status.update(is_paused=1, pause_until=self._now(seconds))
+            else:
+                status.update(is_paused=0, pause_until=None)
+            self._touch_status(status, before)
+    
+    # ===== СОСТОЯНИЕ ДИАЛОГОВ (FSM) =====
+    
+    def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], Dict]]:
+        with self.lock:
+            record = self.fsm.get(key)
+            return (record['state'], json.loads(record['data'])) if record else None
+    
+    def save_fsm_records(self, records: List[Tuple[str, int, Optional[str], Dict]], wait: bool = True) -> int:
+        now = self._now()
+        rows = [(key, user_id, state, json.dumps(data, ensure_ascii=False)) for key, user_id, state, data in records]
+        with self.lock:
+            for key, user_id, state, data in rows:
+                if state is None and data == '{}':
+                    self.fsm.pop(key, None)
+                else:
+                    self.fsm[key] = {'user_id': user_id, 'state': state, 'data': data, 'updated_at': now}
+        return self._result(len(rows), wait)
+    
+    def cleanup_fsm_records(self, days: int = config.FSM_RETENTION_DAYS) -> int:
+        cutoff = self._now(-days * 86400)
+        with self.lock:
+            stale = [key for key, record in self.fsm.items() if record['updated_at'] < cutoff]
+            for key in stale:
+                del self.fsm[key]
+        return len(stale)
+    
+    # ===== ОТЛОЖЕННЫЕ УДАЛЕНИЯ СООБЩЕНИЙ =====
+    
+    def add_scheduled_deletions(self, deletions: List[Tuple[int, int, int]], wait: bool = True) -> int:
+        with self.lock:
+            for chat_id, message_id, due_at in deletions:
+                self.scheduled_deletions[(chat_id, message_id)] = due_at
+        return self._result(len(deletions), wait)
+    
+    def get_scheduled_deletions(self) -> List[Tuple[int, int, int]]:
+        with self.lock:
+            return [(chat_id, message_id, due_at) for (chat_id, message_id), due_at in self.scheduled_deletions.items()]
+    
+    def remove_scheduled_deletions(self, messages: List[Tuple[int, int]], wait: bool = True) -> int:
+        with self.lock:
+            removed = sum(1 for message in messages if self.scheduled_deletions.pop(tuple(message), None) is not None)
+        return self._result(removed, wait)
+    
+    # ===== СТАТИСТИКА =====
+    
+    def get_statistics(self) -> Dict:
+        with self.lock:
+            statuses = self.status.values()
+            counters = {
+                'users_total': len(self.users),
+                'users_admins': sum(1 for user in self.users.values() if user['is_admin']),
+                'keys_total': len(self.keys),
+                'keys_used': sum(len(owned) for owned in self.key_ids_by_owner.values()),
+                'keys_frozen': sum(1 for key in self.keys.values() if key['is_frozen']),
+                'scripts_running': sum(1 for s in statuses if s['is_running'] and not s['is_paused']),
+                'scripts_paused': sum(1 for s in statuses if s['is_paused']),
+                'scripts_offline': sum(1 for s in statuses if not s['is_running']),
+            }
+        return self._format_statistics(counters)
+    
+    def reconcile_statistics(self) -> Dict[str, int]:
+        # Статистика считается напрямую по данным - расходиться нечему
+        return {}
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | STORAGE PARITY
+
+Проверка взаимозаменяемости хранилищ: один и тот же сценарий вызовов Storage
+прогоняется на MemoryStorage, Database и ShardedDatabase, результаты шагов
+сравниваются с MemoryStorage. Порядок элементов в списках сравнивается;
+отметки времени и сгенерированные значения ключей - нет.
+
+Использование:
+    python storage_parity.py            - проверить, код возврата 1 при расхождениях
+    python storage_parity.py --verbose  - показать результаты всех шагов
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from typing import Any, List, Tuple
+
+import config
+
+# Поля, зависящие от времени или случайности, а не от логики хранилища
+IGNORED_FIELDS = {
+    'created_at', 'last_seen', 'activated_at', 'updated_at', 'executed_at',
+    'last_heartbeat', 'pause_until', 'key_value',
+    'status_seq',  # у каждого шарда своя нумерация изменений
+}
+
+USERS = 12
+KEYS = 30
+
+def normalize(value: Any) -> Any:
+    """Привести результат к виду, сравнимому между хранилищами"""
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items() if k not in IGNORED_FIELDS}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+def scenario(db) -> List[Tuple[str, Any]]:
+    """Выполнить сценарий на хранилище. Returns: (шаг, результат)"""
+    results = []
+    
+    def step(name: str, value: Any):
+        results.append((name, normalize(value)))
+        return value
+    
+    admin_id = config.ADMIN_IDS[0]
+    step('get_or_create_user (админ)', db.get_or_create_user(admin_id, "admin"))
+    for user_id in range(1, USERS + 1):
+        step(f'get_or_create_user {user_id}', db.get_or_create_user(user_id, f"user{user_id}"))
+    step('get_or_create_user (повторно)', db.get_or_create_user(3, "renamed"))
+    step('get_user', db.get_user(3))
+    step('get_user (нет)', db.get_user(10 ** 9))
+    step('set_last_message_id', db.set_last_message_id(3, 55))
+    step('set_last_message_id (то же)', db.set_last_message_id(3, 55))
+    step('get_last_message_id', db.get_last_message_id(3))
+    step('get_user (после set_last_message_id)', db.get_user(3))
+    
+    # ===== КЛЮЧИ =====
+    keys = step('create_keys', db.create_keys(admin_id, KEYS))
+    step('create_key', db.create_key(admin_id))
+    for user_id in range(1, USERS + 1):
+        step(f'activate_key {user_id}', db.activate_key(keys[user_id]['key_value'], user_id))
+    step('activate_key (занят)', db.activate_key(keys[1]['key_value'], 2))
+    step('activate_key (нет)', db.activate_key('NOPE', 2))
+    
+    key_ids = [key['id'] for key in keys]
+    step('freeze_key', db.freeze_key(key_ids[2]))
+    step('activate_key (заморожен)', db.activate_key(keys[20]['key_value'], 5) if db.freeze_key(key_ids[20]) else None)
+    step('freeze_keys', db.freeze_keys(key_ids[::4]))
+    step('unfreeze_key', db.unfreeze_key(key_ids[4]))
+    step('unfreeze_keys', db.unfreeze_keys(key_ids[::8]))
+    step('unbind_key', db.unbind_key(key_ids[3]))
+    step('unbind_keys', db.unbind_keys(key_ids[5:8]))
+    step('delete_key', db.delete_key(key_ids[9]))
+    step('delete_keys', db.delete_keys(key_ids[25:]))
+    step('get_user_key_info', db.get_user_key_info(2))
+    step('get_user_key_info (отвязан)', db.get_user_key_info(3))
+    step('get_key_by_id', db.get_key_by_id(key_ids[1]))
+    step('get_key_by_value', db.get_key_by_value(keys[1]['key_value']))
+    step('get_keys_by_values', db.get_keys_by_values([key['key_value'] for key in keys[:6]] + ['NOPE']))
+    step('count_keys', db.count_keys(exclude_owners=[1, 2]))
+    step('get_all_keys', db.get_all_keys(limit=7, offset=3))
+    
+    page = step('get_keys_page', db.get_keys_page(exclude_owners=[1], limit=7))
+    last = page['keys'][-1]
+    page = step('get_keys_page (after)', db.get_keys_page(exclude_owners=[1], after=(last['created_at'], last['id']), limit=7))
+    first = page['keys'][0]
+    step('get_keys_page (before)', db.get_keys_page(exclude_owners=[1], before=(first['created_at'], first['id']), limit=7))
+    
+    # ===== НАСТРОЙКИ И КООРДИНАТЫ =====
+    settings = step('get_script_settings', db.get_script_settings(4))
+    first_setting = next(iter(settings))
+    step('save_script_settings', db.save_script_settings(4, {first_setting: settings[first_setting]}))
+    step('get_script_settings (после сохранения)', db.get_script_settings(4))
+    step('get_config_version', db.get_config_version(4))
+    coord_name = next(iter(config.DEFAULT_COORDINATES))
+    step('save_user_coordinate', db.save_user_coordinate(4, coord_name, 10, 20))
+    step('save_user_coordinate (неизвестная)', db.save_user_coordinate(4, 'unknown', 1, 2))
+    step('get_user_coordinates', db.get_user_coordinates(4))
+    step('get_coordinate_status', db.get_coordinate_status(4))
+    step('get_script_config', db.get_script_config(4))
+    step('delete_user_coordinate', db.delete_user_coordinate(4, coord_name))
+    step('delete_user_coordinate (повторно)', db.delete_user_coordinate(4, coord_name))
+    step('get_config_version (после координат)', db.get_config_version(4))
+    
+    # ===== КОМАНДЫ =====
+    first_command = db.create_command(5, 'stop', {'a': 1})
+    db.create_command(5, 'pause')
+    step('complete_command', db.complete_command(first_command, 'ok'))
+    step('complete_command (нет)', db.complete_command(10 ** 9))
+    # id команд у каждого шарда свои
+    step('get_pending_commands', [
+        {k: v for k, v in command.items() if k != 'id'} for command in db.get_pending_commands(5)
+    ])
+    step('cleanup_old_commands', db.cleanup_old_commands())
+    
+    # ===== СТАТУС СКРИПТА =====
+    _, status_cursor = db.get_status_changes()
+    for user_id in range(9, USERS + 1):
+        db.update_script_status(user_id, True, user_id % 3 == 0)
+    db.update_script_status(6, True)
+    db.update_script_status(7, True, True)
+    db.update_script_status(8, False)
+    db.update_heartbeat(6)
+    db.set_pause(6, 60)
+    db.set_pause(7, 0)
+    for user_id in (6, 7, 8, 10 ** 9):
+        step(f'get_script_status {user_id}', db.get_script_status(user_id))
+    step('expire_script_statuses', db.expire_script_statuses())
+    # Порядок изменений между шардами не определён - сравниваем размеры пачек и состав
+    batches, changed = [], []
+    while True:
+        changes, status_cursor = db.get_status_changes(status_cursor, limit=2)
+        batches.append(len(changes))
+        changed.extend(changes)
+        if not changes:
+            break
+    step('get_status_changes (пачки)', batches)
+    step('get_status_changes', sorted(changed, key=lambda change: change['user_id']))
+    step('get_statistics', db.get_statistics())
+    
+    # ===== СОСТОЯНИЕ ДИАЛОГОВ И ОТЛОЖЕННЫЕ УДАЛЕНИЯ =====
+    fsm_key = 'fsm:1:9:9:default'
+    db.save_fsm_records([(fsm_key, 9, 'UserStates:delay_input', {'editing_param': 'x'})])
+    step('get_fsm_record', db.get_fsm_record(fsm_key))
+    db.save_fsm_records([(fsm_key, 9, None, {})])
+    step('get_fsm_record (удалена)', db.get_fsm_record(fsm_key))
+    step('add_scheduled_deletions', db.add_scheduled_deletions([(9, 500, 1000), (9, 501, 2000)]))
+    step('remove_scheduled_deletions', db.remove_scheduled_deletions([(9, 500)]))
+    step('get_scheduled_deletions', db.get_scheduled_deletions())
+    return results
+
+def compare(expected: List[Tuple[str, Any]], actual: List[Tuple[str, Any]]) -> List[Tuple[str, Any, Any]]:
+    """Расхождения: (шаг, ожидаемое, полученное)"""
+    diffs = [(name, want, got) for (name, want), (_, got) in zip(expected, actual) if want != got]
+    if len(expected) != len(actual):
+        diffs.append(('число шагов', len(expected), len(actual)))
+    return diffs
+
+def main(argv: List[str] = None) -> int:
+    """Точка входа CLI"""
+    parser = argparse.ArgumentParser(description="Проверка взаимозаменяемости хранилищ DARKVEIL")
+    parser.add_argument('--verbose', action='store_true', help="показать результаты всех шагов")
+    args = parser.parse_args(argv)
+    
+    from database import Database, ShardedDatabase
+    from storage import MemoryStorage
+    
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        expected = scenario(MemoryStorage())
+        if args.verbose:
+            for name, value in expected:
+                print(f"[{name}] {value}")
+        
+        engines = [
+            ('Database', lambda: Database(os.path.join(directory, "parity.db"))),
+            ('ShardedDatabase', lambda: ShardedDatabase(
+                os.path.join(directory, "parity_catalog.db"), 3, os.path.join(directory, "parity_shard{}.db")
+            )),
+        ]
+        for engine, create in engines:
+            db = create()
+            try:
+                diffs = compare(expected, scenario(db))
+            finally:
+                db.close()
+            
+            print(f"{engine}: проверено шагов: {len(expected)}, расхождений: {len(diffs)}")
+            for name, want, got in diffs:
+                print(f"[{name}]\n    MemoryStorage: {want}\n    {engine}: {got}")
+            failed = failed or bool(diffs)
+    
+    if failed:
+        print("Хранилища ведут себя по-разному", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,8 @@
 Полностью переработана структура с красивым отображением
 """
 
+from typing import Any, Callable, Dict, Optional, Tuple
+
 # ===== ГЛАВНОЕ МЕНЮ =====
 MAIN_MENU = {
     "admin": {
@@ -505,7 +507,28 @@ KEYS = {
             "delete": "🗑️ Удалить",
             "create": "➕ Создать ключ",
             "back": "‹ Назад",
-            "copy": "📋 Скопировать ключ"
+            "copy": "📋 Скопировать ключ",
+            "prev_page": "⬅️",
+            "next_page": "➡️",
+            "bulk": "📦 Массовые операции"
+        },
+        "bulk": {
+            "menu": "📦 <b>МАССОВЫЕ ОПЕРАЦИИ</b>\n\nВсе изменения выполняются одной транзакцией\n\n⬇️ Выберите действие",
+            "actions": {
+                "generate": "➕ Сгенерировать ключи",
+                "freeze": "❄️ Заморозить",
+                "unfreeze": "🔥 Разморозить",
+                "unbind": "🔓 Отвязать",
+                "delete": "🗑️ Удалить"
+            },
+            "count_prompt": "➕ <b>Генерация ключей</b>\n\nВведите количество ключей (от 1 до {max_count}):",
+            "keys_prompt": "{action}\n\nОтправьте ключи, по одному на строке (не больше {max_count}):",
+            "invalid_count": "❌ Введите число от 1 до {max_count}",
+            "too_many": "❌ Слишком много ключей: {count}. Максимум - {max_count}",
+            "generated": "✅ <b>Создано ключей:</b> {count}\n\nСписок отправлен файлом",
+            "file_caption": "🔑 Ключи ({count} шт.)",
+            "done": "✅ <b>Готово</b>\n\nИзменено ключей: {affected} из {found}",
+            "not_found": "\n\n❌ Не найдено ({count}):\n<code>{values}</code>"
         },
         "not_found": "❌ Ключ не найден",
         "operation_success": {
@@ -599,6 +622,13 @@ STATISTICS = {
         "• На паузе: {paused}\n"
         "• Остановлено: {offline}"
     ),
+    "outbound": (
+        "\n\n<b>Отправка в Telegram:</b>\n"
+        "• Отправлено: {sent}\n"
+        "• Повторов после RetryAfter: {retried}\n"
+        "• Правок схлопнуто в очереди: {coalesced}\n"
+        "• Правок без изменений пропущено: {suppressed}"
+    ),
     "users": ("<b>Пользователи:</b>\n"
              "• Всего: {total}\n"
              "• Админы: {admins}\n"
@@ -747,17 +777,10 @@ BUTTONS = {
     "close": "✖️ Закрыть"
 }
 
-def get_text(path: str, **kwargs) -> str:
-    """
-    Получить текст по пути с форматированием
-    
-    Args:
-        path: Путь к тексту через точку, например "MAIN_MENU.admin.text"
-        **kwargs: Параметры для форматирования
-    
-    Returns:
-        Отформатированный текст
-    """
+# ===== КАТАЛОГ =====
+
+def _get_text_uncompiled(path: str, **kwargs) -> str:
+    """Найти текст обходом вложенных словарей (для путей вне каталога и для сравнения в render_bench.py)"""
     parts = path.split('.')
     result = globals()[parts[0]]
     
@@ -774,3 +797,49 @@ def get_text(path: str, **kwargs) -> str:
     if isinstance(result, str) and kwargs:
         return result.format(**kwargs)
     return result
+
+def _compile_catalog() -> Dict[str, Tuple[Any, Optional[Callable[..., str]]]]:
+    """
+    Плоский каталог: путь -> (значение, форматирование или None)
+    
+    Кортежи склеены заранее; у строк без полей {} форматирования нет, они отдаются как есть.
+    Словари разделов тоже в каталоге - get_text("MODES.modes.x") возвращает сам словарь.
+    """
+    catalog = {}
+    
+    def add(path: str, value: Any):
+        if isinstance(value, tuple):
+            value = '\n'.join(value)
+        formatter = value.format if isinstance(value, str) and ('{' in value or '}' in value) else None
+        catalog[path] = (value, formatter)
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if isinstance(key, str) and '.' not in key:
+                    add(f"{path}.{key}", item)
+    
+    for name, value in list(globals().items()):
+        if name.isupper() and isinstance(value, dict):
+            add(name, value)
+    return catalog
+
+_CATALOG = _compile_catalog()
+
+def get_text(path: str, **kwargs) -> str:
+    """
+    Получить текст по пути с форматированием
+    
+    Args:
+        path: Путь к тексту через точку, например "MAIN_MENU.admin.text"
+        **kwargs: Параметры для форматирования
+    
+    Returns:
+        Отформатированный текст
+    """
+    entry = _CATALOG.get(path)
+    if entry is None:
+        return _get_text_uncompiled(path, **kwargs)
+    
+    value, formatter = entry
+    if kwargs and formatter is not None:
+        return formatter(**kwargs)
+    return value
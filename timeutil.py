@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | TIME
+
+Время в БД хранится целым числом миллисекунд Unix (UTC). Здесь - преобразования
+на границах: для показа пользователю и для ответов API.
+"""
+
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+# Выражение SQLite с текущим временем в миллисекундах (работает и без unixepoch())
+SQL_NOW_MS = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+def now_ms() -> int:
+    """Текущее время в миллисекундах Unix"""
+    return time.time_ns() // 1_000_000
+
+def to_datetime(timestamp_ms: Optional[int]) -> Optional[datetime]:
+    """Миллисекунды Unix -> datetime UTC (без tzinfo, как прежние значения CURRENT_TIMESTAMP)"""
+    if timestamp_ms is None:
+        return None
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+def format_timestamp(timestamp_ms: Optional[int], fmt: str = "%d.%m.%Y %H:%M", default: str = "-") -> str:
+    """Отформатировать время для показа пользователю"""
+    if timestamp_ms is None:
+        return default
+    return to_datetime(timestamp_ms).strftime(fmt)
+
+def to_sql_text(timestamp_ms: Optional[int]) -> Optional[str]:
+    """Миллисекунды Unix -> прежний текстовый формат 'YYYY-MM-DD HH:MM:SS' (для внешних API)"""
+    if timestamp_ms is None:
+        return None
+    return format_timestamp(timestamp_ms, "%Y-%m-%d %H:%M:%S")
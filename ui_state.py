@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+DARKVEIL 0.03 | UI STATE
+
+Состояние интерфейса бота по пользователям: текущее сообщение бота в чате и
+открытая панель скрипта (когда открыта и с каким статусом отрисована).
+
+Хранилище ограничено: не больше UI_STATE_MAX_USERS пользователей (вытесняются
+давно не использованные), записи без обращений дольше UI_STATE_TTL_SECONDS удаляются.
+message_id сохраняется в users.last_message_id в фоне (через очередь записи БД) и
+после перезапуска или вытеснения читается оттуда: бот продолжает редактировать
+своё сообщение, а не присылает новое.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
+
+import config
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+PanelStatus = Tuple[bool, bool]  # (is_running, is_paused)
+
+class UIState:
+    """Состояние интерфейса одного пользователя"""
+    __slots__ = ('message_id', 'panel_opened_at', 'panel_status', 'used_at')
+    
+    def __init__(self, message_id: Optional[int]):
+        self.message_id = message_id
+        self.panel_opened_at: Optional[float] = None  # последнее открытие панели скрипта
+        self.panel_status: Optional[PanelStatus] = None  # статус, с которым отрисована панель
+        self.used_at = time.monotonic()
+
+class UIStateStore:
+    """Ограниченное хранилище состояния интерфейса с TTL и сохранением message_id в БД"""
+    def __init__(self, db: Storage, max_users: int = config.UI_STATE_MAX_USERS,
+                 ttl: float = config.UI_STATE_TTL_SECONDS, panel_idle: float = config.UI_PANEL_IDLE_SECONDS):
+        self.db = db
+        self.max_users = max_users
+        self.ttl = ttl
+        self.panel_idle = panel_idle
+        
+        self.entries: "OrderedDict[int, UIState]" = OrderedDict()  # от давно использованных к недавним
+        self.panels: Set[int] = set()  # пользователи с открытой панелью скрипта
+    
+    def _entry(self, user_id: int) -> UIState:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            # Нет в памяти (перезапуск, вытеснение): message_id - из БД
+            entry = UIState(self.db.get_last_message_id(user_id))
+            self.entries[user_id] = entry
+            while len(self.entries) > self.max_users:
+                evicted, _ = self.entries.popitem(last=False)
+                self.panels.discard(evicted)
+        else:
+            self.entries.move_to_end(user_id)
+        entry.used_at = time.monotonic()
+        return entry
+    
+    # ===== СООБЩЕНИЕ БОТА =====
+    
+    def get_message_id(self, user_id: int) -> Optional[int]:
+        """Текущее сообщение бота у пользователя (None - нет)"""
+        return self._entry(user_id).message_id
+    
+    def set_message_id(self, user_id: int, message_id: Optional[int]):
+        """Запомнить текущее сообщение бота (None - забыть); в БД - в фоне"""
+        entry = self._entry(user_id)
+        if entry.message_id == message_id:
+            return
+        entry.message_id = message_id
+        
+        def saved(future):
+            if future.exception() is not None:
+                logger.warning(f"Не удалось сохранить message_id user_id={user_id}: {future.exception()}")
+        
+        self.db.set_last_message_id(user_id, message_id, wait=False).add_done_callback(saved)
+    
+    # ===== ПАНЕЛЬ СКРИПТА =====
+    
+    def open_panel(self, user_id: int, status: PanelStatus):
+        """Пользователь открыл панель скрипта, отрисованную со статусом status"""
+        entry = self._entry(user_id)
+        entry.panel_opened_at = entry.used_at
+        entry.panel_status = status
+        self.panels.add(user_id)
+    
+    def set_panel_status(self, user_id: int, status: PanelStatus):
+        """Панель перерисована со статусом status"""
+        entry = self.entries.get(user_id)
+        if entry is not None and user_id in self.panels:
+            entry.panel_status = status
+    
+    def close_panel(self, user_id: int):
+        """Пользователь ушёл с панели скрипта"""
+        self.panels.discard(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            entry.panel_opened_at = entry.panel_status = None
+    
+    def panel_status(self, user_id: int) -> Optional[PanelStatus]:
+        """Статус, с которым отрисована открытая панель (None - панель не открыта)"""
+        if user_id not in self.panels:
+            return None
+        return self.entries[user_id].panel_status
+    
+    def has_open_panels(self) -> bool:
+        return bool(self.panels)
+    
+    # ===== ОЧИСТКА =====
+    
+    def expire(self):
+        """Закрыть панели без действий дольше panel_idle и удалить записи без обращений дольше ttl"""
+        now = time.monotonic()
+        for user_id in [u for u in self.panels if now - self.entries[u].panel_opened_at > self.panel_idle]:
+            self.close_panel(user_id)
+        
+        # Записи упорядочены по последнему обращению: устаревшие - в начале
+        while self.entries:
+            user_id, entry = next(iter(self.entries.items()))
+            if now - entry.used_at <= self.ttl:
+                break
+            del self.entries[user_id]
+            self.panels.discard(user_id)